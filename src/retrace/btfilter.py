@@ -0,0 +1,129 @@
+#
+#  Copyright (C) 2009 Flavio Leitner <fleitner@redhat.com>
+#
+#  This copyrighted material is made available to anyone wishing to use,
+#  modify, copy, or redistribute it subject to the terms and conditions
+#  of the GNU General Public License, either version 2 of the License, or
+#  (at your option) any later version
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+#
+#  Description:
+#    The vmcore usually shows many processes with the same backtrace.
+#    This module groups similar backtraces of crash's 'foreach bt'
+#    reducing the amount of data to be reviewed. The input is consumed
+#    line by line, only one copy of every distinct frame and backtrace
+#    is kept, so vmcores with very many tasks are grouped in bounded
+#    memory.
+#
+
+from array import array
+from cStringIO import StringIO
+
+BT_FILTER_VERSION = "0.8"
+
+#PID: 373    TASK: d5874550  CPU: 7   COMMAND: "BBCU"
+def backtrace_is_starting(line):
+    return line.find("PID:") == 0 and line.find("CPU:") > 0
+
+def backtrace_is_ending(line):
+    return len(line) <= 2
+
+def backtrace_is_frame(line):
+    return line.find("#") >= 0
+
+#PID: 373    TASK: d5874550  CPU: 7   COMMAND: "BBCU"
+def backtrace_get_proc_info(line):
+    end = line.find("TASK:")
+    start = len("PID:")
+    pid = int(line[start:end])
+    start = line.find("COMMAND:") + len("COMMAND: ")
+    cmd = line[start:].rstrip("\r\n").strip('"')
+    return (cmd, pid)
+
+#0 [e041ed40] schedule at c06076a4
+def backtrace_clear_frame(line):
+    start = line.find("[")
+    end = line.find("]") + 1
+    return (line[:start] + line[end:]).strip()
+
+class BacktraceFilter(object):
+    """Groups tasks with the same backtrace. Feed it with lines
+    of 'foreach bt' output, then call report()."""
+    def __init__(self):
+        # every distinct frame is stored once
+        self.frames = {}
+        # backtrace (tuple of frames) -> index into self.groups
+        self.signatures = {}
+        # [backtrace, { command: array of PIDs }, number of PIDs]
+        self.groups = []
+        self.commands = {}
+        self.proc_info = None
+        self.backtrace = None
+
+    def _intern(self, table, value):
+        return table.setdefault(value, value)
+
+    def _finish_task(self):
+        backtrace = tuple(self.backtrace)
+        index = self.signatures.get(backtrace)
+        if index is None:
+            index = len(self.groups)
+            self.signatures[backtrace] = index
+            self.groups.append([backtrace, {}, 0])
+
+        group = self.groups[index]
+        cmd, pid = self.proc_info
+        group[1].setdefault(cmd, array("l")).append(pid)
+        group[2] += 1
+
+        self.proc_info = None
+        self.backtrace = None
+
+    def feed(self, line):
+        if self.proc_info is not None:
+            if backtrace_is_ending(line):
+                self._finish_task()
+                return
+
+            if backtrace_is_frame(line):
+                self.backtrace.append(self._intern(self.frames, backtrace_clear_frame(line)))
+            return
+
+        if backtrace_is_starting(line):
+            cmd, pid = backtrace_get_proc_info(line)
+            self.proc_info = (self._intern(self.commands, cmd), pid)
+            self.backtrace = []
+
+    def finish(self):
+        """The last task may not be followed by an empty line"""
+        if self.proc_info is not None:
+            self._finish_task()
+
+    def write_report(self, output):
+        """Writes grouped backtraces into a file-like object"""
+        self.finish()
+
+        output.write("version: %s\n\n" % BT_FILTER_VERSION)
+        for backtrace, tasks, count in self.groups:
+            output.write("\nBacktrace:\n")
+            for frame in backtrace:
+                output.write("%s\n" % frame)
+
+            output.write("PID List:\n")
+            # group all PIDs of the same command
+            for cmd in sorted(tasks):
+                pids = tasks[cmd]
+                output.write("  %s *%d[%s]\n" % (cmd, len(pids), " ".join(str(pid) for pid in pids)))
+
+            output.write("\n")
+            output.write("Total of %d PIDs\n\n" % count)
+
+    def report(self):
+        """Returns grouped backtraces as a string"""
+        output = StringIO()
+        self.write_report(output)
+        return output.getvalue()
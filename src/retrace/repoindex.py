@@ -0,0 +1,281 @@
+import rpm
+from retrace import *
+
+CONFIG = Config()
+
+REPO_INDEX_FILE = "repoindex.db"
+# indexes of older versions are rebuilt from scratch
+REPO_INDEX_VERSION = 1
+
+BUILDID_PATH_PARSER = re.compile("^/usr/lib/debug/\.build-id/([0-9a-f]{2})/([0-9a-f]+)(\.debug)?$")
+
+# SQLite refuses more than 999 parameters in a single statement
+LOOKUP_CHUNK = 500
+
+def compare_evr(package1, package2):
+    """Compares epoch, version and release of two packages. Works both
+    for yum package objects and for IndexedPackage."""
+    return rpm.labelCompare((str(package1.epoch), package1.ver, package1.rel),
+                            (str(package2.epoch), package2.ver, package2.rel))
+
+def is_binary_path(filename, mode):
+    """Only files that may appear in eu-unstrip output are indexed"""
+    if stat.S_ISLNK(mode):
+        # shared libraries are reported by their SONAME, which is
+        # a symlink, the mode of a symlink tells nothing
+        return True
+
+    if not stat.S_ISREG(mode):
+        return False
+
+    return bool(mode & 0111) or ".so" in os.path.basename(filename)
+
+class IndexedPackage(object):
+    """Package found in the repository index. Mimics the attributes
+    of yum package objects used by coredump2packages."""
+    def __init__(self, name, epoch, ver, rel, arch, base_package_name):
+        self.name = name
+        self.epoch = str(epoch)
+        self.ver = ver
+        self.rel = rel
+        self.arch = arch
+        self.base_package_name = base_package_name
+
+    def __str__(self):
+        # same as yum's ui_envra
+        if self.epoch == "0":
+            return "%s-%s-%s.%s" % (self.name, self.ver, self.rel, self.arch)
+
+        return "%s:%s-%s-%s.%s" % (self.epoch, self.name, self.ver, self.rel, self.arch)
+
+    def __cmp__(self, other):
+        result = cmp(self.name, other.name)
+        if result == 0:
+            result = compare_evr(self, other)
+        if result == 0:
+            result = cmp(self.arch, other.arch)
+        return result
+
+def get_repo_index_path(releaseid):
+    return os.path.join(CONFIG["RepoDir"], releaseid, REPO_INDEX_FILE)
+
+def is_repo_index_current(path):
+    """An index built by an older version misses some paths,
+    it is only used after build_repo_index updated it"""
+    if not os.path.isfile(path):
+        return False
+
+    con = sqlite3.connect(path)
+    try:
+        query = con.cursor()
+        query.execute("PRAGMA user_version")
+        return query.fetchone()[0] >= REPO_INDEX_VERSION
+    finally:
+        con.close()
+
+def _init_repo_index(path):
+    con = sqlite3.connect(path)
+    query = con.cursor()
+    query.execute("""
+      CREATE TABLE IF NOT EXISTS
+      packages(id INTEGER PRIMARY KEY, filename UNIQUE NOT NULL,
+               size NOT NULL, mtime NOT NULL, name NOT NULL, epoch NOT NULL,
+               version NOT NULL, release NOT NULL, arch NOT NULL,
+               basename NOT NULL)
+    """)
+    query.execute("""
+      CREATE TABLE IF NOT EXISTS
+      buildids(buildid NOT NULL, package_id NOT NULL, target)
+    """)
+    query.execute("""
+      CREATE TABLE IF NOT EXISTS
+      files(path NOT NULL, package_id NOT NULL)
+    """)
+    query.execute("CREATE INDEX IF NOT EXISTS buildids_buildid ON buildids(buildid)")
+    query.execute("CREATE INDEX IF NOT EXISTS buildids_package ON buildids(package_id)")
+    query.execute("CREATE INDEX IF NOT EXISTS files_path ON files(path)")
+    query.execute("CREATE INDEX IF NOT EXISTS files_package ON files(package_id)")
+    query.execute("""
+      CREATE INDEX IF NOT EXISTS packages_evra
+      ON packages(epoch, version, release, arch)
+    """)
+    query.execute("PRAGMA user_version")
+    if query.fetchone()[0] < REPO_INDEX_VERSION:
+        # the packages are read again by build_repo_index
+        query.execute("DELETE FROM buildids")
+        query.execute("DELETE FROM files")
+        query.execute("DELETE FROM packages")
+        query.execute("PRAGMA user_version = %d" % REPO_INDEX_VERSION)
+    con.commit()
+
+    return con
+
+def _read_rpm_header(ts, path):
+    with open(path, "rb") as f:
+        return ts.hdrFromFdno(f.fileno())
+
+def _index_package(query, filename, size, mtime, hdr):
+    epoch = hdr[rpm.RPMTAG_EPOCH]
+    if epoch is None:
+        epoch = 0
+
+    basename = hdr[rpm.RPMTAG_NAME]
+    if hdr[rpm.RPMTAG_SOURCERPM]:
+        srcname = parse_rpm_name(hdr[rpm.RPMTAG_SOURCERPM])["name"]
+        if srcname:
+            basename = srcname
+
+    query.execute("""
+      INSERT INTO packages (filename, size, mtime, name, epoch,
+                            version, release, arch, basename)
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+      """, (filename, size, mtime, hdr[rpm.RPMTAG_NAME], str(epoch),
+            hdr[rpm.RPMTAG_VERSION], hdr[rpm.RPMTAG_RELEASE],
+            hdr[rpm.RPMTAG_ARCH], basename))
+    package_id = query.lastrowid
+
+    buildids = {}
+    paths = []
+    for path, mode, linkto in zip(hdr[rpm.RPMTAG_FILENAMES],
+                                  hdr[rpm.RPMTAG_FILEMODES],
+                                  hdr[rpm.RPMTAG_FILELINKTOS]):
+        match = BUILDID_PATH_PARSER.match(path)
+        if match:
+            buildid = match.group(1) + match.group(2)
+            if match.group(3):
+                buildids.setdefault(buildid, None)
+            elif linkto:
+                # the link without suffix points to the binary
+                buildids[buildid] = os.path.normpath(os.path.join(os.path.dirname(path), linkto))
+            continue
+
+        if is_binary_path(path, mode):
+            paths.append(path)
+
+    query.executemany("INSERT INTO buildids (buildid, package_id, target) VALUES (?, ?, ?)",
+                      [(buildid, package_id, target) for buildid, target in buildids.items()])
+    query.executemany("INSERT INTO files (path, package_id) VALUES (?, ?)",
+                      [(path, package_id) for path in paths])
+
+def _remove_package(query, package_id):
+    query.execute("DELETE FROM buildids WHERE package_id = ?", (package_id,))
+    query.execute("DELETE FROM files WHERE package_id = ?", (package_id,))
+    query.execute("DELETE FROM packages WHERE id = ?", (package_id,))
+
+def build_repo_index(releaseid):
+    """Updates the index of build-ids and binaries of releaseid's local
+    repository. Only packages that were added or changed since the last
+    run are read. Returns the number of packages (re)indexed."""
+    pkgdir = os.path.join(CONFIG["RepoDir"], releaseid, "Packages")
+    con = _init_repo_index(get_repo_index_path(releaseid))
+    try:
+        query = con.cursor()
+        query.execute("SELECT id, filename, size, mtime FROM packages")
+        indexed = dict((row[1], (row[0], row[2], row[3])) for row in query.fetchall())
+
+        ts = rpm.TransactionSet()
+        ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES | rpm._RPMVSF_NODIGESTS)
+
+        changed = 0
+        present = set()
+        for filename in os.listdir(pkgdir):
+            if not filename.endswith(".rpm"):
+                continue
+
+            present.add(filename)
+            path = os.path.join(pkgdir, filename)
+            try:
+                st = os.stat(path)
+            except OSError as ex:
+                log_warn("Unable to stat %s: %s" % (filename, ex))
+                continue
+
+            old = indexed.get(filename)
+            if old is not None:
+                if old[1] == st.st_size and old[2] == int(st.st_mtime):
+                    continue
+
+                _remove_package(query, old[0])
+
+            try:
+                hdr = _read_rpm_header(ts, path)
+            except Exception as ex:
+                log_warn("Unable to read header of %s: %s" % (filename, ex))
+                continue
+
+            _index_package(query, filename, st.st_size, int(st.st_mtime), hdr)
+            changed += 1
+
+        for filename, (package_id, size, mtime) in indexed.items():
+            if not filename in present:
+                _remove_package(query, package_id)
+
+        con.commit()
+    finally:
+        con.close()
+
+    return changed
+
+class RepoIndex(object):
+    """Read access to the index built by build_repo_index"""
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            raise Exception("Repository index '%s' does not exist" % path)
+
+        self.con = sqlite3.connect(path)
+        # package names and paths are printed, not unicode
+        self.con.text_factory = str
+
+    def close(self):
+        self.con.close()
+
+    def _package(self, row):
+        return IndexedPackage(*row)
+
+    def _lookup(self, sql, keys):
+        """Runs sql for all keys in as few statements as possible.
+        The first column of each row must be the key."""
+        result = {}
+        keys = list(set(keys))
+        query = self.con.cursor()
+        for i in xrange(0, len(keys), LOOKUP_CHUNK):
+            chunk = keys[i:i + LOOKUP_CHUNK]
+            query.execute(sql % ", ".join("?" * len(chunk)), chunk)
+            for row in query.fetchall():
+                result.setdefault(row[0], []).append(row[1:])
+
+        return result
+
+    def find_debuginfos(self, buildids):
+        """Returns a dictionary { buildid: [(debuginfo package, binary path)] },
+        the path is None if the package does not tell it"""
+        rows = self._lookup("""
+          SELECT buildids.buildid, buildids.target, packages.name, packages.epoch,
+                 packages.version, packages.release, packages.arch, packages.basename
+          FROM buildids JOIN packages ON buildids.package_id = packages.id
+          WHERE buildids.buildid IN (%s)
+        """, buildids)
+
+        return dict((buildid, [(self._package(row[1:]), row[0]) for row in found])
+                    for buildid, found in rows.items())
+
+    def find_binaries(self, paths):
+        """Returns a dictionary { path: [packages containing path] }"""
+        rows = self._lookup("""
+          SELECT files.path, packages.name, packages.epoch, packages.version,
+                 packages.release, packages.arch, packages.basename
+          FROM files JOIN packages ON files.package_id = packages.id
+          WHERE files.path IN (%s)
+        """, paths)
+
+        return dict((path, [self._package(row) for row in found])
+                    for path, found in rows.items())
+
+    def find_by_evra(self, epoch, ver, rel, arch):
+        query = self.con.cursor()
+        query.execute("""
+          SELECT name, epoch, version, release, arch, basename FROM packages
+          WHERE epoch = ? AND version = ? AND release = ? AND arch = ?
+        """, (str(epoch), ver, rel, arch))
+
+        return [self._package(row) for row in query.fetchall()]
@@ -0,0 +1,437 @@
+import heapq
+import sys
+from retrace import *
+from repoindex import RepoIndex, compare_evr, get_repo_index_path, is_repo_index_current
+
+CONFIG = Config()
+
+def parse_unstrip_output(unstrip):
+    """
+    Parses eu-unstrip -n output. Returns a list of pairs (build id,
+    library/executable path) in the order of the output. The path is
+    '-' for an executable whose name eu-unstrip does not know.
+    """
+    entries = []
+    for line in unstrip.split('\n'):
+        parts = line.split()
+        if not parts or len(parts) < 3:
+            continue
+        build_id = parts[1].split('@')[0]
+        binobj_path = parts[2]
+        # try/except to handle malformed eu-unstrip output
+        # e.g. for X.org cores
+        try:
+            # if FILE (parts[2]) is not present on local filesystem
+            # eu-unstrip uses FILE as MODULENAME (parts[4])
+            if (binobj_path == '-' or binobj_path == '.') and parts[4] != '[exe]':
+                binobj_path = parts[4]
+            if binobj_path[0] != '/' and parts[4] != '[exe]':
+                continue
+        except:
+            continue
+        entries.append((build_id, binobj_path))
+
+    return entries
+
+def run_unstrip(coredump, log):
+    """Returns eu-unstrip entries of the coredump, see parse_unstrip_output,
+    or None if eu-unstrip gives no output"""
+    log.write("Running eu-unstrip...\n")
+    unstrip_proc = Popen(['eu-unstrip', '--core={0}'.format(coredump), '-n'], stdout=PIPE)
+    unstrip = unstrip_proc.communicate()[0]
+    log.write("{0}\n".format(unstrip))
+    if not unstrip:
+        return None
+
+    return parse_unstrip_output(unstrip)
+
+class IndexSearch(object):
+    """Package search in the index built by retrace-server-reposync.
+    All build-ids and paths of a coredump are looked up at once."""
+    name = "Index"
+
+    def __init__(self, index):
+        self.index = index
+        self.debuginfo_cache = {}
+        self.binary_cache = {}
+
+    def prefetch(self, entries, log):
+        """
+        Looks up all build-ids and binary object paths from eu-unstrip
+        output in the index at once. Binaries pointed to by the build-id
+        links of debuginfo packages are looked up as well, they are used
+        when eu-unstrip does not know the binary name.
+        """
+        build_ids = [build_id for build_id, binobj_path in entries]
+        log.write("Index search for {0} build-ids...\n".format(len(build_ids)))
+        self.debuginfo_cache = self.index.find_debuginfos(build_ids)
+
+        paths = [binobj_path for build_id, binobj_path in entries if binobj_path[0] == '/']
+        for found in self.debuginfo_cache.values():
+            paths.extend(target for package, target in found if target)
+        log.write("Index search for {0} binary objects...\n".format(len(paths)))
+        self.binary_cache = self.index.find_binaries(paths)
+
+    def debuginfos(self, build_id):
+        return self.debuginfo_cache.get(build_id, [])
+
+    def binaries(self, binobj_path):
+        return self.binary_cache.get(binobj_path, [])
+
+    def by_evra(self, package):
+        return self.index.find_by_evra(package.epoch, package.ver, package.rel, package.arch)
+
+class YumSearch(object):
+    """Package search in yum metadata and filelists sacks"""
+    name = "Yum"
+
+    def __init__(self, repos="*", config=None, log=None):
+        import yum
+
+        if log is None:
+            log = open(os.devnull, "w")
+
+        #
+        # Initialize yum, enable only repositories matching repos.
+        #
+        stdout = sys.stdout
+        sys.stdout = log
+        try:
+            self.yumbase = yum.YumBase()
+            if config:
+                self.yumbase.doConfigSetup(config)
+            else:
+                self.yumbase.doConfigSetup()
+            if not self.yumbase.setCacheDir():
+                raise Exception("Unable to set up yum cache directory")
+            log.write("Closing all enabled repositories...\n")
+            for repo in self.yumbase.repos.listEnabled():
+                log.write(" - {0}\n".format(repo.name))
+                repo.close()
+                self.yumbase.repos.disableRepo(repo.id)
+            log.write("Enabling repositories matching \'{0}\'...\n".format(repos))
+            for repo in self.yumbase.repos.findRepos(repos):
+                log.write(" - {0}\n".format(repo.name))
+                repo.enable()
+                repo.skip_if_unavailable = True
+            self.yumbase.repos.doSetup()
+            self.yumbase.repos.populateSack(mdtype='metadata', cacheonly=1)
+            self.yumbase.repos.populateSack(mdtype='filelists', cacheonly=1)
+        finally:
+            sys.stdout = stdout
+
+    def prefetch(self, entries, log):
+        pass
+
+    def debuginfos(self, build_id):
+        debuginfo_path = "/usr/lib/debug/.build-id/{0}/{1}.debug".format(build_id[:2], build_id[2:])
+        return [(package, None) for package in self.yumbase.pkgSack.searchFiles(debuginfo_path)]
+
+    def binaries(self, binobj_path):
+        return self.yumbase.pkgSack.searchFiles(binobj_path)
+
+    def by_evra(self, package):
+        return self.yumbase.pkgSack.searchNevra(epoch=package.epoch, ver=package.ver,
+                                                rel=package.rel, arch=package.arch)
+
+class PackageResolver(object):
+    """Finds packages necessary for processing of a coredump"""
+    def __init__(self, search):
+        self.search = search
+
+    def binary_packages_from_debuginfo_package(self, debuginfo_package, binobj_path, log):
+        """
+        Returns a list of packages corresponding to the provided debuginfo
+        package. One of the packages in the list contains the binary
+        specified in binobj_path; this is a list because if binobj_patch
+        is not specified (and sometimes it is not, binobj_path might
+        contain just '-'), we do not know which package contains the
+        binary, we know only packages from the same SRPM as the debuginfo
+        package.
+        """
+        package_list = []
+        if binobj_path == '-': # [exe] without binary name
+            log.write("   {0} search for [exe] without binary name, "
+                      "packages with NVR {1}:{2}-{3}.{4}...\n".format(self.search.name,
+                                                                      debuginfo_package.epoch,
+                                                                      debuginfo_package.ver,
+                                                                      debuginfo_package.rel,
+                                                                      debuginfo_package.arch))
+            # Append all packages with the same base package name.
+            # Other possibility is to download the debuginfo RPM,
+            # unpack it, and get the name of the binary from the
+            # /usr/lib/debug/.build-id/xx/yyyyyy symlink. The index
+            # does that in advance, see process_unstrip_entry.
+            evra_list = self.search.by_evra(debuginfo_package)
+            for package in evra_list:
+                log.write("    - {0}: base name \"{1}\"\n".format(str(package), package.base_package_name))
+                if package.base_package_name != debuginfo_package.base_package_name:
+                    continue
+                package_list.append(package)
+        else:
+            log.write("   {0} search for {1}...\n".format(self.search.name, binobj_path))
+            binobj_package_list = self.search.binaries(binobj_path)
+            for binobj_package in binobj_package_list:
+                log.write("    - {0}".format(str(binobj_package)))
+                if 0 != compare_evr(binobj_package, debuginfo_package):
+                    log.write(": NVR doesn't match\n")
+                    continue
+                log.write(": NVR matches\n")
+                package_list.append(binobj_package)
+        return package_list
+
+    def process_unstrip_entry(self, build_id, binobj_path, log):
+        """
+        Returns a tuple of two items.
+
+        First item is a list of packages which we found to be associated
+        with the unstrip entry defined by build_id and binobj_path.
+
+        Second item is a list of package versions (same package name,
+        different epoch-version-release), which contain the binary object
+        (an executable or shared library) corresponding to this unstrip
+        entry. If this method failed to find an unique package name (with
+        only different versions), this list contains the list of base
+        package names. This item can be used to associate a coredump with
+        some crashing package.
+        """
+        package_list = []
+        coredump_package_list = []
+        coredump_base_package_list = []
+        # Ask for a known path from debuginfo package.
+        debuginfo_path = "/usr/lib/debug/.build-id/{0}/{1}.debug".format(build_id[:2], build_id[2:])
+        log.write("{0} search for {1}...\n".format(self.search.name, debuginfo_path))
+        debuginfo_package_list = self.search.debuginfos(build_id)
+
+        # A problem here is that some libraries lack debuginfo. Either
+        # they were stripped during build, or they were not stripped by
+        # /usr/lib/rpm/find-debuginfo.sh because of wrong permissions or
+        # something. The proper solution is to detect such libraries and
+        # fix the packages.
+        for debuginfo_package, target in debuginfo_package_list:
+            log.write(" - {0}\n".format(str(debuginfo_package)))
+            package_list.append(debuginfo_package)
+            if binobj_path == '-' and target:
+                log.write("   Build-id link points to {0}\n".format(target))
+                binary_packages = self.binary_packages_from_debuginfo_package(debuginfo_package, target, log)
+            else:
+                binary_packages = self.binary_packages_from_debuginfo_package(debuginfo_package, binobj_path, log)
+            coredump_base_package_list.append(debuginfo_package.base_package_name)
+            if len(binary_packages) == 1:
+                coredump_package_list.append(str(binary_packages[0]))
+            package_list.extend(binary_packages)
+        if len(coredump_package_list) == len(coredump_base_package_list):
+            return package_list, coredump_package_list
+        else:
+            return package_list, coredump_base_package_list
+
+    def process_unstrip_output(self, entries, log):
+        """
+        Search for packages of the parsed eu-unstrip output.
+
+        Returns a tuple containing three items:
+          - a list of package objects
+          - a list of missing buildid entries
+          - a list of coredump package adepts
+        """
+        # List of packages found in repositories and matching the
+        # coredump.
+        package_list = []
+        # List of pairs (library/executable path, build id) which were not
+        # found.
+        missing_buildid_list = []
+        # coredump package adepts
+        coredump_package_list = []
+        # str() of packages already in package_list
+        seen = set()
+
+        self.search.prefetch(entries, log)
+
+        first_entry = True
+        for build_id, binobj_path in entries:
+            entry_package_list, entry_coredump_package_list = self.process_unstrip_entry(build_id, binobj_path, log)
+            if first_entry:
+                coredump_package_list = entry_coredump_package_list
+                first_entry = False
+            if len(entry_package_list) == 0:
+                missing_buildid_list.append([binobj_path, build_id])
+            else:
+                for entry_package in entry_package_list:
+                    nevra = str(entry_package)
+                    if not nevra in seen:
+                        seen.add(nevra)
+                        package_list.append(entry_package)
+        return package_list, missing_buildid_list, coredump_package_list
+
+    @staticmethod
+    def _evra_key(package):
+        return (package.base_package_name, package.epoch, package.ver, package.rel, package.arch)
+
+    def remove_duplicates(self, package_list, log):
+        """
+        The package list might contain multiple packages with the same
+        name, but different version. This happens because some binary had
+        the same build id over multiple package releases.
+
+        Conflicts are resolved one by one in the order of the list. The
+        packages are indexed by (name, arch), by base package name and by
+        base package name and EVRA, so that the whole pass runs in near
+        linear time even for cores with hundreds of libraries.
+        """
+        log.write("Checking for duplicates...\n")
+        alive = [True] * len(package_list)
+        # (name, arch) -> positions in package_list, in list order
+        by_name_arch = {}
+        # base package name -> positions in package_list
+        by_base = {}
+        # base package name and EVRA -> number of alive packages
+        removals = {}
+        for i, package in enumerate(package_list):
+            by_name_arch.setdefault((package.name, package.arch), []).append(i)
+            by_base.setdefault(package.base_package_name, []).append(i)
+            key = self._evra_key(package)
+            removals[key] = removals.get(key, 0) + 1
+
+        def first_alive(positions, count):
+            # drops removed packages from the front, returns up to count
+            while positions and not alive[positions[0]]:
+                positions.pop(0)
+            result = []
+            for i in positions:
+                if alive[i]:
+                    result.append(i)
+                    if len(result) == count:
+                        break
+            return result
+
+        # conflicts ordered by position of the first package, same as
+        # scanning the list from the beginning
+        conflicts = [(positions[0], key) for key, positions in by_name_arch.items()
+                     if len(positions) > 1]
+        heapq.heapify(conflicts)
+        while conflicts:
+            position, key = heapq.heappop(conflicts)
+            pair = first_alive(by_name_arch[key], 2)
+            if len(pair) < 2:
+                continue
+            if pair[0] != position:
+                heapq.heappush(conflicts, (pair[0], key))
+                continue
+
+            package1, package2 = package_list[pair[0]], package_list[pair[1]]
+            p1removals = removals[self._evra_key(package1)]
+            p2removals = removals[self._evra_key(package2)]
+
+            log.write(" - {0}".format(package1.base_package_name))
+            if package1.base_package_name != package2.base_package_name:
+                log.write(" {0}\n".format(package2.base_package_name))
+            else:
+                log.write("\n")
+            log.write("   - {0}:{1}-{2}.{3} ({4} dependent packages)\n".format(package1.epoch,
+                                                                               package1.ver,
+                                                                               package1.rel,
+                                                                               package1.arch,
+                                                                               p1removals))
+            log.write("   - {0}:{1}-{2}.{3} ({4} dependent packages)\n".format(package2.epoch,
+                                                                               package2.ver,
+                                                                               package2.rel,
+                                                                               package2.arch,
+                                                                               p2removals))
+
+            removal_candidate = package1
+            if p1removals == p2removals:
+                # Remove older if we can choose
+                if compare_evr(package1, package2) > 0:
+                    removal_candidate = package2
+                log.write("   - decided to remove {0}:{1}-{2}.{3} because it's older\n".format(removal_candidate.epoch,
+                                                                                               removal_candidate.ver,
+                                                                                               removal_candidate.rel,
+                                                                                               removal_candidate.arch))
+            else:
+                if p1removals > p2removals:
+                    removal_candidate = package2
+                log.write("   - decided to remove {0}:{1}-{2}.{3} because has fewer dependencies\n".format(removal_candidate.epoch,
+                                                                                                           removal_candidate.ver,
+                                                                                                           removal_candidate.rel,
+                                                                                                           removal_candidate.arch))
+            # Remove the removal_candidate packages from the package list
+            positions = by_base[removal_candidate.base_package_name]
+            for i in positions:
+                if alive[i] and 0 == compare_evr(package_list[i], removal_candidate):
+                    alive[i] = False
+                    removals[self._evra_key(package_list[i])] -= 1
+            by_base[removal_candidate.base_package_name] = [i for i in positions if alive[i]]
+
+            # the conflict may not be resolved yet
+            pair = first_alive(by_name_arch[key], 2)
+            if len(pair) == 2:
+                heapq.heappush(conflicts, (pair[0], key))
+
+        package_list[:] = [package for i, package in enumerate(package_list) if alive[i]]
+
+    def resolve(self, entries, log=None):
+        """
+        Returns a tuple containing three items:
+          - the crashed package or its base name, None if it is not
+            unique
+          - a sorted list of package names (as printed by yum)
+          - a list of pairs (library/executable path, build id)
+            for which no package was found
+        """
+        if log is None:
+            log = open(os.devnull, "w")
+
+        package_list, missing_buildid_list, coredump_package_list = self.process_unstrip_output(entries, log)
+        self.remove_duplicates(package_list, log)
+
+        # Clean coredump_package_list:
+        names = set(str(package) for package in package_list)
+        names.update(package.base_package_name for package in package_list)
+        coredump_package_list = [coredump_package for coredump_package in coredump_package_list
+                                 if coredump_package in names]
+
+        crash_package = None
+        if len(coredump_package_list) == 1:
+            crash_package = coredump_package_list[0]
+
+        return (crash_package,
+                [str(package) for package in sorted(package_list)],
+                [(path, build_id) for path, build_id in missing_buildid_list])
+
+def get_package_resolver(releaseid, log=None):
+    """Returns PackageResolver for the local repository of releaseid"""
+    indexpath = get_repo_index_path(releaseid)
+    if is_repo_index_current(indexpath):
+        search = IndexSearch(RepoIndex(indexpath))
+    else:
+        repoid = "%s%s" % (REPO_PREFIX, releaseid)
+        fd, yumcfgpath = tempfile.mkstemp(prefix="yum", suffix=".conf")
+        try:
+            with os.fdopen(fd, "w") as yumcfg:
+                yumcfg.write("[%s]\n" % repoid)
+                yumcfg.write("name=%s\n" % releaseid)
+                yumcfg.write("baseurl=file://%s/%s/\n" % (CONFIG["RepoDir"], releaseid))
+                yumcfg.write("failovermethod=priority\n")
+            search = YumSearch(repos=repoid, config=yumcfgpath, log=log)
+        finally:
+            os.unlink(yumcfgpath)
+
+    return PackageResolver(search)
+
+def resolve_coredump_packages(coredump, releaseid, log=None):
+    """Returns packages necessary for processing of the coredump,
+    see PackageResolver.resolve"""
+    if log is None:
+        log = open(os.devnull, "w")
+
+    entries = run_unstrip(coredump, log)
+    if entries is None:
+        log.write("eu-unstrip returned no output, no packages found\n")
+        return (None, [], [])
+
+    resolver = get_package_resolver(releaseid, log=log)
+    try:
+        return resolver.resolve(entries, log=log)
+    finally:
+        if isinstance(resolver.search, IndexSearch):
+            resolver.search.index.close()
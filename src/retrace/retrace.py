@@ -1,27 +1,42 @@
 import ConfigParser
 import datetime
 import errno
+import fcntl
 import ftplib
 import gettext
 import logging
-import magic
+import mmap
 import os
 import grp
 import re
 import random
+import Queue
+import select
 import shutil
+import signal
 import smtplib
 import sqlite3
 import stat
+import struct
+import tarfile
+import tempfile
+import threading
 import time
 import urllib
+import urllib2
 import hashlib
+import httplib
+import json
+import socket
 from argparser import *
 from webob import Request
 from yum import YumBase
+from distutils.spawn import find_executable
 from subprocess import *
 from config import *
 from plugins import *
+from sysprobe import directory_size, filesystem_free_space, get_process_table, \
+                     get_process_tree, read_process_table, TTLCache, PROCESS_TABLE_TTL
 
 GETTEXT_DOMAIN = "retrace-server"
 
@@ -67,6 +82,55 @@ SUFFIX_MAP = {
   ARCHIVE_UNKNOWN: "",
 }
 
+# enough to see the tar header
+ARCHIVE_HEADER_SIZE = 512
+# (offset, signature, type)
+ARCHIVE_SIGNATURES = [
+  (0, "\x1f\x8b", ARCHIVE_GZ),
+  # compress'd data, gzip unpacks it
+  (0, "\x1f\x9d", ARCHIVE_GZ),
+  (0, "BZh", ARCHIVE_BZ2),
+  (0, "\xfd7zXZ\x00", ARCHIVE_XZ),
+  (0, "7z\xbc\xaf\x27\x1c", ARCHIVE_7Z),
+  (0, "PK\x03\x04", ARCHIVE_ZIP),
+  (0, "\x89LZO\x00\x0d\x0a\x1a\x0a", ARCHIVE_LZOP),
+  (257, "ustar", ARCHIVE_TAR),
+]
+
+# decompressors reading stdin and writing stdout, the first installed one is used
+STREAM_DECOMPRESSORS = {
+  ARCHIVE_GZ: [["pigz", "-dc"], [GZIP_BIN, "-dc"]],
+  ARCHIVE_BZ2: [["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]],
+  ARCHIVE_XZ: [[XZ_BIN, "-dc", "-T0"]],
+  ARCHIVE_LZOP: [["lzop", "-dc"]],
+}
+_decompressors = {}
+
+UNPACK_CHUNK_SIZE = 1 << 20
+# blocks of UNPACK_CHUNK_SIZE waiting for the unpacker of a download
+INGEST_QUEUE_SIZE = 32
+
+# list of finished chunks of an interrupted HTTP download
+DOWNLOAD_STATE_SUFFIX = ".download"
+HTTP_BLOCK_SIZE = 1 << 20
+HTTP_TIMEOUT = 60
+# attempts to fetch a single chunk before the download fails
+HTTP_RETRIES = 3
+
+FTP_TIMEOUT = 60
+# idle pooled FTP connections are checked by NOOP, old ones are closed (seconds)
+FTP_NOOP_AFTER = 10
+FTP_IDLE_TIMEOUT = 120
+# how long ftp_init() waits for a free pooled connection (seconds)
+FTP_ACQUIRE_TIMEOUT = 60
+# reconnections without any progress before the download fails
+FTP_RETRIES = 3
+FTP_BLOCK_SIZE = 1 << 20
+# FTP files are not split into smaller segments
+FTP_MIN_SEGMENT = 64 << 20
+# how often the retrieved segments are recorded (bytes)
+FTP_STATE_INTERVAL = 64 << 20
+
 #characters, numbers, dash (utf-8, iso-8859-2 etc.)
 INPUT_CHARSET_PARSER = re.compile("^([a-zA-Z0-9\-]+)(,.*)?$")
 #en_GB, sk-SK, cs, fr etc.
@@ -78,10 +142,7 @@ INPUT_ARCH_PARSER = re.compile("^[a-zA-Z0-9_]+$")
 #name-version-arch (fedora-16-x86_64, rhel-6.2-i386, opensuse-12.1-x86_64)
 INPUT_RELEASEID_PARSER = re.compile("^[a-zA-Z0-9]+\-[0-9a-zA-Z\.]+\-[a-zA-Z0-9_]+$")
 
-CORE_ARCH_PARSER = re.compile("core file,? .*(x86-64|80386|ARM|aarch64|IBM S/390|64-bit PowerPC)")
 PACKAGE_PARSER = re.compile("^(.+)-([0-9]+(\.[0-9]+)*-[0-9]+)\.([^-]+)$")
-DF_OUTPUT_PARSER = re.compile("^([^ ^\t]*)[ \t]+([0-9]+)[ \t]+([0-9]+)[ \t]+([0-9]+)[ \t]+([0-9]+%)[ \t]+(.*)$")
-DU_OUTPUT_PARSER = re.compile("^([0-9]+)")
 URL_PARSER = re.compile("^/([0-9]+)/?")
 
 REPODIR_NAME_PARSER = re.compile("^[^\-]+\-[^\-]+\-[^\-]+$")
@@ -97,14 +158,14 @@ KO_DEBUG_PARSER = re.compile("^.*/([a-zA-Z0-9_\-]+)\.ko\.debug$")
 
 # parsers for vmcore version
 # 2.6.32-209.el6.x86_64 | 2.6.18-197.el5
+RELEASE_TAG_PARSER = re.compile("\\.((fc|el)[0-9]+)")
+
 KERNEL_RELEASE_PARSER = re.compile("^([0-9]+\.[0-9]+\.[0-9]+)-([0-9]+\.[^ \t]*)$")
 # OSRELEASE=2.6.32-209.el6.x86_64
 OSRELEASE_VAR_PARSER = re.compile("^OSRELEASE=([^%]*)$")
 
 DUMP_LEVEL_PARSER = re.compile("^[ \t]*dump_level[ \t]*:[ \t]*([0-9]+).*$")
 
-WORKER_RUNNING_PARSER = re.compile("^[ \t]*([0-9]+)[ \t]+[0-9]+[ \t]+([^ ^\t]+)[ \t]+.*retrace-server-worker ([0-9]+)( .*)?$")
-
 UNITS = ["B", "kB", "MB", "GB", "TB", "PB", "EB"]
 
 HANDLE_ARCHIVE = {
@@ -136,6 +197,53 @@ EXPLOITABLE_SEPARATOR = "== EXPLOITABLE ==\n"
 
 TASKPASS_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
+# seconds to wait for a concurrent writer to release the task catalog
+TASK_CATALOG_TIMEOUT = 30
+# bump when _create_task_catalog_schema() changes
+TASK_CATALOG_SCHEMA_VERSION = 1
+CRASHSTATS_DB_TIMEOUT = 30
+# bump when _create_crashstats_schema() changes
+CRASHSTATS_SCHEMA_VERSION = 2
+# StatsAppendLog: DBFile + suffix, one JSON [table, values] per line
+CRASHSTATS_LOG_SUFFIX = ".log"
+CRASHSTATS_LOG_TABLES = {
+    "reportfull": "INSERT INTO reportfull (requesttime, ip) VALUES (?, ?)",
+    "debuginfostore": "INSERT INTO debuginfostore (requesttime, hits, misses) VALUES (?, ?, ?)",
+}
+
+# maps kernel debuginfo package names to their location, in RepoDir
+KERNEL_DEBUGINFO_INDEX_FILE = "kernel-debuginfo.db"
+# per-kernel lists of debuginfo files, in RepoDir/kernel/<arch>
+KERNEL_MANIFEST_DIR = ".manifests"
+# retry a background extraction that did not finish in time (seconds)
+KERNEL_EXTRACT_TIMEOUT = 3600
+# how long a killed crash may take to exit (seconds)
+CRASH_KILL_TIMEOUT = 10
+
+KERNEL_DEBUGINFO_PARSER = re.compile("^kernel(-[a-zA-Z0-9_]+)*-debuginfo-[0-9].*\.rpm$")
+
+# admission slots, one file per running task, see acquire_task_slot()
+TASK_SLOT_DIR = ".slots"
+# a pending slot not claimed by its worker in time is freed (seconds)
+TASK_SLOT_CLAIM_TIMEOUT = 120
+
+# finished tasks needed before an estimate is trusted
+ESTIMATE_MIN_SAMPLES = 3
+# run time assumed when there is no history (seconds)
+ESTIMATE_DEFAULT_TIME = 180
+ESTIMATE_DEFAULT_VMCORE_TIME = 600
+
+# where the debuginfo store is mounted in the chroot
+DEBUGINFO_STORE_MOUNT = "/usr/lib/retrace-debug"
+# packages used within this time are never evicted (seconds)
+DEBUGINFO_STORE_GRACE = 3600
+# shared by tasks adding packages, exclusive for eviction
+DEBUGINFO_STORE_LOCK = ".lock"
+
+WORKER_QUEUE_DIR = ".queue"
+WORKER_SOCKET = ".workerd.sock"
+WORKER_PIDFILE = ".workerd.pid"
+
 
 STATUS_ANALYZE, STATUS_INIT, STATUS_BACKTRACE, STATUS_CLEANUP, \
 STATUS_STATS, STATUS_FINISHING, STATUS_SUCCESS, STATUS_FAIL, \
@@ -177,6 +285,51 @@ ARCH_MAP = {
     "aarch64": set(["aarch64"]),
 }
 
+# the headers needed to determine architecture fit into the first
+# two pages (the kdump header of a flattened vmcore follows the first)
+CORE_HEADER_SIZE = 8192
+ELF_MAGIC = "\x7fELF"
+ELFDATA2LSB = 1
+# e_machine -> canonical architecture
+ELF_MACHINES = {
+    3: "i386",      # EM_386
+    # There is no reliable way to determine which ARM version
+    # the coredump is. At the moment we only support armv7hl /
+    # armhfp - let's approximate arm = armhfp
+    40: "armhfp",   # EM_ARM
+    62: "x86_64",   # EM_X86_64
+    183: "aarch64", # EM_AARCH64
+    22: "s390x",    # EM_S390
+    21: "ppc64",    # EM_PPC64, ppc64le if little endian
+}
+# compressed kdump (makedumpfile -c/-l/-p) and diskdump start with
+# struct disk_dump_header: signature[8], int header_version and
+# struct new_utsname (6 x char[65])
+KDUMP_SIGNATURES = ["KDUMP   ", "DISKDUMP"]
+KDUMP_UTSNAME_OFFSET = 8 + 4
+UTSNAME_FIELD_SIZE = 65
+UTSNAME_RELEASE = 2
+UTSNAME_MACHINE = 4
+# makedumpfile -F writes a 4096-byte header followed by
+# 16-byte headers (offset, size) of the flattened data
+MAKEDUMPFILE_FLAT_SIGNATURE = "makedumpfile\0"
+MAKEDUMPFILE_FLAT_HEADER_SIZE = 4096 + 16
+# the last resort - look for architecture names in the beginning
+ARCH_SCAN_LIMIT = 64 << 20
+ARCH_SCAN_PARSER = re.compile("|".join(sorted(set.union(*ARCH_MAP.values()),
+                                              key=len, reverse=True)))
+PT_NOTE = 4
+# the number of program headers does not fit into e_phnum
+PN_XNUM = 0xffff
+VMCOREINFO_NOTE = "VMCOREINFO"
+# the last resort - look for OSRELEASE= of vmcoreinfo or the kernel
+# banner in the beginning of the vmcore, chunk by chunk
+VMCORE_SCAN_LIMIT = 1 << 30
+VMCORE_SCAN_CHUNK = 16 << 20
+KERNEL_RELEASE_MAXLEN = 256
+LINUX_BANNER = "Linux version "
+OSRELEASE_VAR = "OSRELEASE="
+
 PYTHON_LABLE_START = "----------PYTHON-START--------"
 PYTHON_LABLE_END   = "----------PYTHON--END---------"
 
@@ -238,24 +391,13 @@ def get_canon_arch(arch):
     return arch
 
 def free_space(path):
-    child = Popen([DF_BIN, "-B", "1", path], stdout=PIPE)
-    lines = child.communicate()[0].split("\n")
-    for line in lines:
-        match = DF_OUTPUT_PARSER.match(line)
-        if match:
-            return int(match.group(4))
-
-    return None
+    return filesystem_free_space(path)
 
 def dir_size(path):
-    child = Popen([DU_BIN, "-sb", path], stdout=PIPE)
-    lines = child.communicate()[0].split("\n")
-    for line in lines:
-        match = DU_OUTPUT_PARSER.match(line)
-        if match:
-            return int(match.group(1))
-
-    return 0
+    try:
+        return directory_size(path)
+    except OSError:
+        return 0
 
 def unpacked_size(archive, mime):
     command, parser = HANDLE_ARCHIVE[mime]["size"]
@@ -268,50 +410,95 @@ def unpacked_size(archive, mime):
 
     return None
 
+def _map_file(path, length=None):
+    """Maps at most length bytes (the whole file if None) of path
+    read-only. Returns None if the file is empty or can't be read."""
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return None
+
+            if length is not None:
+                size = min(size, length)
+
+            return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    except (IOError, OSError, mmap.error) as ex:
+        log_debug("Unable to read %s: %s" % (path, ex))
+        return None
+
+def guess_elf_arch(header):
+    """Returns architecture of an ELF core (a coredump or a kdump
+    vmcore in ELF format) or None"""
+    if len(header) < 20 or header[:4] != ELF_MAGIC:
+        return None
+
+    little_endian = ord(header[5]) == ELFDATA2LSB
+    machine = struct.unpack("<H" if little_endian else ">H", header[18:20])[0]
+    result = ELF_MACHINES.get(machine)
+    if result == "ppc64" and little_endian:
+        return "ppc64le"
+
+    return result
+
+def get_kdump_utsname(header, field):
+    """Returns a member of utsname (UTSNAME_*) from the header
+    of a compressed kdump / diskdump vmcore or None"""
+    if header.startswith(MAKEDUMPFILE_FLAT_SIGNATURE):
+        header = header[MAKEDUMPFILE_FLAT_HEADER_SIZE:]
+
+    if header[:8] not in KDUMP_SIGNATURES:
+        return None
+
+    start = KDUMP_UTSNAME_OFFSET + field * UTSNAME_FIELD_SIZE
+    value = header[start:start + UTSNAME_FIELD_SIZE].split("\0", 1)[0]
+    if not value:
+        return None
+
+    return value
+
+def guess_kdump_arch(header):
+    """Returns architecture of a compressed kdump / diskdump
+    vmcore or None"""
+    machine = get_kdump_utsname(header, UTSNAME_MACHINE)
+    if machine is None:
+        return None
+
+    return get_canon_arch(machine)
+
 def guess_arch(coredump_path):
-    child = Popen(["file", coredump_path], stdout=PIPE)
-    output = child.communicate()[0]
-    match = CORE_ARCH_PARSER.search(output)
-    if match:
-        if match.group(1) == "80386":
-            return "i386"
-        elif match.group(1) == "x86-64":
-            return "x86_64"
-        elif match.group(1) == "ARM":
-            # hack - There is no reliable way to determine which ARM
-            # version the coredump is. At the moment we only support
-            # armv7hl / armhfp - let's approximate arm = armhfp
-            return "armhfp"
-        elif match.group(1) == "aarch64":
-            return "aarch64"
-        elif match.group(1) == "IBM S/390":
-            return "s390x"
-        elif match.group(1) == "64-bit PowerPC":
-            if "LSB" in output:
-                return "ppc64le"
-
-            return "ppc64"
-
-    result = None
-    child = Popen(["strings", coredump_path], stdout=PIPE, stderr=STDOUT)
-    line = child.stdout.readline()
-    while line:
-        for canon_arch, derived_archs in ARCH_MAP.items():
-            if any(arch in line for arch in derived_archs):
-                result = canon_arch
-                break
+    """Determines architecture from the headers of a coredump or
+    vmcore. Only if they are unknown, the beginning of the file
+    (ARCH_SCAN_LIMIT bytes) is searched for architecture names."""
+    mapped = _map_file(coredump_path, CORE_HEADER_SIZE)
+    if mapped is None:
+        return None
 
-        if result is not None:
-            break
+    try:
+        header = mapped[:]
+    finally:
+        mapped.close()
 
-        line = child.stdout.readline()
+    result = guess_elf_arch(header) or guess_kdump_arch(header)
+    if result is not None:
+        return result
+
+    data = _map_file(coredump_path, ARCH_SCAN_LIMIT)
+    if data is None:
+        return None
+
+    try:
+        match = ARCH_SCAN_PARSER.search(data)
+        if match is None:
+            return None
 
-    child.kill()
-    child.stdout.close()
+        result = get_canon_arch(match.group(0))
+    finally:
+        data.close()
 
     # "ppc64le" matches both ppc64 and ppc64le
-    # if file magic says little endian, fix it
-    if result == "ppc64" and "LSB" in output:
+    # if the ELF header says little endian, fix it
+    if result == "ppc64" and header[:4] == ELF_MAGIC and ord(header[5]) == ELFDATA2LSB:
         result = "ppc64le"
 
     return result
@@ -345,7 +532,82 @@ def parse_http_gettext(lang, charset):
 
     return result
 
-def run_gdb(savedir, plugin):
+def get_chroot_cache_dir(releaseid, gdb_package):
+    """Returns the directory holding mock's root cache of the chroot
+    template shared by all tasks of the release"""
+    return os.path.join(CONFIG["ChrootCacheDir"], "%s-%s" % (releaseid, gdb_package))
+
+def write_mock_config(cfgdir, root, distribution, version, arch, gdb_package,
+                      packages=None, binds=None):
+    """Writes mock configuration for retracing a coredump into cfgdir.
+    If UseChrootCache is enabled, the chroot is set up with the base
+    packages only, so that it may be cached and shared; the task's
+    packages need to be installed by 'mock install' afterwards."""
+    releaseid = "%s-%s-%s" % (distribution, version, arch)
+    setup = ["abrt-addon-ccpp", "shadow-utils", gdb_package, "rpm"]
+    if not CONFIG["UseChrootCache"] and packages:
+        setup = packages + setup
+
+    if binds is None:
+        binds = []
+
+    with open(os.path.join(cfgdir, RetraceTask.MOCK_DEFAULT_CFG), "w") as mockcfg:
+        mockcfg.write("config_opts['root'] = '%s'\n" % root)
+        mockcfg.write("config_opts['target_arch'] = '%s'\n" % arch)
+        mockcfg.write("config_opts['chroot_setup_cmd'] = '--skip-broken install %s'\n" % " ".join(setup))
+        mockcfg.write("config_opts['plugin_conf']['ccache_enable'] = False\n")
+        mockcfg.write("config_opts['plugin_conf']['yum_cache_enable'] = False\n")
+        if CONFIG["UseChrootCache"]:
+            mockcfg.write("config_opts['yum_common_opts'] = ['--skip-broken']\n")
+            mockcfg.write("config_opts['plugin_conf']['root_cache_enable'] = True\n")
+            mockcfg.write("config_opts['plugin_conf']['root_cache_opts']['dir'] = '%s'\n" %
+                          get_chroot_cache_dir(releaseid, gdb_package))
+            # the config is written for every task, its mtime means nothing
+            mockcfg.write("config_opts['plugin_conf']['root_cache_opts']['age_check'] = False\n")
+            mockcfg.write("config_opts['plugin_conf']['root_cache_opts']['max_age_days'] = %d\n" %
+                          CONFIG["ChrootCacheMaxAge"])
+        else:
+            mockcfg.write("config_opts['plugin_conf']['root_cache_enable'] = False\n")
+        mockcfg.write("config_opts['plugin_conf']['bind_mount_enable'] = True\n")
+        mockcfg.write("config_opts['plugin_conf']['bind_mount_opts'] = { 'create_dirs': True,\n")
+        mockcfg.write("    'dirs': [\n")
+        for source, target in binds:
+            mockcfg.write("              ('%s', '%s'),\n" % (source, target))
+        mockcfg.write("            ] }\n")
+        mockcfg.write("\n")
+        mockcfg.write("config_opts['yum.conf'] = \"\"\"\n")
+        mockcfg.write("[main]\n")
+        mockcfg.write("cachedir=/var/cache/yum\n")
+        mockcfg.write("debuglevel=1\n")
+        mockcfg.write("reposdir=%s\n" % os.devnull)
+        mockcfg.write("logfile=/var/log/yum.log\n")
+        mockcfg.write("retries=20\n")
+        mockcfg.write("obsoletes=1\n")
+        if version != "rawhide" and CONFIG["RequireGPGCheck"]:
+            mockcfg.write("gpgcheck=1\n")
+        else:
+            mockcfg.write("gpgcheck=0\n")
+        mockcfg.write("assumeyes=1\n")
+        mockcfg.write("syslog_ident=mock\n")
+        mockcfg.write("syslog_device=\n")
+        mockcfg.write("\n")
+        mockcfg.write("#repos\n")
+        mockcfg.write("\n")
+        mockcfg.write("[%s]\n" % distribution)
+        mockcfg.write("name=%s\n" % releaseid)
+        mockcfg.write("baseurl=file://%s/%s/\n" % (CONFIG["RepoDir"], releaseid))
+        mockcfg.write("failovermethod=priority\n")
+        if version != "rawhide" and CONFIG["RequireGPGCheck"]:
+            mockcfg.write("gpgkey=file:///usr/share/retrace-server/gpg/%s-%s\n" % (distribution, version))
+        mockcfg.write("\"\"\"\n")
+
+    # symlink defaults from /etc/mock
+    os.symlink("/etc/mock/site-defaults.cfg",
+               os.path.join(cfgdir, RetraceTask.MOCK_SITE_DEFAULTS_CFG))
+    os.symlink("/etc/mock/logging.ini",
+               os.path.join(cfgdir, RetraceTask.MOCK_LOGGING_INI))
+
+def run_gdb(savedir, plugin, debugdirs=None):
     #exception is caught on the higher level
     exec_file = open(os.path.join(savedir, "crash", "executable"), "r")
     executable = exec_file.read(ALLOWED_FILES["executable"])
@@ -379,6 +641,9 @@ def run_gdb(savedir, plugin):
             gdbfile.write("%s -batch " % plugin.gdb_executable)
             if add_exploitable:
                 gdbfile.write("-ex 'python execfile(\"/usr/libexec/abrt-gdb-exploitable\")' ")
+            if debugdirs:
+                gdbfile.write("-ex 'set debug-file-directory %s' " %
+                              ":".join(["/usr/lib/debug"] + debugdirs))
             gdbfile.write("-ex 'file %s' "
                           "-ex 'core-file /var/spool/abrt/crash/coredump' "
                           "-ex 'echo %s\n' "
@@ -480,43 +745,140 @@ def is_package_known(package_nvr, arch, releaseid=None):
 # el6+ vmcores are just proclaimed 'data'. Another thing is that
 # the OSRELEASE in the vmcore sometimes contains architecture
 # and sometimes it does not.
-def get_kernel_release(vmcore, crash_cmd=["crash"]):
-    child = Popen(crash_cmd + ["--osrelease", vmcore], stdout=PIPE, stderr=STDOUT)
-    release = child.communicate()[0].strip()
-
-    if child.wait() != 0 or \
-       not release or \
-       "\n" in release or \
-       release == "unknown":
-        release = None
-        # crash error, let's search the vmcore on our own
-        vers = {}
-        child = Popen(["strings", "-n", "10", vmcore], stdout=PIPE, stderr=STDOUT)
-        # lots! of output, do not use .communicate()
-        line = child.stdout.readline()
-        while line:
-            line = line.strip()
+def read_elf_note(data, name):
+    """Returns the descriptor of the first note called name
+    in PT_NOTE segments of an ELF file (a string or mmap)
+    or None"""
+    if len(data) < 64 or data[:4] != ELF_MAGIC:
+        return None
 
-            # OSRELEASE variable is defined in the vmcore,
-            # but crash was not able to find it (cross-arch)
-            match = OSRELEASE_VAR_PARSER.match(line)
-            if match:
-                release = match.group(1)
-                break
+    elf64 = ord(data[4]) == 2
+    endian = "<" if ord(data[5]) == ELFDATA2LSB else ">"
+    if elf64:
+        phoff, = struct.unpack(endian + "Q", data[32:40])
+        shoff, = struct.unpack(endian + "Q", data[40:48])
+        phentsize, phnum = struct.unpack(endian + "HH", data[54:58])
+    else:
+        phoff, shoff = struct.unpack(endian + "II", data[28:36])
+        phentsize, phnum = struct.unpack(endian + "HH", data[42:46])
 
-            # assuming the kernel version will sooner or later
-            # appear in the list of strings contained in the
-            # vmcore
-            match = KERNEL_RELEASE_PARSER.match(line)
-            if match:
-                release = line
-                break
+    if phnum == PN_XNUM:
+        # the real number is sh_info of the first section header
+        infooff = shoff + (44 if elf64 else 28)
+        if infooff + 4 > len(data):
+            return None
 
-            line = child.stdout.readline()
+        phnum, = struct.unpack(endian + "I", data[infooff:infooff + 4])
 
-        # much more output is available, but we don't need any more
-        child.stdout.close()
-        child.kill()
+    for i in xrange(phnum):
+        start = phoff + i * phentsize
+        if start + phentsize > len(data):
+            break
+
+        if elf64:
+            ptype, flags, offset, vaddr, paddr, filesz = \
+                struct.unpack(endian + "IIQQQQ", data[start:start + 40])
+        else:
+            ptype, offset, vaddr, paddr, filesz = \
+                struct.unpack(endian + "IIIII", data[start:start + 20])
+
+        if ptype != PT_NOTE:
+            continue
+
+        pos = offset
+        end = min(offset + filesz, len(data))
+        while pos + 12 <= end:
+            namesz, descsz, ntype = struct.unpack(endian + "III", data[pos:pos + 12])
+            descstart = pos + 12 + ((namesz + 3) & ~3)
+            if data[pos + 12:pos + 12 + namesz].rstrip("\0") == name:
+                return data[descstart:min(descstart + descsz, end)]
+
+            pos = descstart + ((descsz + 3) & ~3)
+
+    return None
+
+def read_kernel_release(vmcore):
+    """Reads kernel release from the headers of vmcore - OSRELEASE
+    of the VMCOREINFO note of an ELF vmcore or utsname of a compressed
+    kdump / diskdump vmcore. Returns None if it is not there."""
+    mapped = _map_file(vmcore)
+    if mapped is None:
+        return None
+
+    try:
+        release = get_kdump_utsname(mapped[:CORE_HEADER_SIZE], UTSNAME_RELEASE)
+        if release is not None:
+            return release
+
+        vmcoreinfo = read_elf_note(mapped, VMCOREINFO_NOTE)
+    except struct.error as ex:
+        log_debug("Invalid headers of %s: %s" % (vmcore, ex))
+        return None
+    finally:
+        mapped.close()
+
+    if vmcoreinfo is None:
+        return None
+
+    for line in vmcoreinfo.splitlines():
+        match = OSRELEASE_VAR_PARSER.match(line)
+        if match:
+            return match.group(1)
+
+    return None
+
+def _scan_release_at(data, needle, start, end):
+    """Returns (position, release) of the first valid release
+    following needle that starts between start and end or None"""
+    while True:
+        pos = data.find(needle, start, end + len(needle) - 1)
+        if pos < 0:
+            return None
+
+        valuestart = pos + len(needle)
+        value = data[valuestart:valuestart + KERNEL_RELEASE_MAXLEN]
+        value = re.split("[\0-\x20\x7f-\xff]", value, 1)[0]
+        if needle == LINUX_BANNER:
+            if KERNEL_RELEASE_PARSER.match(value):
+                return pos, value
+        # the format string "OSRELEASE=%s" is there as well
+        elif value and OSRELEASE_VAR_PARSER.match(needle + value):
+            return pos, value
+
+        start = pos + 1
+
+def scan_kernel_release(vmcore):
+    """Searches the first VMCORE_SCAN_LIMIT bytes of vmcore
+    for OSRELEASE= of vmcoreinfo or for the kernel banner."""
+    mapped = _map_file(vmcore, VMCORE_SCAN_LIMIT)
+    if mapped is None:
+        return None
+
+    try:
+        for start in xrange(0, len(mapped), VMCORE_SCAN_CHUNK):
+            end = min(start + VMCORE_SCAN_CHUNK, len(mapped))
+            found = [_scan_release_at(mapped, needle, start, end)
+                     for needle in [OSRELEASE_VAR, LINUX_BANNER]]
+            found = [f for f in found if f is not None]
+            if found:
+                return min(found)[1]
+    finally:
+        mapped.close()
+
+    return None
+
+def get_kernel_release(vmcore, crash_cmd=["crash"]):
+    release = read_kernel_release(vmcore)
+    if release is None:
+        child = Popen(crash_cmd + ["--osrelease", vmcore], stdout=PIPE, stderr=STDOUT)
+        release = child.communicate()[0].strip()
+
+        if child.wait() != 0 or \
+           not release or \
+           "\n" in release or \
+           release == "unknown":
+            # crash error, let's search the vmcore on our own
+            release = scan_kernel_release(vmcore)
 
     if release is None or release == "unknown":
         return None
@@ -536,6 +898,215 @@ def get_kernel_release(vmcore, crash_cmd=["crash"]):
 
     return result
 
+def get_vmcore_commands():
+    """Returns a list of pairs (misc file name, list of crash commands)
+    that are run on every vmcore"""
+    commands = CONFIG.get_vmcore_commands()
+    if commands:
+        return commands
+
+    result = [("bt-a", ["set hex", "bt -a", "set dec"])]
+    if CONFIG["VmcoreRunKmem"] == 1:
+        result.append(("kmem-f", ["kmem -f"]))
+    elif CONFIG["VmcoreRunKmem"] == 2:
+        result.append(("kmem-f", ["set hash off", "kmem -f", "set hash on"]))
+    elif CONFIG["VmcoreRunKmem"] == 3:
+        result.append(("kmem-z", ["kmem -z"]))
+    result.append(("sys", ["sys"]))
+    result.append(("sys-c", ["sys -c"]))
+    result.append(("bt-filter", ["set hex", "foreach bt", "set dec"]))
+
+    return result
+
+class CrashSession(object):
+    """A single crash process serving many commands. Loading vmlinux
+    symbols and reading vmcore headers takes long on big kernels, so it
+    is only done once. Every command is followed by an 'echo' of
+    a unique sentinel, its output is everything before the sentinel.
+    With chroot set, crash runs in the mock chroot. Sessions are
+    independent, several of them may run in parallel threads."""
+    def __init__(self, vmcore, vmlinux, crash_cmd=["crash"], chroot=None, minimal=False):
+        self.vmcore = vmcore
+        self.vmlinux = vmlinux
+        # may be changed by the caller, it is read on every start()
+        self.crash_cmd = crash_cmd
+        self.chroot = chroot
+        self.minimal = minimal
+        self.child = None
+        self.buffer = ""
+        # output of the last failed command, usually crash's complaint
+        self.leftover = ""
+        self.counter = 0
+        self.sentinel = "RETRACE-SERVER-SENTINEL-%08x" % random.getrandbits(32)
+        self.timed_out = False
+        # a timed out crash could not be killed
+        self.stuck = False
+        # PID of crash as seen in the chroot
+        self.chroot_pid = None
+
+    def start(self):
+        self.close()
+
+        args = list(self.crash_cmd)
+        if self.minimal:
+            args.append("--minimal")
+        args.extend(["-s", self.vmcore, self.vmlinux])
+
+        self.buffer = ""
+        self.chroot_pid = None
+        # own process group, so that a stuck command can be killed
+        if self.chroot:
+            # crash runs as root in the chroot, it is killed from there
+            # by PID; the shell prints it before it turns into crash
+            with open(os.devnull, "w") as null:
+                self.child = Popen(["/usr/bin/mock", "--configdir", self.chroot, "shell",
+                                    "--", "echo $$; exec %s" % " ".join(args)],
+                                   stdin=PIPE, stdout=PIPE, stderr=null, preexec_fn=os.setpgrp)
+
+            line = ""
+            while not line.endswith("\n"):
+                data = os.read(self.child.stdout.fileno(), 1)
+                if not data:
+                    break
+                line += data
+
+            if line.strip().isdigit():
+                self.chroot_pid = int(line)
+            else:
+                self.buffer = line
+        else:
+            self.child = Popen(args, stdin=PIPE, stdout=PIPE, stderr=STDOUT,
+                               preexec_fn=os.setpgrp)
+
+    def is_running(self):
+        return self.child is not None and self.child.poll() is None
+
+    def _read(self, deadline=None):
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([self.child.stdout], [], [], remaining)[0]:
+                self.timed_out = True
+                return False
+
+        data = os.read(self.child.stdout.fileno(), 1 << 16)
+        if not data:
+            return False
+
+        self.buffer += data
+        return True
+
+    def run(self, commands, timeout=0, consumer=None):
+        """Runs a list of crash commands, returns their output or None
+        if crash died or did not finish in timeout seconds (0 means
+        no limit). The session is restarted by the next run then.
+        If consumer is given, it is called with every line of the output
+        as soon as it is read and an empty string is returned, so that
+        huge outputs are never held in memory."""
+        if self.child is None:
+            self.start()
+
+        deadline = None
+        if timeout > 0:
+            deadline = time.time() + timeout
+        self.timed_out = False
+        self.stuck = False
+
+        self.counter += 1
+        sentinel = "%s-%d\n" % (self.sentinel, self.counter)
+        try:
+            self.child.stdin.write("".join("%s\n" % command for command in commands))
+            self.child.stdin.write("echo %s" % sentinel)
+            self.child.stdin.flush()
+        except IOError as ex:
+            if ex.errno != errno.EPIPE:
+                raise
+
+        # the buffer before this offset has already been searched
+        searched = 0
+        while True:
+            # crash does not echo the input, the sentinel is on its own line
+            if self.buffer.startswith(sentinel):
+                pos = 0
+            else:
+                pos = self.buffer.find("\n%s" % sentinel, max(0, searched - len(sentinel)))
+                if pos >= 0:
+                    pos += 1
+
+            if pos >= 0:
+                result = self.buffer[:pos]
+                self.buffer = self.buffer[pos + len(sentinel):]
+                if consumer is None:
+                    return result
+
+                for line in result.splitlines(True):
+                    consumer(line)
+                return ""
+
+            if consumer is not None:
+                # keep the last incomplete line, it may be the sentinel
+                end = self.buffer.rfind("\n") + 1
+                for line in self.buffer[:end].splitlines(True):
+                    consumer(line)
+                self.buffer = self.buffer[end:]
+
+            searched = len(self.buffer)
+            if not self._read(deadline):
+                self.leftover = self.buffer
+                if self.timed_out:
+                    self.stuck = not self.kill()
+                else:
+                    self.close()
+                return None
+
+    def kill(self):
+        """Kills crash without waiting for the running command.
+        Returns False if crash is still running afterwards."""
+        if self.child is None:
+            return True
+
+        child = self.child
+        self.child = None
+        if self.chroot_pid is not None:
+            with open(os.devnull, "w") as null:
+                call(["/usr/bin/mock", "--configdir", self.chroot, "shell", "--",
+                      "kill -KILL %d" % self.chroot_pid], stdout=null, stderr=null)
+
+        try:
+            os.killpg(child.pid, signal.SIGKILL)
+        except OSError as ex:
+            if ex.errno != errno.ESRCH:
+                log_warn("Unable to kill crash: %s" % ex)
+
+        child.stdin.close()
+        child.stdout.close()
+        # the mock wrapper exits once crash is gone
+        deadline = time.time() + CRASH_KILL_TIMEOUT
+        while child.poll() is None:
+            if time.time() > deadline:
+                log_warn("crash (PID %d) is still running after being killed" % child.pid)
+                return False
+
+            time.sleep(0.1)
+
+        return True
+
+    def close(self):
+        """Quits crash, returns its exit code"""
+        if self.child is None:
+            return None
+
+        child = self.child
+        self.child = None
+        try:
+            child.stdin.write("quit\n")
+            child.stdin.close()
+        except IOError:
+            pass
+
+        child.stdout.read()
+        child.stdout.close()
+        return child.wait()
+
 def find_kernel_debuginfo(kernelver):
     vers = [kernelver]
 
@@ -564,6 +1135,59 @@ def find_kernel_debuginfo(kernelver):
                 else:
                     log_debug("LOB not found {0}".format(p.get_lob_path("package")))
 
+    names = [ver.package_name(debug=True) for ver in vers]
+    con = None
+    try:
+        con = init_kernel_debuginfo_index()
+    except Exception as ex:
+        log_warn("Unable to open kernel debuginfo index: %s" % ex)
+
+    try:
+        if con is not None:
+            query = con.cursor()
+            for name in names:
+                query.execute("SELECT path FROM kerneldebuginfo WHERE name = ?", (name,))
+                row = query.fetchone()
+                if row is None:
+                    continue
+
+                if os.path.isfile(row[0]):
+                    log_debug("Kernel debuginfo index: %s" % row[0])
+                    return row[0]
+
+                query.execute("DELETE FROM kerneldebuginfo WHERE name = ?", (name,))
+                con.commit()
+
+            query.execute("""
+              SELECT COUNT(*) FROM kerneldebuginfomiss
+              WHERE name IN (%s) AND checked > ?
+              """ % ", ".join("?" * len(names)),
+              names + [int(time.time()) - 60 * CONFIG["KernelDebuginfoMissTTL"]])
+            if query.fetchone()[0] == len(names):
+                log_debug("Kernel debuginfo for %s was not found recently, not searching" % kernelver)
+                return None
+
+        result = _search_kernel_debuginfo(vers)
+
+        if con is not None:
+            if result is not None:
+                name = os.path.basename(result)
+                query.execute("INSERT OR REPLACE INTO kerneldebuginfo (name, path) VALUES (?, ?)",
+                              (name, result))
+                query.execute("DELETE FROM kerneldebuginfomiss WHERE name = ?", (name,))
+            else:
+                now = int(time.time())
+                query.executemany("""
+                  INSERT OR REPLACE INTO kerneldebuginfomiss (name, checked) VALUES (?, ?)
+                  """, [(name, now) for name in names])
+            con.commit()
+
+        return result
+    finally:
+        if con is not None:
+            con.close()
+
+def _search_kernel_debuginfo(vers):
     # search for the debuginfo RPM
     ver = None
     for release in os.listdir(CONFIG["RepoDir"]):
@@ -614,6 +1238,69 @@ def find_kernel_debuginfo(kernelver):
 
     return None
 
+def init_kernel_debuginfo_index():
+    path = os.path.join(CONFIG["RepoDir"], KERNEL_DEBUGINFO_INDEX_FILE)
+    # written by both retrace-server-reposync and the workers
+    oldmask = os.umask(0002)
+    try:
+        con = sqlite3.connect(path, timeout=TASK_CATALOG_TIMEOUT)
+    finally:
+        os.umask(oldmask)
+
+    # paths are passed to shell commands, not unicode
+    con.text_factory = str
+    query = con.cursor()
+    query.execute("""
+      CREATE TABLE IF NOT EXISTS
+      kerneldebuginfo(name PRIMARY KEY, path NOT NULL)
+    """)
+    query.execute("""
+      CREATE TABLE IF NOT EXISTS
+      kerneldebuginfomiss(name PRIMARY KEY, checked NOT NULL)
+    """)
+    con.commit()
+
+    return con
+
+def update_kernel_debuginfo_index(releaseid, con=None):
+    """Adds kernel debuginfo packages of releaseid's local repository
+    into the index and drops the ones that disappeared from it.
+    Returns the number of packages found."""
+    close = False
+    if con is None:
+        con = init_kernel_debuginfo_index()
+        close = True
+
+    releasedir = os.path.join(CONFIG["RepoDir"], releaseid)
+    found = {}
+    for dirname in [os.path.join(releasedir, "Packages"), releasedir]:
+        try:
+            filenames = os.listdir(dirname)
+        except OSError:
+            continue
+
+        for filename in filenames:
+            if KERNEL_DEBUGINFO_PARSER.match(filename) and not filename in found:
+                found[filename] = os.path.join(dirname, filename)
+
+    query = con.cursor()
+    query.execute("SELECT name, path FROM kerneldebuginfo WHERE path LIKE ?",
+                  ("%s/%%" % releasedir,))
+    for name, path in query.fetchall():
+        if found.get(name) != path and not os.path.isfile(path):
+            query.execute("DELETE FROM kerneldebuginfo WHERE name = ?", (name,))
+
+    query.executemany("INSERT OR REPLACE INTO kerneldebuginfo (name, path) VALUES (?, ?)",
+                      found.items())
+    query.executemany("DELETE FROM kerneldebuginfomiss WHERE name = ?",
+                      [(name,) for name in found])
+    con.commit()
+
+    if close:
+        con.close()
+
+    return len(found)
+
 def cache_files_from_debuginfo(debuginfo, basedir, files):
     # important! if empty list is specified, the whole debuginfo would be unpacked
     if not files:
@@ -627,193 +1314,889 @@ def cache_files_from_debuginfo(debuginfo, basedir, files):
         if files[i][0] == "/":
             files[i] = ".%s" % files[i]
 
-    with open(os.devnull, "w") as null:
-        rpm2cpio = Popen(["rpm2cpio", debuginfo], stdout=PIPE, stderr=null)
-        cpio = Popen(["cpio", "-id"] + files, stdin=rpm2cpio.stdout, stdout=null, stderr=null, cwd=basedir)
-        rpm2cpio.wait()
-        cpio.wait()
-        rpm2cpio.stdout.close()
+    # readers of basedir must never see a partially written file
+    tmpdir = tempfile.mkdtemp(prefix=".extract-", dir=basedir)
+    try:
+        with open(os.devnull, "w") as null:
+            rpm2cpio = Popen(["rpm2cpio", debuginfo], stdout=PIPE, stderr=null)
+            cpio = Popen(["cpio", "-id"] + files, stdin=rpm2cpio.stdout, stdout=null, stderr=null, cwd=tmpdir)
+            rpm2cpio.wait()
+            cpio.wait()
+            rpm2cpio.stdout.close()
+
+        publish_extracted_files(tmpdir, basedir)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def publish_extracted_files(tmpdir, basedir):
+    """Moves files unpacked into tmpdir to the same place under basedir.
+    tmpdir must be on the same filesystem, every file appears at once
+    by rename(). Files that already exist are kept."""
+    for root, dirs, files in os.walk(tmpdir):
+        targetdir = os.path.normpath(os.path.join(basedir, os.path.relpath(root, tmpdir)))
+        # symlinks to directories are not walked into, move them too
+        for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            target = os.path.join(targetdir, name)
+            if os.path.lexists(target):
+                continue
 
+            try:
+                os.makedirs(targetdir)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
 
-def get_vmcore_dump_level(task, vmlinux=None):
-    vmcore_path = os.path.join(task.get_savedir(), "crash", "vmcore")
-    if not os.path.isfile(vmcore_path):
-        return None
+            os.rename(os.path.join(root, name), target)
 
-    dmesg_path = os.path.join(task.get_savedir(), RetraceTask.MISC_DIR, "dmesg")
-    if os.path.isfile(dmesg_path):
-        os.unlink(dmesg_path)
+class KernelCacheLock(object):
+    """Exclusive lock of the cached debuginfo of a single kernel.
+    Tasks processing vmcores of the same kernel wait for each other
+    instead of unpacking the same files at once. The lock is released
+    by the kernel if the holder dies."""
+    def __init__(self, debugdir_base, kernel_path):
+        self.path = os.path.join(debugdir_base, KERNEL_MANIFEST_DIR, "%s.lock" % kernel_path)
+        self.fd = None
 
-    with open(os.devnull, "w") as null:
-        cmd = ["makedumpfile", "-D", "--dump-dmesg", vmcore_path, dmesg_path]
-        if vmlinux is not None:
-            cmd.append("-x")
-            cmd.append(vmlinux)
+    def acquire(self):
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
 
-        result = None
-        child = Popen(cmd, stdout=PIPE, stderr=null)
-        line = child.stdout.readline()
-        while line:
-            match = DUMP_LEVEL_PARSER.match(line)
-            line = child.stdout.readline()
-            if match is None:
-                continue
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0660)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as ex:
+            if ex.errno not in [errno.EAGAIN, errno.EACCES]:
+                os.close(self.fd)
+                self.fd = None
+                raise
+
+            log_info("Waiting for another task to finish unpacking debuginfo (%s)" % self.path)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+def list_kernel_debuginfo(debuginfo, kernelver):
+    """Lists files of kernel debuginfo package that prepare_debuginfo
+    may need. Returns the path of vmlinux and a dictionary
+    { module name: path }."""
+    if "EL" in kernelver.release:
+        if kernelver.flavour is None:
+            pattern = "EL/vmlinux"
+        else:
+            pattern = "EL%s/vmlinux" % kernelver.flavour
+    else:
+        pattern = "/vmlinux"
 
-            result = int(match.group(1))
-            child.terminate()
-            break
+    vmlinux_path = None
+    debugfiles = {}
+    child = Popen(["rpm", "-qpl", debuginfo], stdout=PIPE)
+    lines = child.communicate()[0].splitlines()
+    for line in lines:
+        if line.endswith(pattern):
+            vmlinux_path = line
+            continue
 
-        child.wait()
-        return result
+        match = KO_DEBUG_PARSER.match(line)
+        if not match:
+            continue
 
-def get_files_sizes(directory):
-    result = []
+        # only pick the correct flavour for el4
+        if "EL" in kernelver.release:
+            if kernelver.flavour is None:
+                pattern2 = "EL/"
+            else:
+                pattern2 = "EL%s/" % kernelver.flavour
 
-    for f in os.listdir(directory):
-        fullpath = os.path.join(directory, f)
-        if os.path.isfile(fullpath):
-            result.append((fullpath, os.path.getsize(fullpath)))
-        elif os.path.isdir(fullpath):
-            result += get_files_sizes(fullpath)
+            if not pattern2 in os.path.dirname(line):
+                continue
 
-    return sorted(result, key=lambda (f, s): s, reverse=True)
+        # '-' in file name is transformed to '_' in module name
+        debugfiles[match.group(1).replace("-", "_")] = line
 
-def get_archive_type(path):
-    ms = magic.open(magic.MAGIC_NONE)
-    ms.load()
-    filetype = ms.file(path).lower()
-    log_debug("File type: %s" % filetype)
-
-    if "bzip2 compressed data" in filetype:
-        log_debug("bzip2 detected")
-        return ARCHIVE_BZ2
-    elif "gzip compressed data" in filetype or \
-         "compress'd data" in filetype:
-        log_debug("gzip detected")
-        return ARCHIVE_GZ
-    elif "xz compressed data" in filetype:
-        log_debug("xz detected")
-        return ARCHIVE_XZ
-    elif "7-zip archive data" in filetype:
-        log_debug("7-zip detected")
-        return ARCHIVE_7Z
-    elif "zip archive data" in filetype:
-        log_debug("zip detected")
-        return ARCHIVE_ZIP
-    elif "tar archive" in filetype:
-        log_debug("tar detected")
-        return ARCHIVE_TAR
-    elif "lzop compressed data" in filetype:
-        log_debug("lzop detected")
-        return ARCHIVE_LZOP
-
-    log_debug("unknown file type, unpacking finished")
-    return ARCHIVE_UNKNOWN
+    return vmlinux_path, debugfiles
 
-def rename_with_suffix(frompath, topath):
-    suffix = SUFFIX_MAP[get_archive_type(frompath)]
-    if not topath.endswith(suffix):
-        topath = "%s%s" % (topath, suffix)
+def get_kernel_manifest_path(debugdir_base, kernel_path):
+    return os.path.join(debugdir_base, KERNEL_MANIFEST_DIR, "%s.json" % kernel_path)
 
-    os.rename(frompath, topath)
+def read_kernel_manifest(path):
+    """Returns the manifest written by write_kernel_manifest
+    or None if there is no usable one."""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except IOError as ex:
+        if ex.errno != errno.ENOENT:
+            log_warn("Unable to read kernel manifest %s: %s" % (path, ex))
+    except ValueError as ex:
+        log_warn("Corrupted kernel manifest %s: %s" % (path, ex))
 
-    return topath
+    return None
 
-def unpack_vmcore(path):
-    parentdir = os.path.dirname(path)
-    archivebase = os.path.join(parentdir, "archive")
-    archive = rename_with_suffix(path, archivebase)
-    filetype = get_archive_type(archive)
-    while filetype != ARCHIVE_UNKNOWN:
-        files = set(f for (f, s) in get_files_sizes(parentdir))
-        if filetype == ARCHIVE_GZ:
-            check_run(["gunzip", archive])
-        elif filetype == ARCHIVE_BZ2:
-            check_run(["bunzip2", archive])
-        elif filetype == ARCHIVE_XZ:
-            check_run(["unxz", archive])
-        elif filetype == ARCHIVE_ZIP:
-            check_run(["unzip", archive, "-d", parentdir])
-        elif filetype == ARCHIVE_7Z:
-            check_run(["7za", "e", "-o%s" % parentdir, archive])
-        elif filetype == ARCHIVE_TAR:
-            check_run(["tar", "-C", parentdir, "-xf", archive])
-        elif filetype == ARCHIVE_LZOP:
-            check_run(["lzop", "-d", archive])
-        else:
-            raise Exception, "Unknown archive type"
-
-        if os.path.isfile(archive):
-            os.unlink(archive)
-
-        files_sizes = get_files_sizes(parentdir)
-        newfiles = [f for (f, s) in files_sizes]
-        diff = set(newfiles) - files
-        vmcore_candidate = 0
-        while vmcore_candidate < len(newfiles) and \
-              not newfiles[vmcore_candidate] in diff:
-            vmcore_candidate += 1
-
-        if len(diff) > 1:
-            archive = rename_with_suffix(newfiles[vmcore_candidate], archivebase)
-            for filename in newfiles:
-                if not filename in diff or \
-                   filename == newfiles[vmcore_candidate]:
-                    continue
+def write_kernel_manifest(path, manifest):
+    """Manifest is a dictionary:
+    debuginfo: path to the kernel debuginfo package
+    vmlinux: path of vmlinux inside the package
+    modules: { module name: { path: path inside the package,
+                              cached: whether it is already unpacked } }
+    tasks: number of tasks that used the kernel
+    complete: whether the whole package is unpacked
+    extracting: when the background extraction started"""
+    dirname = os.path.dirname(path)
+    try:
+        os.makedirs(dirname)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
 
-                os.unlink(filename)
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix=".%s." % os.path.basename(path))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f)
+        os.rename(tmppath, path)
+    except:
+        os.unlink(tmppath)
+        raise
+
+def get_manifest_debuginfo(manifest, kernelver):
+    """Returns the kernel debuginfo package of manifest,
+    searches for it again if it has been moved."""
+    if manifest["debuginfo"] and os.path.isfile(manifest["debuginfo"]):
+        return manifest["debuginfo"]
+
+    log_info("Searching for kernel-debuginfo package for " + str(kernelver))
+    manifest["debuginfo"] = find_kernel_debuginfo(kernelver)
+    return manifest["debuginfo"]
+
+def extract_kernel_debuginfo(debuginfo, basedir, kernel_path):
+    """Unpacks the whole kernel debuginfo into basedir and marks
+    the manifest complete afterwards, so that tasks for the kernel
+    do not need to touch the package at all. The kernel cache lock
+    is only held while publishing the files."""
+    manifest_path = get_kernel_manifest_path(basedir, kernel_path)
+    tmpdir = tempfile.mkdtemp(prefix=".extract-", dir=basedir)
+    try:
+        with open(os.devnull, "w") as null:
+            rpm2cpio = Popen(["rpm2cpio", debuginfo], stdout=PIPE, stderr=null)
+            cpio = Popen(["cpio", "-id"], stdin=rpm2cpio.stdout, stdout=null, stderr=null, cwd=tmpdir)
+            rpm2cpio.stdout.close()
+            rpm2cpio.wait()
+            cpio.wait()
+
+        with KernelCacheLock(basedir, kernel_path):
+            publish_extracted_files(tmpdir, basedir)
+            manifest = read_kernel_manifest(manifest_path)
+            if manifest is not None:
+                for module in manifest["modules"].values():
+                    if os.path.isfile(os.path.join(basedir, module["path"].lstrip("/"))):
+                        module["cached"] = True
+
+                manifest["complete"] = rpm2cpio.returncode == 0 and cpio.returncode == 0
+                manifest["extracting"] = None
+                write_kernel_manifest(manifest_path, manifest)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def extract_kernel_debuginfo_background(debuginfo, basedir, kernel_path):
+    """Runs extract_kernel_debuginfo in retrace-server-extract-kernel,
+    which detaches itself. The caller may be a web server process,
+    it must not be forked and its descriptors must not be inherited."""
+    try:
+        with open(os.devnull, "r+") as null:
+            retcode = call(["retrace-server-extract-kernel", debuginfo, basedir, kernel_path],
+                           stdin=null, stdout=null, stderr=null, close_fds=True)
+    except OSError as ex:
+        log_warn("Unable to run retrace-server-extract-kernel: %s" % ex)
+        return
 
-        elif len(diff) == 1:
-            archive = rename_with_suffix(diff.pop(), archivebase)
+    if retcode != 0:
+        log_warn("retrace-server-extract-kernel exitted with %d" % retcode)
 
-        # just be explicit here - if no file changed, an archive
-        # has most probably been unpacked to a file with same name
-        else:
-            pass
+def is_debuginfo_package(package):
+    return "-debuginfo" in package
 
-        for filename in os.listdir(parentdir):
-            fullpath = os.path.join(parentdir, filename)
-            if os.path.isdir(fullpath):
-                shutil.rmtree(fullpath)
+def find_repo_package(releaseid, package):
+    """Returns the path of package's RPM in the local repository
+    of releaseid or None if it is not there."""
+    # yum prints epoch in front of the name
+    match = EPOCH_PARSER.match(package)
+    if match:
+        package = package[len(match.group(1)):]
 
-        filetype = get_archive_type(archive)
+    rpmpath = os.path.join(CONFIG["RepoDir"], releaseid, "Packages", "%s.rpm" % package)
+    if not os.path.isfile(rpmpath):
+        return None
 
-    os.rename(archive, os.path.join(parentdir, "vmcore"))
+    return rpmpath
 
+def _get_debuginfo_store_dir(name):
+    path = os.path.join(CONFIG["DebuginfoStoreDir"], name)
+    if not os.path.isdir(path):
+        oldmask = os.umask(0002)
+        try:
+            os.makedirs(path)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        finally:
+            os.umask(oldmask)
 
-def unpack_coredump(path):
-    processed = set()
-    parentdir = os.path.dirname(path)
-    files = set(f for (f, s) in get_files_sizes(parentdir))
-    # Keep unpacking
-    while len(files - processed) > 0:
-        archive = list(files - processed)[0]
-        filetype = get_archive_type(archive)
-        if filetype == ARCHIVE_GZ:
-            check_run(["gunzip", archive])
-        elif filetype == ARCHIVE_BZ2:
-            check_run(["bunzip2", archive])
-        elif filetype == ARCHIVE_XZ:
-            check_run(["unxz", archive])
-        elif filetype == ARCHIVE_ZIP:
-            check_run(["unzip", archive, "-d", parentdir])
-        elif filetype == ARCHIVE_7Z:
-            check_run(["7za", "e", "-o%s" % parentdir, archive])
-        elif filetype == ARCHIVE_TAR:
-            check_run(["tar", "-C", parentdir, "-xf", archive])
-        elif filetype == ARCHIVE_LZOP:
-            check_run(["lzop", "-d", archive])
+    return path
 
-        if os.path.isfile(archive) and filetype != ARCHIVE_UNKNOWN:
-            os.unlink(archive)
-        processed.add(archive)
+def get_debuginfo_store_tree():
+    """Returns the directory mounted into chroots, it only contains
+    .build-id/xx/yyyy.debug files like /usr/lib/debug does"""
+    return _get_debuginfo_store_dir("tree")
 
-        files = set(f for (f, s) in get_files_sizes(parentdir))
+class DebuginfoStoreLock(object):
+    """Lock of the debuginfo store. Tasks adding packages share it,
+    eviction holds it exclusively, so that it never removes a file
+    that has just been listed in a new manifest."""
+    def __init__(self, exclusive=False):
+        self.path = os.path.join(CONFIG["DebuginfoStoreDir"], DEBUGINFO_STORE_LOCK)
+        self.exclusive = exclusive
+        self.fd = None
 
-    # If coredump is not present, the biggest file becomes it
-    if "coredump" not in os.listdir(parentdir):
-        os.rename(get_files_sizes(parentdir)[0][0],
-                  os.path.join(parentdir, "coredump"))
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0660)
+        try:
+            if self.exclusive:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            else:
+                fcntl.flock(self.fd, fcntl.LOCK_SH)
+        except:
+            os.close(self.fd)
+            self.fd = None
+            raise
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        os.close(self.fd)
+        self.fd = None
+
+def _read_debuginfo_manifest(path):
+    result = []
+    with open(path, "r") as f:
+        for line in f:
+            size, entry = line.rstrip("\n").split(" ", 1)
+            result.append((int(size), entry))
+
+    return result
+
+def store_debuginfo(package, rpmpath):
+    """Makes the debug files of the package available in the store,
+    extracting the RPM only if it has not been done before.
+    Returns True if the package was in the store already."""
+    manifestdir = _get_debuginfo_store_dir("manifests")
+    manifest = os.path.join(manifestdir, package)
+    with DebuginfoStoreLock():
+        if os.path.isfile(manifest):
+            # mtime is the last use for eviction
+            try:
+                os.utime(manifest, None)
+            except OSError:
+                pass
+
+            return True
+
+    treedir = get_debuginfo_store_tree()
+    workdir = tempfile.mkdtemp(dir=_get_debuginfo_store_dir("tmp"))
+    try:
+        with open(os.devnull, "w") as null:
+            rpm2cpio = Popen(["rpm2cpio", rpmpath], stdout=PIPE, stderr=null)
+            cpio = Popen(["cpio", "-id", "--quiet", "./usr/lib/debug/*"],
+                         stdin=rpm2cpio.stdout, stdout=null, stderr=null, cwd=workdir)
+            rpm2cpio.stdout.close()
+            cpio.wait()
+            rpm2cpio.wait()
+
+        # a partially extracted package is never recorded
+        if rpm2cpio.returncode != 0:
+            raise Exception("rpm2cpio exitted with %d" % rpm2cpio.returncode)
+
+        if cpio.returncode != 0:
+            raise Exception("cpio exitted with %d" % cpio.returncode)
+
+        # eviction must not remove the files before the manifest lists them
+        with DebuginfoStoreLock():
+            # .build-id/xx/yyyy.debug are symlinks to the debug files,
+            # the store keeps the files themselves under those names
+            entries = []
+            moved = {}
+            builddir = os.path.join(workdir, "usr", "lib", "debug", ".build-id")
+            if os.path.isdir(builddir):
+                for prefix in os.listdir(builddir):
+                    for name in os.listdir(os.path.join(builddir, prefix)):
+                        if not name.endswith(".debug"):
+                            continue
+
+                        original = os.path.realpath(os.path.join(builddir, prefix, name))
+                        if not original.startswith(workdir + os.sep):
+                            continue
+
+                        source = moved.get(original, original)
+                        if not os.path.isfile(source):
+                            continue
+
+                        entry = os.path.join(".build-id", prefix, name)
+                        target = os.path.join(treedir, entry)
+                        size = os.path.getsize(source)
+                        if not os.path.exists(target):
+                            if not os.path.isdir(os.path.dirname(target)):
+                                try:
+                                    os.makedirs(os.path.dirname(target))
+                                except OSError as ex:
+                                    if ex.errno != errno.EEXIST:
+                                        raise
+
+                            if original in moved:
+                                # the same file under more build-ids
+                                try:
+                                    os.link(source, target)
+                                except OSError as ex:
+                                    if ex.errno != errno.EEXIST:
+                                        raise
+                            else:
+                                os.rename(source, target)
+                                moved[original] = target
+
+                        entries.append((size, entry))
+
+            fd, tmpname = tempfile.mkstemp(prefix=".tmp", dir=manifestdir)
+            with os.fdopen(fd, "w") as f:
+                for size, entry in entries:
+                    f.write("%d %s\n" % (size, entry))
+            os.chmod(tmpname, 0664)
+            os.rename(tmpname, manifest)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return False
+
+def evict_debuginfo_store(maxsize=None):
+    """Removes least recently used packages from the debuginfo store
+    until it fits into maxsize bytes (DebuginfoStoreSize by default).
+    Files shared with other packages are kept. Returns freed bytes."""
+    if maxsize is None:
+        maxsize = CONFIG["DebuginfoStoreSize"] << 20
+
+    manifestdir = _get_debuginfo_store_dir("manifests")
+    treedir = get_debuginfo_store_tree()
+    now = time.time()
+
+    with DebuginfoStoreLock(exclusive=True):
+        freed = _evict_debuginfo_manifests(manifestdir, treedir, maxsize, now)
+
+    tmpdir = _get_debuginfo_store_dir("tmp")
+    for name in os.listdir(tmpdir):
+        path = os.path.join(tmpdir, name)
+        if now - os.path.getmtime(path) > DEBUGINFO_STORE_GRACE:
+            shutil.rmtree(path, ignore_errors=True)
+
+    return freed
+
+def _evict_debuginfo_manifests(manifestdir, treedir, maxsize, now):
+    manifests = []
+    refs = {}
+    sizes = {}
+    for name in os.listdir(manifestdir):
+        path = os.path.join(manifestdir, name)
+        if name.startswith(".tmp"):
+            # leftover of a killed worker
+            if now - os.path.getmtime(path) > DEBUGINFO_STORE_GRACE:
+                os.unlink(path)
+            continue
+
+        try:
+            mtime = os.path.getmtime(path)
+            entries = _read_debuginfo_manifest(path)
+        except (IOError, OSError, ValueError) as ex:
+            log_warn("Unable to read debuginfo manifest '%s': %s" % (name, ex))
+            continue
+
+        manifests.append((mtime, path, entries))
+        for size, entry in entries:
+            refs[entry] = refs.get(entry, 0) + 1
+            sizes[entry] = size
+
+    total = sum(sizes.values())
+    freed = 0
+    for mtime, path, entries in sorted(manifests):
+        if total <= maxsize or now - mtime < DEBUGINFO_STORE_GRACE:
+            break
+
+        # drop the manifest first so that nobody considers the package stored
+        os.unlink(path)
+        for size, entry in entries:
+            refs[entry] -= 1
+            if refs[entry] > 0:
+                continue
+
+            try:
+                os.unlink(os.path.join(treedir, entry))
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+
+            total -= size
+            freed += size
+
+    return freed
+
+def get_vmcore_dump_level(task, vmlinux=None):
+    vmcore_path = os.path.join(task.get_savedir(), "crash", "vmcore")
+    if not os.path.isfile(vmcore_path):
+        return None
+
+    dmesg_path = os.path.join(task.get_savedir(), RetraceTask.MISC_DIR, "dmesg")
+    if os.path.isfile(dmesg_path):
+        os.unlink(dmesg_path)
+
+    with open(os.devnull, "w") as null:
+        cmd = ["makedumpfile", "-D", "--dump-dmesg", vmcore_path, dmesg_path]
+        if vmlinux is not None:
+            cmd.append("-x")
+            cmd.append(vmlinux)
+
+        result = None
+        child = Popen(cmd, stdout=PIPE, stderr=null)
+        line = child.stdout.readline()
+        while line:
+            match = DUMP_LEVEL_PARSER.match(line)
+            line = child.stdout.readline()
+            if match is None:
+                continue
+
+            result = int(match.group(1))
+            child.terminate()
+            break
+
+        child.wait()
+        return result
+
+def get_files_sizes(directory):
+    result = []
+
+    for f in os.listdir(directory):
+        fullpath = os.path.join(directory, f)
+        if os.path.isfile(fullpath):
+            result.append((fullpath, os.path.getsize(fullpath)))
+        elif os.path.isdir(fullpath):
+            result += get_files_sizes(fullpath)
+
+    return sorted(result, key=lambda (f, s): s, reverse=True)
+
+def sniff_archive_type(header):
+    """Detects the archive type from the first ARCHIVE_HEADER_SIZE bytes"""
+    for offset, signature, filetype in ARCHIVE_SIGNATURES:
+        if header[offset:offset + len(signature)] == signature:
+            return filetype
+
+    return ARCHIVE_UNKNOWN
+
+def get_archive_type(path):
+    with open(path, "rb") as f:
+        filetype = sniff_archive_type(f.read(ARCHIVE_HEADER_SIZE))
+
+    if filetype == ARCHIVE_UNKNOWN:
+        log_debug("unknown file type, unpacking finished")
+    else:
+        log_debug("%s detected" % SUFFIX_MAP[filetype][1:])
+
+    return filetype
+
+def get_decompressor(filetype):
+    """Returns the command decompressing filetype from stdin to stdout,
+    the parallel implementation if it is installed."""
+    if not filetype in _decompressors:
+        _decompressors[filetype] = None
+        for cmd in STREAM_DECOMPRESSORS[filetype]:
+            if find_executable(cmd[0]):
+                _decompressors[filetype] = cmd
+                break
+
+    if _decompressors[filetype] is None:
+        raise Exception, "No decompressor for %s found" % SUFFIX_MAP[filetype]
+
+    return _decompressors[filetype]
+
+class _PeekStream(object):
+    """Allows to look at the beginning of a stream before reading it"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.buffer = ""
+
+    def peek(self, size):
+        while len(self.buffer) < size:
+            data = self.fileobj.read(size - len(self.buffer))
+            if not data:
+                break
+
+            self.buffer += data
+
+        return self.buffer[:size]
+
+    def read(self, size):
+        if self.buffer:
+            data = self.buffer[:size]
+            self.buffer = self.buffer[size:]
+            return data
+
+        return self.fileobj.read(size)
+
+class _ProgressStream(object):
+    """Reports how much of the file has been read, at most once a second"""
+    def __init__(self, fileobj, total, progress):
+        self.fileobj = fileobj
+        self.total = total
+        self.current = 0
+        self.progress = progress
+        self.reported = 0
+
+    def read(self, size):
+        data = self.fileobj.read(size)
+        self.current += len(data)
+        if self.progress is not None and time.time() - self.reported >= 1:
+            self.progress(self.current, self.total)
+            self.reported = time.time()
+
+        return data
+
+class _DecompressorStream(object):
+    """Output of an external decompressor. The input is fed
+    from another stream by a thread."""
+    def __init__(self, cmd, source):
+        self.cmd = cmd
+        self.stderr = tempfile.TemporaryFile()
+        self.child = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=self.stderr, close_fds=True)
+        self.error = None
+        self.thread = threading.Thread(target=self._feed, args=(source,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _feed(self, source):
+        try:
+            while True:
+                data = source.read(UNPACK_CHUNK_SIZE)
+                if not data:
+                    break
+
+                self.child.stdin.write(data)
+        except Exception as ex:
+            self.error = ex
+        finally:
+            try:
+                self.child.stdin.close()
+            except IOError:
+                pass
+
+    def read(self, size):
+        return self.child.stdout.read(size)
+
+    def kill(self):
+        try:
+            self.child.kill()
+        except OSError:
+            pass
+
+        self.child.stdout.close()
+        self.thread.join()
+        self.child.wait()
+        self.stderr.close()
+
+    def close(self):
+        # tar does not read the padding behind its end of archive
+        while self.child.stdout.read(UNPACK_CHUNK_SIZE):
+            pass
+
+        self.child.stdout.close()
+        self.thread.join()
+        self.child.wait()
+        if self.child.returncode != 0:
+            self.stderr.seek(0)
+            raise Exception, "%s exitted with %d: %s" % (self.cmd[0], self.child.returncode,
+                                                         self.stderr.read(1 << 12))
+        self.stderr.close()
+
+        if self.error is not None:
+            raise self.error
+
+class StreamUnpacker(object):
+    """Unpacks nested archives in a single pass. Compressed layers
+    are piped through decompressors and tar archives are read
+    as a stream, only the innermost files are written into targetdir.
+    Zip and 7-zip need random access, they are written to disk and
+    unpacked by unzip or 7za. Archive types are detected from the
+    first bytes of every layer. progress(current, total) is called
+    with the number of bytes of the archive read so far. With toplevel
+    set, files in subdirectories of tar and zip archives are skipped,
+    otherwise they are written under their base names."""
+    def __init__(self, targetdir, progress=None, toplevel=False):
+        self.targetdir = targetdir
+        self.progress = progress
+        self.toplevel = toplevel
+        self.files = []
+
+    def unpack(self, path):
+        """Unpacks path into targetdir, returns the list of files written"""
+        with open(path, "rb") as f:
+            stream = _ProgressStream(f, os.path.getsize(path), self.progress)
+            self.unpack_stream(stream, os.path.basename(path))
+
+        if self.progress is not None:
+            self.progress(stream.current, stream.total)
+
+        return self.files
+
+    def unpack_stream(self, stream, name):
+        """Unpacks a file-like object named name into targetdir,
+        returns the list of files written"""
+        try:
+            self._unpack_stream(stream, name)
+        except:
+            # do not leave partially unpacked files behind
+            for filename in self.files:
+                if os.path.isfile(filename):
+                    os.unlink(filename)
+            raise
+
+        return self.files
+
+    def _unpack_stream(self, stream, name):
+        stream = _PeekStream(stream)
+        filetype = sniff_archive_type(stream.peek(ARCHIVE_HEADER_SIZE))
+        suffix = SUFFIX_MAP[filetype]
+        if suffix and name.endswith(suffix) and len(name) > len(suffix):
+            name = name[:-len(suffix)]
+
+        if filetype in STREAM_DECOMPRESSORS:
+            decompressor = _DecompressorStream(get_decompressor(filetype), stream)
+            try:
+                self._unpack_stream(decompressor, name)
+            except:
+                decompressor.kill()
+                raise
+
+            decompressor.close()
+        elif filetype == ARCHIVE_TAR:
+            tar = tarfile.open(fileobj=stream, mode="r|")
+            for member in tar:
+                # directories are not kept
+                if not member.isfile():
+                    continue
+
+                membername = os.path.normpath(member.name)
+                if self.toplevel and os.sep in membername:
+                    log_debug("Skipping '%s' from a subdirectory" % member.name)
+                    continue
+
+                self._unpack_stream(tar.extractfile(member), os.path.basename(membername))
+            tar.close()
+        elif filetype in [ARCHIVE_ZIP, ARCHIVE_7Z]:
+            archive = self._write(stream, "%s%s" % (name, suffix))
+            self.files.remove(archive)
+            tmpdir = tempfile.mkdtemp(prefix=".unpack-", dir=self.targetdir)
+            try:
+                try:
+                    if filetype == ARCHIVE_ZIP:
+                        check_run(["unzip", archive, "-d", tmpdir])
+                    else:
+                        check_run(["7za", "e", "-o%s" % tmpdir, archive])
+                finally:
+                    os.unlink(archive)
+
+                for path, size in get_files_sizes(tmpdir):
+                    if self.toplevel and os.path.dirname(path) != tmpdir:
+                        continue
+
+                    with open(path, "rb") as f:
+                        self._unpack_stream(f, os.path.basename(path))
+                    os.unlink(path)
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        else:
+            self._write(stream, name)
+
+    def _write(self, stream, name):
+        path = os.path.join(self.targetdir, name)
+        i = 0
+        while os.path.lexists(path):
+            i += 1
+            path = os.path.join(self.targetdir, "%s.%d" % (name, i))
+
+        self.files.append(path)
+        with open(path, "wb") as f:
+            while True:
+                data = stream.read(UNPACK_CHUNK_SIZE)
+                if not data:
+                    break
+
+                f.write(data)
+
+        return path
+
+class DownloadIngest(object):
+    """Receives a file in order as it is being downloaded. Computes
+    the checksums of the data and, if unpackdir is given and the file
+    is an archive, unpacks it by StreamUnpacker in another thread,
+    so that the download is not read again from disk."""
+    def __init__(self, name, checksums=[], unpackdir=None):
+        self.name = name
+        self.hashes = dict((checksum, hashlib.new(checksum)) for checksum in checksums)
+        self.unpackdir = unpackdir
+        self.header = ""
+        self.queue = None
+        self.thread = None
+        self.files = None
+        self.error = None
+        self.pending = ""
+        self.pos = 0
+
+    def _start(self):
+        if sniff_archive_type(self.header) == ARCHIVE_UNKNOWN:
+            # nothing to unpack, the file is used as it is
+            self.unpackdir = None
+            return
+
+        self.queue = Queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self._unpack)
+        self.thread.daemon = True
+        self.thread.start()
+        self._put(self.header)
+
+    def _unpack(self):
+        try:
+            self.files = StreamUnpacker(self.unpackdir).unpack_stream(self, self.name)
+        except Exception as ex:
+            self.error = ex
+        finally:
+            # the producer must never block on a full queue
+            while self.queue.get() is not None:
+                pass
+
+    def _put(self, data):
+        for i in xrange(0, len(data), UNPACK_CHUNK_SIZE):
+            self.queue.put(data[i:i + UNPACK_CHUNK_SIZE])
+
+    def read(self, size):
+        """Used by StreamUnpacker"""
+        while self.pos >= len(self.pending):
+            data = self.queue.get()
+            if data is None:
+                # the unpacking thread drains the queue
+                self.queue.put(None)
+                return ""
+
+            self.pending = data
+            self.pos = 0
+
+        data = self.pending[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def feed(self, data):
+        for checksum in self.hashes.values():
+            checksum.update(data)
+
+        if self.unpackdir is None:
+            return
+
+        if self.queue is None:
+            self.header += data
+            if len(self.header) >= ARCHIVE_HEADER_SIZE:
+                self._start()
+            return
+
+        self._put(data)
+
+    def feed_file(self, path):
+        """Reads a file that has been downloaded by other means"""
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(UNPACK_CHUNK_SIZE)
+                if not data:
+                    break
+
+                self.feed(data)
+
+    def finish(self):
+        """Waits for the unpacking to finish. Returns the list of files
+        unpacked or None if the file was not unpacked."""
+        if self.unpackdir is not None and self.queue is None:
+            self._start()
+
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+        if self.error is not None:
+            raise self.error
+
+        return self.files
+
+    def abort(self):
+        """The download failed, the unpacking of truncated data fails too"""
+        try:
+            self.finish()
+        except Exception:
+            pass
+
+    def hexdigest(self, checksum):
+        return self.hashes[checksum].hexdigest()
+
+def unpack_vmcore(path, progress=None):
+    parentdir = os.path.dirname(path)
+    vmcore = os.path.join(parentdir, "vmcore")
+    if get_archive_type(path) == ARCHIVE_UNKNOWN:
+        if path != vmcore:
+            os.rename(path, vmcore)
+        return
+
+    files = StreamUnpacker(parentdir, progress).unpack(path)
+    os.unlink(path)
+    select_vmcore(files)
+
+def select_vmcore(files):
+    """Renames the largest of unpacked files to vmcore
+    and removes the others"""
+    if not files:
+        raise Exception, "No files found in the archive"
+
+    vmcore = os.path.join(os.path.dirname(files[0]), "vmcore")
+    # the largest file is the vmcore
+    files_sizes = sorted(((os.path.getsize(f), f) for f in files), reverse=True)
+    os.rename(files_sizes[0][1], vmcore)
+    for size, filename in files_sizes[1:]:
+        os.unlink(filename)
+
+def unpack_coredump(path, progress=None):
+    parentdir = os.path.dirname(path)
+    for archive, size in get_files_sizes(parentdir):
+        if get_archive_type(archive) == ARCHIVE_UNKNOWN:
+            continue
+
+        # the coredump is looked for at the top level only
+        StreamUnpacker(parentdir, progress, toplevel=True).unpack(archive)
+        os.unlink(archive)
+
+    # If coredump is not present, the biggest file becomes it
+    if "coredump" not in os.listdir(parentdir):
+        os.rename(get_files_sizes(parentdir)[0][0],
+                  os.path.join(parentdir, "coredump"))
 
     for filename in os.listdir(parentdir):
         fullpath = os.path.join(parentdir, filename)
@@ -821,8 +2204,145 @@ def unpack_coredump(path):
             shutil.rmtree(fullpath)
 
 
-def get_task_est_time(taskdir):
-    return 180
+def _estimate_keys(tasktype, package=None, release=None, arch=None):
+    """Returns estimates table keys from the most specific to the most
+    general one. Tasks of other types fall back to plain retrace or vmcore."""
+    result = []
+    types = [tasktype]
+    if tasktype in [TASK_VMCORE, TASK_VMCORE_INTERACTIVE]:
+        basetype = TASK_VMCORE
+    else:
+        basetype = TASK_RETRACE
+
+    if basetype != tasktype:
+        types.append(basetype)
+
+    for t in types:
+        keys = ["%d" % t]
+        if package:
+            keys.append("%d:%s" % (t, package))
+            if release:
+                keys.append("%d:%s:%s" % (t, package, release))
+                if arch:
+                    keys.append("%d:%s:%s:%s" % (t, package, release, arch))
+
+        keys.reverse()
+        result.extend(keys)
+
+    return result
+
+def _get_release_tag(version):
+    if not version:
+        return None
+
+    match = RELEASE_TAG_PARSER.search(version)
+    if not match:
+        return None
+
+    return match.group(1)
+
+def _add_task_estimate(query, stats):
+    """Adds a successfully finished task into the sums the estimates
+    are computed from. Uses coresize in MB and duration in seconds."""
+    if stats.get("coresize") is None or stats.get("duration") is None:
+        return
+
+    tasktype = stats.get("type")
+    if tasktype is None:
+        tasktype = TASK_RETRACE
+
+    size = stats["coresize"] / 1048576.0
+    duration = float(stats["duration"])
+    for key in _estimate_keys(tasktype, stats["package"],
+                              _get_release_tag(stats["version"]), stats["arch"]):
+        query.execute("""
+          INSERT OR IGNORE INTO estimates
+          (key, samples, sumsize, sumduration, sumsize2, sumsizeduration)
+          VALUES (?, 0, 0, 0, 0, 0)
+          """, (key,))
+        query.execute("""
+          UPDATE estimates SET samples = samples + 1, sumsize = sumsize + ?,
+          sumduration = sumduration + ?, sumsize2 = sumsize2 + ?,
+          sumsizeduration = sumsizeduration + ? WHERE key = ?
+          """, (size, duration, size * size, size * duration, key))
+
+def estimate_task_time(tasktype, package=None, release=None, arch=None,
+                       coresize=None, con=None):
+    """Estimates run time of a task (seconds) by the least squares fit of
+    duration against core size over the most specific group of finished
+    tasks (type, package, release, arch) with enough samples."""
+    if con is None:
+        con = get_crashstats_db()
+
+    row = None
+    query = con.cursor()
+    for key in _estimate_keys(tasktype, package, release, arch):
+        query.execute("""
+          SELECT samples, sumsize, sumduration, sumsize2, sumsizeduration
+          FROM estimates WHERE key = ?
+          """, (key,))
+        row = query.fetchone()
+        if row and row[0] >= ESTIMATE_MIN_SAMPLES:
+            break
+        row = None
+
+    if row is None:
+        if tasktype in [TASK_VMCORE, TASK_VMCORE_INTERACTIVE]:
+            return ESTIMATE_DEFAULT_VMCORE_TIME
+        return ESTIMATE_DEFAULT_TIME
+
+    n, sx, sy, sxx, sxy = row
+    result = sy / n
+    variance = n * sxx - sx * sx
+    if coresize is not None and variance > 0:
+        slope = (n * sxy - sx * sy) / variance
+        # bigger cores never take less time, noise says otherwise
+        if slope > 0:
+            result = (sy - slope * sx) / n + slope * coresize / 1048576.0
+
+    return max(1, int(result))
+
+def get_task_est_time(task):
+    """Estimates the total run time of the task (seconds)
+    from what is known about it before it runs."""
+    tasktype = task.get_type()
+    crashdir = os.path.join(task.get_savedir(), "crash")
+    package = release = arch = None
+    if tasktype in [TASK_VMCORE, TASK_VMCORE_INTERACTIVE]:
+        corepath = os.path.join(crashdir, "vmcore")
+        package = "kernel"
+        if task.has_kernelver():
+            try:
+                kernelver = KernelVer(task.get_kernelver())
+                release = _get_release_tag(kernelver.release)
+                arch = kernelver.arch
+            except Exception:
+                pass
+    else:
+        corepath = os.path.join(crashdir, "coredump")
+        try:
+            with open(os.path.join(crashdir, "package"), "r") as f:
+                pkgdata = parse_rpm_name(f.read(ALLOWED_FILES["package"]).strip())
+            package = pkgdata["name"]
+            release = _get_release_tag(pkgdata["release"])
+            arch = pkgdata["arch"]
+        except (IOError, OSError):
+            pass
+
+    try:
+        coresize = os.path.getsize(corepath)
+    except OSError:
+        coresize = None
+
+    return estimate_task_time(tasktype, package, release, arch, coresize)
+
+def get_task_remaining_time(task):
+    """Estimates how many seconds remain until the task finishes"""
+    result = get_task_est_time(task)
+    if task.has_started_time():
+        result -= int(time.time()) - task.get_started_time()
+
+    return max(0, result)
 
 def unpack(archive, mime, targetdir=None):
     cmd = list(HANDLE_ARCHIVE[mime]["unpack"])
@@ -838,26 +2358,58 @@ def response(start_response, status, body="", extra_headers=[]):
     start_response(status, [("Content-Type", "text/plain"), ("Content-Length", "%d" % len(body))] + extra_headers)
     return [body]
 
-def run_ps():
-    child = Popen(["ps", "-eo", "pid,ppid,etime,cmd"], stdout=PIPE)
-    lines = child.communicate()[0].split("\n")
+def get_worker_taskid(cmdline):
+    """Returns task ID if cmdline is the one of retrace-server-worker,
+    None otherwise"""
+    for i in xrange(len(cmdline) - 1):
+        if cmdline[i].endswith("retrace-server-worker") and cmdline[i + 1].isdigit():
+            return int(cmdline[i + 1])
 
-    return lines
+    return None
+
+def is_worker_daemon_cmdline(cmdline):
+    return any(arg.endswith("retrace-server-workerd") for arg in cmdline[:2])
 
-def get_running_tasks(ps_output=None):
-    if not ps_output:
-        ps_output = run_ps()
+def get_running_tasks(processes=None):
+    """Returns a list of (PID, task ID, seconds running) of task
+    workers, both retrace-server-worker and retrace-server-workerd's"""
+    if processes is None:
+        processes = get_process_table()
 
     result = []
+    for process in processes.values():
+        taskid = get_worker_taskid(process.cmdline)
+        if taskid is not None:
+            result.append((process.pid, taskid, process.elapsed))
+
+    # workers forked by retrace-server-workerd keep the daemon's
+    # command line, they are known by the slots they claimed
+    daemon = get_worker_daemon_pid()
+    for taskid, pid in get_task_slot_owners():
+        process = processes.get(pid)
+        if process is None or pid == daemon or \
+           not is_worker_daemon_cmdline(process.cmdline):
+            continue
 
-    for line in ps_output:
-        match = WORKER_RUNNING_PARSER.match(line)
-        if match:
-            result.append((int(match.group(1)), int(match.group(3)), match.group(2)))
+        result.append((pid, taskid, process.elapsed))
 
     return result
 
-def get_active_tasks():
+_task_workers_cache = TTLCache(PROCESS_TABLE_TTL)
+
+def _index_task_workers():
+    result = {}
+    for pid, taskid, elapsed in get_running_tasks():
+        result.setdefault(taskid, []).append(pid)
+
+    return result
+
+def get_task_workers():
+    """Returns { task ID: [PIDs of its workers] }, the index
+    is rebuilt at most once a second"""
+    return _task_workers_cache.get(None, _index_task_workers)
+
+def scan_active_tasks():
     tasks = []
 
     for filename in os.listdir(CONFIG["SaveDir"]):
@@ -877,6 +2429,486 @@ def get_active_tasks():
 
     return tasks
 
+def get_active_tasks():
+    try:
+        con = get_task_catalog()
+    except sqlite3.Error as ex:
+        log_warn("Unable to open task catalog, scanning %s: %s" % (CONFIG["SaveDir"], ex))
+        return scan_active_tasks()
+
+    query = con.cursor()
+    if CONFIG["AllowTaskManager"]:
+        query.execute("SELECT taskid FROM tasks WHERE haslog = 0 AND managed = 0")
+    else:
+        query.execute("SELECT taskid FROM tasks WHERE haslog = 0")
+
+    tasks = [row[0] for row in query.fetchall()]
+
+    return tasks
+
+def get_managed_tasks():
+    try:
+        con = get_task_catalog()
+    except sqlite3.Error as ex:
+        log_warn("Unable to open task catalog, scanning %s: %s" % (CONFIG["SaveDir"], ex))
+        return [int(f) for f in os.listdir(CONFIG["SaveDir"])
+                if len(f) == CONFIG["TaskIdLength"] and f.isdigit() and
+                os.path.isfile(os.path.join(CONFIG["SaveDir"], f, RetraceTask.MANAGED_FILE))]
+
+    query = con.cursor()
+    query.execute("SELECT taskid FROM tasks WHERE managed = 1")
+    tasks = [row[0] for row in query.fetchall()]
+
+    return tasks
+
+def init_task_catalog():
+    """Opens a new connection to the task catalog. The schema is only
+    created by the first process to find it missing, which also fills
+    the catalog from SaveDir."""
+    path = os.path.join(CONFIG["SaveDir"], CONFIG["TaskCatalogFile"])
+
+    # the catalog is only used by the server, keep it group-writable
+    old_umask = os.umask(0117)
+    try:
+        con = sqlite3.connect(path, timeout=TASK_CATALOG_TIMEOUT)
+    finally:
+        os.umask(old_umask)
+
+    query = con.cursor()
+    query.execute("PRAGMA user_version")
+    if query.fetchone()[0] < TASK_CATALOG_SCHEMA_VERSION:
+        _create_task_catalog_schema(con)
+
+    return con
+
+def _create_task_catalog_schema(con):
+    """A new catalog is filled in the same transaction, so that other
+    processes never see it empty"""
+    # sqlite3 would commit before every CREATE by itself
+    con.isolation_level = None
+    query = con.cursor()
+    try:
+        query.execute("BEGIN IMMEDIATE")
+        query.execute("PRAGMA user_version")
+        if query.fetchone()[0] >= TASK_CATALOG_SCHEMA_VERSION:
+            # created by another process in the meantime
+            query.execute("ROLLBACK")
+            return False
+
+        query.execute("""
+          SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'tasks'
+        """)
+        created = query.fetchone() is None
+        query.execute("""
+          CREATE TABLE IF NOT EXISTS
+          tasks(taskid INTEGER PRIMARY KEY, type, status,
+                managed NOT NULL, haslog NOT NULL, mtime NOT NULL)
+        """)
+        query.execute("""
+          CREATE INDEX IF NOT EXISTS tasks_active ON tasks(haslog, managed)
+        """)
+        if created:
+            _store_task_catalog_rows(query, _scan_task_catalog_rows())
+
+        query.execute("PRAGMA user_version = %d" % TASK_CATALOG_SCHEMA_VERSION)
+        query.execute("COMMIT")
+    except:
+        try:
+            query.execute("ROLLBACK")
+        except sqlite3.OperationalError:
+            # no transaction is active
+            pass
+        raise
+    finally:
+        con.isolation_level = ""
+
+_task_catalog = threading.local()
+
+def get_task_catalog():
+    """Returns a connection to the task catalog that stays open
+    for further calls of the same thread. A forked process opens its own."""
+    pid, con = getattr(_task_catalog, "con", (None, None))
+    if pid != os.getpid():
+        if con is not None:
+            _inherited_dbs.append(con)
+        con = init_task_catalog()
+        _task_catalog.con = (os.getpid(), con)
+
+    return con
+
+def close_task_catalog():
+    """Closes the connection kept by get_task_catalog,
+    see close_crashstats_db"""
+    pid, con = getattr(_task_catalog, "con", (None, None))
+    if con is not None and pid == os.getpid():
+        con.close()
+
+    _task_catalog.con = (None, None)
+
+def _task_catalog_row(task):
+    return (task.get_taskid(), task.get_type(), task.get_status(),
+            int(task.has(RetraceTask.MANAGED_FILE)), int(task.has_log()),
+            int(time.time()))
+
+def update_task_catalog(task, con=None):
+    if con is None:
+        con = get_task_catalog()
+
+    # a failed statement must not leave the kept connection in a transaction
+    with con:
+        con.execute("""
+          INSERT OR REPLACE INTO tasks (taskid, type, status, managed, haslog, mtime)
+          VALUES (?, ?, ?, ?, ?, ?)
+          """, _task_catalog_row(task))
+
+def remove_from_task_catalog(taskid, con=None):
+    if con is None:
+        con = get_task_catalog()
+
+    with con:
+        con.execute("DELETE FROM tasks WHERE taskid = ?", (taskid,))
+
+def rebuild_task_catalog(con=None):
+    """Reconstructs the task catalog from the SaveDir directory tree.
+    Rows are replaced rather than wiped first, so that tasks created
+    while the rebuild is running are not lost."""
+    if con is None:
+        con = get_task_catalog()
+
+    rows = _scan_task_catalog_rows()
+    with con:
+        _store_task_catalog_rows(con.cursor(), rows)
+
+    return len(rows)
+
+def _scan_task_catalog_rows():
+    rows = []
+    for filename in os.listdir(CONFIG["SaveDir"]):
+        if len(filename) != CONFIG["TaskIdLength"]:
+            continue
+
+        try:
+            task = RetraceTask(int(filename))
+            rows.append(_task_catalog_row(task))
+        except:
+            continue
+
+    return rows
+
+def _store_task_catalog_rows(query, rows):
+    query.executemany("""
+      INSERT OR REPLACE INTO tasks (taskid, type, status, managed, haslog, mtime)
+      VALUES (?, ?, ?, ?, ?, ?)
+      """, rows)
+
+    query.execute("SELECT taskid FROM tasks")
+    stale = [(row[0],) for row in query.fetchall()
+             if not os.path.isdir(os.path.join(CONFIG["SaveDir"], "%d" % row[0]))]
+    query.executemany("DELETE FROM tasks WHERE taskid = ?", stale)
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        if ex.errno == errno.ESRCH:
+            return False
+        # EPERM - the process exists, but belongs to someone else
+
+    return True
+
+def _get_task_slot_dir():
+    slotdir = os.path.join(CONFIG["SaveDir"], TASK_SLOT_DIR)
+    if not os.path.isdir(slotdir):
+        oldmask = os.umask(0007)
+        try:
+            os.makedirs(slotdir)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        finally:
+            os.umask(oldmask)
+
+    return slotdir
+
+def _write_task_slot_record(slotdir, taskid, pid, pending=False):
+    fd, tmpname = tempfile.mkstemp(prefix=".tmp", dir=slotdir)
+    with os.fdopen(fd, "w") as f:
+        if pending:
+            f.write("%d %d pending\n" % (taskid, pid))
+        else:
+            f.write("%d %d\n" % (taskid, pid))
+
+    return tmpname
+
+def _read_task_slot_record(path):
+    """Returns (taskid, pid, pending) recorded in the slot file, None if
+    the slot is free or (None, None, False) if the record is corrupted."""
+    try:
+        with open(path, "r") as f:
+            data = f.read(64).split()
+    except (IOError, OSError) as ex:
+        if ex.errno == errno.ENOENT:
+            return None
+        raise
+
+    pending = data[2:] == ["pending"]
+    if pending:
+        data = data[:2]
+
+    try:
+        taskid, pid = data
+        return int(taskid), int(pid), pending
+    except ValueError:
+        return None, None, False
+
+def _read_task_slot(path):
+    """Returns (taskid, pid) recorded in the slot file, None if
+    the slot is free or (None, None) if the record is corrupted."""
+    record = _read_task_slot_record(path)
+    if record is None:
+        return None
+
+    return record[:2]
+
+def _list_task_slots(slotdir):
+    return [os.path.join(slotdir, f) for f in os.listdir(slotdir) if f.isdigit()]
+
+def acquire_task_slot(taskid, pid=None):
+    """Atomically claims one of MaxParallelTasks slots for the task.
+    Returns the slot number or None if the server is fully loaded."""
+    if pid is None:
+        pid = os.getpid()
+
+    slotdir = _get_task_slot_dir()
+    # the record is written in advance and hardlinked into place,
+    # so that a slot is never visible without its owner
+    tmpname = _write_task_slot_record(slotdir, taskid, pid)
+    try:
+        reaped = False
+        while True:
+            for slot in xrange(CONFIG["MaxParallelTasks"]):
+                try:
+                    os.link(tmpname, os.path.join(slotdir, "%d" % slot))
+                except OSError as ex:
+                    if ex.errno == errno.EEXIST:
+                        continue
+                    raise
+
+                return slot
+
+            if reaped or reap_task_slots() == 0:
+                return None
+
+            reaped = True
+    finally:
+        os.unlink(tmpname)
+
+def claim_task_slot(taskid, pid=None, pending=False):
+    """Hands the task's slot over to another process (by default
+    the calling one). Returns False if the task holds no slot.
+    If the slot stays pending for TASK_SLOT_CLAIM_TIMEOUT seconds,
+    reap_task_slots() assumes the worker never started and frees it."""
+    if pid is None:
+        pid = os.getpid()
+
+    slotdir = _get_task_slot_dir()
+    for path in _list_task_slots(slotdir):
+        owner = _read_task_slot(path)
+        if owner is None or owner[0] != taskid:
+            continue
+
+        tmpname = _write_task_slot_record(slotdir, taskid, pid, pending)
+        os.rename(tmpname, path)
+        return True
+
+    return False
+
+def release_task_slot(taskid):
+    """Frees all slots held by the task."""
+    slotdir = os.path.join(CONFIG["SaveDir"], TASK_SLOT_DIR)
+    if not os.path.isdir(slotdir):
+        return
+
+    for path in _list_task_slots(slotdir):
+        owner = _read_task_slot(path)
+        if owner is not None and owner[0] == taskid:
+            try:
+                os.unlink(path)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+
+def reap_task_slots():
+    """Frees slots held by processes that do not exist anymore
+    and pending slots that have not been claimed in time.
+    Returns the number of recovered slots."""
+    slotdir = os.path.join(CONFIG["SaveDir"], TASK_SLOT_DIR)
+    if not os.path.isdir(slotdir):
+        return 0
+
+    result = 0
+    for path in _list_task_slots(slotdir):
+        record = _read_task_slot_record(path)
+        if record is None:
+            continue
+
+        owner = record[:2]
+        if owner[1] is None:
+            log_warn("Recovering slot '%s' with a corrupted record" % path)
+        elif not pid_exists(owner[1]):
+            log_warn("Recovering slot of task %d held by dead process %d" % owner)
+        elif record[2] and _task_slot_age(path) > TASK_SLOT_CLAIM_TIMEOUT:
+            log_warn("Recovering slot of task %d never claimed from process %d" % owner)
+        else:
+            continue
+
+        try:
+            os.unlink(path)
+            result += 1
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    return result
+
+def _task_slot_age(path):
+    try:
+        return time.time() - os.stat(path).st_mtime
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+        return 0
+
+def get_task_slot_owners():
+    """Returns a list of (task ID, PID) of all held slots"""
+    slotdir = os.path.join(CONFIG["SaveDir"], TASK_SLOT_DIR)
+    if not os.path.isdir(slotdir):
+        return []
+
+    result = []
+    for path in _list_task_slots(slotdir):
+        owner = _read_task_slot(path)
+        if owner is not None and owner[1] is not None:
+            result.append(owner)
+
+    return result
+
+def count_task_slots():
+    """Returns the number of slots currently held."""
+    slotdir = os.path.join(CONFIG["SaveDir"], TASK_SLOT_DIR)
+    if not os.path.isdir(slotdir):
+        return 0
+
+    return len(_list_task_slots(slotdir))
+
+def get_worker_queue_dir():
+    queuedir = os.path.join(CONFIG["SaveDir"], WORKER_QUEUE_DIR)
+    if not os.path.isdir(queuedir):
+        oldmask = os.umask(0007)
+        try:
+            os.makedirs(queuedir)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        finally:
+            os.umask(oldmask)
+
+    return queuedir
+
+def get_worker_socket_path():
+    return os.path.join(CONFIG["SaveDir"], WORKER_SOCKET)
+
+def get_worker_pidfile_path():
+    return os.path.join(CONFIG["SaveDir"], WORKER_PIDFILE)
+
+def get_worker_daemon_pid():
+    """Returns PID of retrace-server-workerd from its pidfile or None"""
+    try:
+        with open(get_worker_pidfile_path(), "r") as f:
+            return int(f.read(32).strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+def worker_daemon_running():
+    """Returns True if retrace-server-workerd is alive"""
+    pid = get_worker_daemon_pid()
+    return pid is not None and pid_exists(pid)
+
+def use_worker_daemon():
+    """Returns True if new tasks should be queued for retrace-server-workerd"""
+    return CONFIG["UseWorkerDaemon"] and worker_daemon_running()
+
+def enqueue_task(taskid, debug=False, kernelver=None, arch=None, client=None):
+    """Passes the task to retrace-server-workerd. The job is stored
+    in the queue directory first so that it survives a lost wake-up
+    or a daemon restart."""
+    queuedir = get_worker_queue_dir()
+    job = {"debug": debug, "kernelver": kernelver, "arch": arch, "client": client}
+    fd, tmpname = tempfile.mkstemp(prefix=".tmp", dir=queuedir)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(job, f)
+        os.rename(tmpname, os.path.join(queuedir, "%d" % taskid))
+    except:
+        os.unlink(tmpname)
+        raise
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto("%d" % taskid, get_worker_socket_path())
+    except socket.error as ex:
+        # the daemon polls the queue anyway
+        log_debug("Unable to wake up retrace-server-workerd: %s" % ex)
+    finally:
+        sock.close()
+
+def read_queued_task(taskid):
+    """Returns parameters of the queued job without removing it
+    or None if the task is not queued."""
+    path = os.path.join(get_worker_queue_dir(), "%d" % taskid)
+    try:
+        with open(path, "r") as f:
+            job = json.load(f)
+    except (IOError, OSError) as ex:
+        if ex.errno == errno.ENOENT:
+            return None
+        raise
+    except ValueError:
+        log_warn("Dropping corrupted job for task %d" % taskid)
+        remove_queued_task(taskid)
+        return None
+
+    return job
+
+def remove_queued_task(taskid):
+    """Removes the job from the queue. Returns False if it
+    has not been there."""
+    try:
+        os.unlink(os.path.join(get_worker_queue_dir(), "%d" % taskid))
+    except OSError as ex:
+        if ex.errno == errno.ENOENT:
+            return False
+        raise
+
+    return True
+
+def get_queued_tasks():
+    """Returns IDs of tasks waiting for retrace-server-workerd, oldest first"""
+    queuedir = get_worker_queue_dir()
+    result = []
+    for filename in os.listdir(queuedir):
+        if not filename.isdigit():
+            continue
+
+        try:
+            mtime = os.path.getmtime(os.path.join(queuedir, filename))
+        except OSError:
+            continue
+
+        result.append((mtime, int(filename)))
+
+    return [taskid for mtime, taskid in sorted(result)]
+
 def parse_rpm_name(name):
     result = {
       "epoch": 0,
@@ -930,149 +2962,452 @@ def parse_rpm_name(name):
     return result
 
 def init_crashstats_db():
+    """Opens a new connection to the statistics database. The schema
+    is only created (or upgraded) by the first process to find its
+    version outdated."""
     # create the database group-writable and world-readable
     old_umask = os.umask(0113)
-    con = sqlite3.connect(os.path.join(CONFIG["SaveDir"], CONFIG["DBFile"]))
-    os.umask(old_umask)
+    try:
+        con = sqlite3.connect(get_crashstats_db_path(), timeout=CRASHSTATS_DB_TIMEOUT)
+    finally:
+        os.umask(old_umask)
 
     query = con.cursor()
     query.execute("PRAGMA foreign_keys = ON")
+    # durable enough with WAL, a crash may only lose the last transactions
+    query.execute("PRAGMA synchronous = NORMAL")
+    query.execute("PRAGMA user_version")
+    if query.fetchone()[0] < CRASHSTATS_SCHEMA_VERSION:
+        _create_crashstats_schema(con)
+
+    return con
+
+def _create_crashstats_schema(con):
+    # sqlite3 would commit before every CREATE by itself
+    con.isolation_level = None
+    query = con.cursor()
+    try:
+        # readers (stats.wsgi) do not block the workers writing
+        query.execute("PRAGMA journal_mode = WAL")
+        query.execute("BEGIN IMMEDIATE")
+        query.execute("PRAGMA user_version")
+        schema_version = query.fetchone()[0]
+        if schema_version >= CRASHSTATS_SCHEMA_VERSION:
+            # created by another process in the meantime
+            query.execute("ROLLBACK")
+            return
+
+        query.execute("""
+          CREATE TABLE IF NOT EXISTS
+          tasks(id INTEGER PRIMARY KEY AUTOINCREMENT, taskid, package, version,
+          arch, starttime NOT NULL, duration NOT NULL, coresize, status NOT NULL)
+        """)
+        query.execute("""
+          CREATE TABLE IF NOT EXISTS
+          success(taskid REFERENCES tasks(id), pre NOT NULL, post NOT NULL,
+                  rootsize NOT NULL)
+        """)
+        query.execute("""
+          CREATE TABLE IF NOT EXISTS
+          packages(id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   name NOT NULL, version NOT NULL)
+        """)
+        query.execute("""
+          CREATE TABLE IF NOT EXISTS
+          packages_tasks(pkgid REFERENCES packages(id),
+                         taskid REFERENCES tasks(id))
+        """)
+        query.execute("""
+          CREATE TABLE IF NOT EXISTS
+          buildids(taskid REFERENCES tasks(id), soname, buildid NOT NULL)
+        """)
+        query.execute("""
+          CREATE TABLE IF NOT EXISTS
+          reportfull(requesttime NOT NULL, ip NOT NULL)
+        """)
+        query.execute("""
+          CREATE TABLE IF NOT EXISTS
+          debuginfostore(requesttime NOT NULL, hits NOT NULL, misses NOT NULL)
+        """)
+
+        query.execute("PRAGMA table_info(tasks)")
+        if not "type" in [column[1] for column in query.fetchall()]:
+            query.execute("ALTER TABLE tasks ADD COLUMN type")
+
+        query.execute("""
+          SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'estimates'
+        """)
+        if query.fetchone() is None:
+            query.execute("""
+              CREATE TABLE
+              estimates(key PRIMARY KEY, samples NOT NULL, sumsize NOT NULL,
+                        sumduration NOT NULL, sumsize2 NOT NULL,
+                        sumsizeduration NOT NULL)
+            """)
+            query.execute("""
+              SELECT package, version, arch, duration, coresize, type
+              FROM tasks WHERE status = ?
+            """, (STATUS_SUCCESS,))
+            for package, version, arch, duration, coresize, tasktype in query.fetchall():
+                if tasktype is None:
+                    # saved before the type was recorded
+                    tasktype = TASK_VMCORE if package == "kernel" else TASK_RETRACE
+                _add_task_estimate(query, {"type": tasktype, "package": package,
+                                           "version": version, "arch": arch,
+                                           "duration": duration,
+                                           "coresize": coresize})
+
+        # packages used to be looked up before they were inserted,
+        # concurrent workers could insert the same one twice
+        query.execute("""
+          UPDATE packages_tasks SET pkgid =
+            (SELECT MIN(other.id) FROM packages AS package
+             JOIN packages AS other ON other.name = package.name AND
+                                       other.version = package.version
+             WHERE package.id = packages_tasks.pkgid)
+          WHERE pkgid NOT IN (SELECT MIN(id) FROM packages GROUP BY name, version)
+        """)
+        query.execute("""
+          DELETE FROM packages
+          WHERE id NOT IN (SELECT MIN(id) FROM packages GROUP BY name, version)
+        """)
+        query.execute("""
+          CREATE UNIQUE INDEX IF NOT EXISTS
+          packages_name_version ON packages(name, version)
+        """)
+        query.execute("CREATE INDEX IF NOT EXISTS tasks_starttime ON tasks(starttime)")
+        query.execute("CREATE INDEX IF NOT EXISTS packages_tasks_taskid ON packages_tasks(taskid)")
+        query.execute("CREATE INDEX IF NOT EXISTS packages_tasks_pkgid ON packages_tasks(pkgid)")
+        query.execute("CREATE INDEX IF NOT EXISTS buildids_taskid ON buildids(taskid)")
+
+        # counts for stats.wsgi, updated as the statistics are saved
+        query.execute("""
+          CREATE TABLE IF NOT EXISTS
+          statsrollup(kind NOT NULL, key NOT NULL, count NOT NULL,
+                      PRIMARY KEY (kind, key))
+        """)
+        query.execute("""
+          CREATE INDEX IF NOT EXISTS statsrollup_count ON statsrollup(kind, count)
+        """)
+        query.execute("""
+          CREATE TABLE IF NOT EXISTS
+          statsbuildids(key PRIMARY KEY, buildid, soname, count NOT NULL)
+        """)
+        query.execute("""
+          CREATE INDEX IF NOT EXISTS statsbuildids_count ON statsbuildids(count)
+        """)
+        if schema_version < 2:
+            _fill_crashstats_rollups(query)
+
+        query.execute("PRAGMA user_version = %d" % CRASHSTATS_SCHEMA_VERSION)
+        query.execute("COMMIT")
+    except:
+        try:
+            query.execute("ROLLBACK")
+        except sqlite3.OperationalError:
+            # no transaction is active
+            pass
+        raise
+    finally:
+        con.isolation_level = ""
+
+def _get_version_tail(version):
+    """The part of the version stats.wsgi matches releases against
+    (fc25 of 1.0-1.fc25)"""
+    if version is None:
+        return None
+
+    return version.rsplit(".", 1)[-1]
+
+def _fill_crashstats_rollups(query):
+    """Counts the statistics saved before the rollups existed"""
     query.execute("""
-      CREATE TABLE IF NOT EXISTS
-      tasks(id INTEGER PRIMARY KEY AUTOINCREMENT, taskid, package, version,
-      arch, starttime NOT NULL, duration NOT NULL, coresize, status NOT NULL)
+      INSERT INTO statsrollup (kind, key, count)
+      SELECT 'status', status, COUNT(*) FROM tasks GROUP BY status
     """)
     query.execute("""
-      CREATE TABLE IF NOT EXISTS
-      success(taskid REFERENCES tasks(id), pre NOT NULL, post NOT NULL,
-              rootsize NOT NULL)
+      INSERT INTO statsrollup (kind, key, count)
+      SELECT 'arch', arch, COUNT(*) FROM tasks WHERE arch IS NOT NULL GROUP BY arch
     """)
     query.execute("""
-      CREATE TABLE IF NOT EXISTS
-      packages(id INTEGER PRIMARY KEY AUTOINCREMENT,
-               name NOT NULL, version NOT NULL)
+      INSERT INTO statsrollup (kind, key, count)
+      SELECT 'package', package, COUNT(*) FROM tasks
+      WHERE package IS NOT NULL GROUP BY package
     """)
     query.execute("""
-      CREATE TABLE IF NOT EXISTS
-      packages_tasks(pkgid REFERENCES packages(id),
-                     taskid REFERENCES tasks(id))
+      INSERT INTO statsrollup (kind, key, count)
+      SELECT 'day', date(starttime, 'unixepoch', 'localtime'), COUNT(*) FROM tasks
+      GROUP BY 2
+    """)
+    query.execute("SELECT version, COUNT(*) FROM tasks WHERE version IS NOT NULL GROUP BY version")
+    releases = {}
+    for version, count in query.fetchall():
+        tail = _get_version_tail(version)
+        releases[tail] = releases.get(tail, 0) + count
+    _add_crashstats_rollup(query, [("release", tail, count) for tail, count in releases.items()])
+
+    query.execute("""
+      INSERT INTO statsrollup (kind, key, count)
+      SELECT 'required', packages.name, COUNT(*) FROM packages_tasks
+      JOIN packages ON packages.id = packages_tasks.pkgid
+      WHERE NOT packages.name LIKE '%-debuginfo' GROUP BY packages.name
     """)
+
+    query.execute("SELECT COUNT(*) FROM reportfull")
+    denied = query.fetchone()[0]
+    query.execute("SELECT COALESCE(SUM(hits), 0), COALESCE(SUM(misses), 0) FROM debuginfostore")
+    hits, misses = query.fetchone()
+    _add_crashstats_rollup(query, [("counter", "denied", denied),
+                                   ("counter", "debuginfo_hits", hits),
+                                   ("counter", "debuginfo_misses", misses)])
+
     query.execute("""
-      CREATE TABLE IF NOT EXISTS
-      buildids(taskid REFERENCES tasks(id), soname, buildid NOT NULL)
+      INSERT INTO statsbuildids (key, buildid, soname, count)
+      SELECT 'soname:' || COALESCE(soname, ''), buildid, soname, COUNT(*) FROM buildids
+      WHERE buildid = '-' OR buildid IS NULL GROUP BY soname
     """)
     query.execute("""
-      CREATE TABLE IF NOT EXISTS
-      reportfull(requesttime NOT NULL, ip NOT NULL)
+      INSERT INTO statsbuildids (key, buildid, soname, count)
+      SELECT 'buildid:' || buildid, buildid, soname, COUNT(*) FROM buildids
+      WHERE buildid != '-' AND buildid IS NOT NULL GROUP BY buildid
     """)
-    con.commit()
+
+def _add_crashstats_rollup(query, counts):
+    """Adds [(kind, key, count)] to statsrollup, None keys are skipped"""
+    counts = [(kind, key, count) for kind, key, count in counts if key is not None]
+    query.executemany("""
+      INSERT OR IGNORE INTO statsrollup (kind, key, count) VALUES (?, ?, 0)
+      """, [(kind, key) for kind, key, count in counts])
+    query.executemany("""
+      UPDATE statsrollup SET count = count + ? WHERE kind = ? AND key = ?
+      """, [(count, kind, key) for kind, key, count in counts])
+
+def get_crashstats_db_path():
+    return os.path.join(CONFIG["SaveDir"], CONFIG["DBFile"])
+
+_crashstats_db = threading.local()
+# connections inherited through fork(), they must be neither used
+# nor closed by the child, closing would disturb the parent
+_inherited_dbs = []
+
+def get_crashstats_db():
+    """Returns a connection to the statistics database that stays open
+    for further calls of the same thread. A forked process opens its own."""
+    pid, con = getattr(_crashstats_db, "con", (None, None))
+    if pid != os.getpid():
+        if con is not None:
+            _inherited_dbs.append(con)
+        con = init_crashstats_db()
+        _crashstats_db.con = (os.getpid(), con)
 
     return con
 
+def close_crashstats_db():
+    """Closes the connection kept by get_crashstats_db. Processes
+    that fork() call it first so that children do not inherit it."""
+    pid, con = getattr(_crashstats_db, "con", (None, None))
+    if con is not None and pid == os.getpid():
+        con.close()
+
+    _crashstats_db.con = (None, None)
+
 def save_crashstats(stats, con=None):
-    close = False
+    """Saves the task's statistics and returns their ID. The changes are
+    committed unless con is given, then the caller commits them."""
     if con is None:
-        con = init_crashstats_db()
-        close = True
+        con = get_crashstats_db()
+        with con:
+            return save_crashstats(stats, con)
 
     query = con.cursor()
     query.execute("""
       INSERT INTO tasks (taskid, package, version, arch,
-      starttime, duration, coresize, status)
-      VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+      starttime, duration, coresize, status, type)
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
       """,
       (stats["taskid"], stats["package"], stats["version"],
        stats["arch"], stats["starttime"], stats["duration"],
-       stats["coresize"], stats["status"]))
+       stats["coresize"], stats["status"], stats.get("type")))
+    statsid = query.lastrowid
 
-    con.commit()
-    if close:
-        con.close()
+    day = time.strftime("%Y-%m-%d", time.localtime(stats["starttime"]))
+    _add_crashstats_rollup(query, [("status", stats["status"], 1),
+                                   ("arch", stats["arch"], 1),
+                                   ("package", stats["package"], 1),
+                                   ("release", _get_version_tail(stats["version"]), 1),
+                                   ("day", day, 1)])
+
+    if stats["status"] == STATUS_SUCCESS:
+        _add_task_estimate(query, stats)
 
-    return query.lastrowid
+    return statsid
 
 def save_crashstats_success(statsid, pre, post, rootsize, con=None):
-    close = False
     if con is None:
-        con = init_crashstats_db()
-        close = True
+        con = get_crashstats_db()
+        with con:
+            return save_crashstats_success(statsid, pre, post, rootsize, con)
 
-    query = con.cursor()
-    query.execute("""
+    con.execute("""
       INSERT INTO success (taskid, pre, post, rootsize)
       VALUES (?, ?, ?, ?)
       """,
       (statsid, pre, post, rootsize))
 
-    con.commit()
-    if close:
-        con.close()
-
 def save_crashstats_packages(statsid, packages, con=None):
-    close = False
     if con is None:
-        con = init_crashstats_db()
-        close = True
+        con = get_crashstats_db()
+        with con:
+            return save_crashstats_packages(statsid, packages, con)
 
-    query = con.cursor()
+    rows = []
     for package in packages:
         pkgdata = parse_rpm_name(package)
         if pkgdata["name"] is None:
             continue
 
-        ver = "%s-%s" % (pkgdata["version"], pkgdata["release"])
-        query.execute("SELECT id FROM packages WHERE name = ? AND version = ?",
-                      (pkgdata["name"], ver))
-        row = query.fetchone()
-        if row:
-            pkgid = row[0]
-        else:
-            query.execute("INSERT INTO packages (name, version) VALUES (?, ?)",
-                          (pkgdata["name"], ver))
-            pkgid = query.lastrowid
+        rows.append((pkgdata["name"], "%s-%s" % (pkgdata["version"], pkgdata["release"])))
 
-        query.execute("""
-          INSERT INTO packages_tasks (taskid, pkgid) VALUES (?, ?)
-          """, (statsid, pkgid))
+    # the unique index of packages(name, version) keeps one copy
+    con.executemany("INSERT OR IGNORE INTO packages (name, version) VALUES (?, ?)", rows)
+    con.executemany("""
+      INSERT INTO packages_tasks (taskid, pkgid)
+      SELECT ?, id FROM packages WHERE name = ? AND version = ?
+      """, [(statsid, name, version) for name, version in rows])
 
-    con.commit()
-    if close:
-        con.close()
+    required = {}
+    for name, version in rows:
+        if not name.endswith("-debuginfo"):
+            required[name] = required.get(name, 0) + 1
+    _add_crashstats_rollup(con, [("required", name, count) for name, count in required.items()])
 
 def save_crashstats_build_ids(statsid, buildids, con=None):
-    close = False
     if con is None:
-        con = init_crashstats_db()
-        close = True
+        con = get_crashstats_db()
+        with con:
+            return save_crashstats_build_ids(statsid, buildids, con)
 
-    query = con.cursor()
+    con.executemany("""
+      INSERT INTO buildids (taskid, soname, buildid)
+      VALUES (?, ?, ?)
+      """,
+      [(statsid, soname, buildid) for soname, buildid in buildids])
+
+    # missing build-ids are grouped by soname, the others by build-id
+    rollup = []
     for soname, buildid in buildids:
-        query.execute("""
-          INSERT INTO buildids (taskid, soname, buildid)
-          VALUES (?, ?, ?)
-          """,
-          (statsid, soname, buildid))
+        if buildid is None or buildid == "-":
+            key = "soname:%s" % (soname or "")
+        else:
+            key = "buildid:%s" % buildid
+        rollup.append((key, buildid, soname))
+
+    con.executemany("""
+      INSERT OR IGNORE INTO statsbuildids (key, buildid, soname, count)
+      VALUES (?, ?, ?, 0)
+      """, rollup)
+    con.executemany("UPDATE statsbuildids SET count = count + 1 WHERE key = ?",
+                    [(key,) for key, buildid, soname in rollup])
+
+def get_crashstats_log_path():
+    return "%s%s" % (get_crashstats_db_path(), CRASHSTATS_LOG_SUFFIX)
+
+def _append_crashstats_log(table, values):
+    path = get_crashstats_log_path()
+    line = "%s\n" % json.dumps([table, values])
+    while True:
+        old_umask = os.umask(0113)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        finally:
+            os.umask(old_umask)
 
-    con.commit()
-    if close:
-        con.close()
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            try:
+                current = os.stat(path).st_ino
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+                current = None
+
+            # the log may have been taken by drain_crashstats_log()
+            # between open() and flock(), write into the new one
+            if current == os.fstat(fd).st_ino:
+                os.write(fd, line)
+                return
+        finally:
+            os.close(fd)
+
+def _insert_crashstats_rows(con, table, rows):
+    con.executemany(CRASHSTATS_LOG_TABLES[table], rows)
+    if table == "reportfull":
+        counts = [("counter", "denied", len(rows))]
+    else:
+        counts = [("counter", "debuginfo_hits", sum(row[1] for row in rows)),
+                  ("counter", "debuginfo_misses", sum(row[2] for row in rows))]
+    _add_crashstats_rollup(con, counts)
+
+def _save_crashstats_row(table, values, con):
+    if con is not None:
+        _insert_crashstats_rows(con, table, [values])
+    elif CONFIG["StatsAppendLog"]:
+        # do not wait for the database lock
+        _append_crashstats_log(table, values)
+    else:
+        con = get_crashstats_db()
+        with con:
+            _insert_crashstats_rows(con, table, [values])
 
 def save_crashstats_reportfull(ip, con=None):
-    close = False
-    if con is None:
-        con = init_crashstats_db()
-        close = True
+    _save_crashstats_row("reportfull", [int(time.time()), ip], con)
+
+def save_crashstats_debuginfostore(hits, misses, con=None):
+    _save_crashstats_row("debuginfostore", [int(time.time()), hits, misses], con)
+
+def drain_crashstats_log(con=None):
+    """Moves the records of the append log (StatsAppendLog)
+    into the statistics database. Returns their number."""
+    path = get_crashstats_log_path()
+    draining = "%s.draining" % path
+    # a previous drain might have been interrupted
+    if not os.path.isfile(draining):
+        try:
+            os.rename(path, draining)
+        except OSError as ex:
+            if ex.errno == errno.ENOENT:
+                return 0
+            raise
+
+    rows = {}
+    with open(draining, "r") as f:
+        # wait for the writers that opened the log before the rename
+        fcntl.flock(f, fcntl.LOCK_EX)
+        if os.fstat(f.fileno()).st_nlink == 0:
+            # drained by another process
+            return 0
+
+        for line in f:
+            try:
+                table, values = json.loads(line)
+                CRASHSTATS_LOG_TABLES[table]
+            except (ValueError, KeyError, TypeError):
+                # a write interrupted in the middle
+                log_warn("Invalid record in statistics log: %s" % line.strip())
+                continue
 
-    query = con.cursor()
-    query.execute("""
-      INSERT INTO reportfull (requesttime, ip)
-      VALUES (?, ?)
-      """,
-      (int(time.time()), ip))
+            rows.setdefault(table, []).append(values)
 
-    con.commit()
-    if close:
-        con.close()
+        if con is None:
+            con = get_crashstats_db()
+
+        with con:
+            for table, values in rows.items():
+                _insert_crashstats_rows(con, table, values)
+
+        os.unlink(draining)
+
+    return sum(len(values) for values in rows.values())
 
 def send_email(frm, to, subject, body):
     if isinstance(to, list):
@@ -1091,37 +3426,656 @@ def send_email(frm, to, subject, body):
     smtp.sendmail(frm, to, msg)
     smtp.close()
 
-def ftp_init():
+def ftp_connect():
+    """Opens a new logged in FTP connection"""
     if CONFIG["FTPSSL"]:
-        ftp = ftplib.FTP_SSL(CONFIG["FTPHost"])
-        ftp.prot_p()
+        ftp = ftplib.FTP_TLS()
     else:
-        ftp = ftplib.FTP(CONFIG["FTPHost"])
+        ftp = ftplib.FTP()
 
+    ftp.connect(CONFIG["FTPHost"], CONFIG["FTPPort"], timeout=FTP_TIMEOUT)
     ftp.login(CONFIG["FTPUser"], CONFIG["FTPPass"])
+    if CONFIG["FTPSSL"]:
+        ftp.prot_p()
     ftp.cwd(CONFIG["FTPDir"])
+    # SIZE and REST need binary mode
+    ftp.voidcmd("TYPE I")
 
     return ftp
 
-def ftp_close(ftp):
+def ftp_disconnect(ftp):
     try:
         ftp.quit()
     except:
         ftp.close()
 
-def ftp_list_dir(ftpdir="/", ftp=None):
-    close = False
-    if ftp is None:
-        ftp = ftp_init()
-        close = True
+class FtpPool(object):
+    """Bounded pool of logged in FTP connections. At most size
+    connections are in use at once, released ones are kept open
+    and reused, which saves the connect, TLS handshake and login."""
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        # protects self.available, the number of free slots
+        self.slots = threading.Condition()
+        self.available = max(1, size)
+        self.idle = []
+
+    def _take_slot(self, timeout):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        with self.slots:
+            while self.available < 1:
+                if deadline is None:
+                    self.slots.wait()
+                    continue
 
-    result = [f.lstrip("/") for f in ftp.nlst(ftpdir)]
+                left = deadline - time.time()
+                if left <= 0:
+                    raise Exception, "No FTP connection available in %d seconds" % timeout
 
-    if close:
-        ftp_close(ftp)
+                self.slots.wait(left)
+
+            self.available -= 1
+
+    def _release_slot(self):
+        with self.slots:
+            self.available += 1
+            self.slots.notify()
+
+    def _reuse(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    return None
+
+                ftp, released = self.idle.pop()
+
+            age = time.time() - released
+            if age < FTP_IDLE_TIMEOUT:
+                try:
+                    if age > FTP_NOOP_AFTER:
+                        ftp.voidcmd("NOOP")
+                    return ftp
+                except ftplib.all_errors:
+                    pass
+
+            ftp_disconnect(ftp)
+
+    def acquire(self, timeout=None):
+        """Every acquired connection must be given back by release()
+        or discard(), also when a command on it fails"""
+        self._take_slot(timeout)
+        try:
+            ftp = self._reuse()
+            if ftp is None:
+                ftp = ftp_connect()
+        except:
+            self._release_slot()
+            raise
+
+        return ftp
+
+    def release(self, ftp):
+        """Returns a connection in a clean state (no transfer in progress)"""
+        if ftp.sock is None:
+            self._release_slot()
+            return
+
+        with self.lock:
+            self.idle.append((ftp, time.time()))
+        self._release_slot()
+
+    def discard(self, ftp):
+        """Closes a connection that failed or was interrupted in a transfer"""
+        try:
+            ftp.close()
+        finally:
+            self._release_slot()
+
+    def clear(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+
+        for ftp, released in idle:
+            ftp_disconnect(ftp)
+
+_ftp_pool = None
+
+def get_ftp_pool():
+    global _ftp_pool
+    if _ftp_pool is None:
+        _ftp_pool = FtpPool(CONFIG["FTPConnections"])
+
+    return _ftp_pool
+
+def ftp_init():
+    return get_ftp_pool().acquire(FTP_ACQUIRE_TIMEOUT)
+
+def ftp_close(ftp):
+    get_ftp_pool().release(ftp)
 
+def ftp_discard(ftp):
+    """ftp_close() for a connection on which a command failed"""
+    get_ftp_pool().discard(ftp)
+
+def ftp_list_dir(ftpdir="/", ftp=None):
+    if ftp is not None:
+        return [f.lstrip("/") for f in ftp.nlst(ftpdir)]
+
+    ftp = ftp_init()
+    try:
+        result = [f.lstrip("/") for f in ftp.nlst(ftpdir)]
+    except:
+        ftp_discard(ftp)
+        raise
+
+    ftp_close(ftp)
     return result
 
+class FtpDownload(object):
+    """Downloads filename from the FTP server into path. The file is
+    split into segments retrieved by parallel connections of pool
+    (REST + RETR). Retrieved bytes of every segment are recorded in
+    path + DOWNLOAD_STATE_SUFFIX, a dropped connection or a worker
+    restart continues where the segment stopped. A partial file
+    without the state (written sequentially) is continued as well.
+    ingest (DownloadIngest) gets the data in order."""
+    def __init__(self, pool, filename, path, segments=1, progress=None, ingest=None):
+        self.pool = pool
+        self.filename = filename
+        self.path = path
+        self.statepath = "%s%s" % (path, DOWNLOAD_STATE_SUFFIX)
+        self.segmentcount = max(1, segments)
+        self.progress = progress
+        self.ingest = ingest
+        self.size = None
+        self.validator = None
+        # [first byte, end (exclusive), bytes retrieved]
+        self.segments = []
+        self.current = 0
+        self.reported = 0
+        self.saved = 0
+        self.lock = threading.Lock()
+        self.ingested = 0
+        self.ingest_lock = threading.Lock()
+        self.failed = False
+
+    def _probe(self):
+        ftp = self.pool.acquire()
+        try:
+            self.size = ftp.size(self.filename)
+            try:
+                self.validator = ftp.sendcmd("MDTM %s" % self.filename)
+            except ftplib.error_perm:
+                self.validator = None
+        except:
+            self.pool.discard(ftp)
+            raise
+
+        self.pool.release(ftp)
+        if self.size is None:
+            raise Exception, "Unable to determine size of %s" % self.filename
+
+    def _load_state(self):
+        try:
+            with open(self.statepath, "r") as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = None
+
+        if state is not None and state.get("filename") == self.filename and \
+           state.get("size") == self.size and state.get("validator") == self.validator and \
+           os.path.isfile(self.path) and os.path.getsize(self.path) == self.size:
+            self.segments = state["segments"]
+            return
+
+        if state is None and os.path.isfile(self.path) and 0 < os.path.getsize(self.path) < self.size:
+            # a file written sequentially, e.g. by an interrupted retrbinary;
+            # a full-size file without the state may be a preallocated one
+            log_info("Continuing partial download of %s at byte %d" % (self.filename, os.path.getsize(self.path)))
+            self.segments = [[0, self.size, os.path.getsize(self.path)]]
+        else:
+            count = min(self.segmentcount, max(1, self.size // FTP_MIN_SEGMENT))
+            length = self.size // count
+            self.segments = [[i * length, (i + 1) * length, 0] for i in xrange(count)]
+            self.segments[-1][1] = self.size
+
+        # the state must exist before the file is preallocated,
+        # a restart before the first RETR must not see a complete file
+        self._save_state()
+        with open(self.path, "ab") as target:
+            target.truncate(self.size)
+
+    def _save_state(self):
+        tmppath = "%s.tmp" % self.statepath
+        with open(tmppath, "w") as f:
+            json.dump({ "filename": self.filename,
+                        "size": self.size,
+                        "validator": self.validator,
+                        "segments": self.segments }, f)
+        os.rename(tmppath, self.statepath)
+
+    def _add_progress(self, length):
+        # called with self.lock held
+        self.current += length
+        if self.progress is not None and time.time() - self.reported >= 1:
+            self.progress(self.current, self.size)
+            self.reported = time.time()
+
+    def _feed_ingest(self):
+        """Feeds the retrieved bytes following the ones already ingested"""
+        if self.ingest is None or not self.ingest_lock.acquire(False):
+            return
+
+        try:
+            with open(self.path, "rb") as source:
+                while True:
+                    with self.lock:
+                        ready = 0
+                        for first, end, done in self.segments:
+                            ready = first + done
+                            if first + done < end:
+                                break
+
+                    if ready <= self.ingested:
+                        break
+
+                    source.seek(self.ingested)
+                    data = source.read(min(UNPACK_CHUNK_SIZE, ready - self.ingested))
+                    if not data:
+                        raise Exception, "%s is shorter than expected" % self.path
+
+                    self.ingest.feed(data)
+                    self.ingested += len(data)
+        finally:
+            self.ingest_lock.release()
+
+    def _retrieve(self, target, segment):
+        """Retrieves the rest of segment over a single connection"""
+        first, end, done = segment
+        ftp = self.pool.acquire()
+        try:
+            conn = ftp.transfercmd("RETR %s" % self.filename, rest=first + done)
+            try:
+                target.seek(first + done)
+                while first + done < end and not self.failed:
+                    data = conn.recv(min(FTP_BLOCK_SIZE, end - first - done))
+                    if not data:
+                        break
+
+                    target.write(data)
+                    done += len(data)
+                    with self.lock:
+                        segment[2] = done
+                        self._add_progress(len(data))
+                        if self.current - self.saved >= FTP_STATE_INTERVAL:
+                            # the data must be on disk before it is recorded
+                            target.flush()
+                            os.fsync(target.fileno())
+                            self._save_state()
+                            self.saved = self.current
+
+                    if self.ingest is not None:
+                        # _feed_ingest reads the data back from the file
+                        target.flush()
+                        self._feed_ingest()
+            finally:
+                conn.close()
+
+            if first + done < end:
+                raise EOFError, "Connection closed at byte %d of %s" % (first + done, self.filename)
+
+            if end < self.size:
+                # the server is still sending, the connection is not reusable
+                self.pool.discard(ftp)
+            else:
+                ftp.voidresp()
+                self.pool.release(ftp)
+        except:
+            self.pool.discard(ftp)
+            raise
+
+    def _worker(self, segment, errors):
+        try:
+            with open(self.path, "r+b") as target:
+                retries = 0
+                while segment[0] + segment[2] < segment[1] and not self.failed:
+                    before = segment[2]
+                    try:
+                        self._retrieve(target, segment)
+                    except (socket.error, EOFError, ftplib.error_temp, ftplib.error_reply) as ex:
+                        if segment[2] == before:
+                            retries += 1
+                        if retries > FTP_RETRIES:
+                            raise
+
+                        log_warn("FTP transfer of %s interrupted at byte %d, resuming: %s"
+                                 % (self.filename, segment[0] + segment[2], ex))
+
+                target.flush()
+                os.fsync(target.fileno())
+        except Exception as ex:
+            self.failed = True
+            errors.append(ex)
+
+    def run(self):
+        self._probe()
+        self._load_state()
+        self.current = sum(done for first, end, done in self.segments)
+        self.saved = self.current
+        if self.current > 0:
+            log_info("Resuming download of %s, %s of %s retrieved"
+                     % (self.filename, human_readable_size(self.current), human_readable_size(self.size)))
+
+        errors = []
+        threads = []
+        for segment in self.segments:
+            thread = threading.Thread(target=self._worker, args=(segment, errors))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            with self.lock:
+                self._save_state()
+            raise errors[0]
+
+        self._feed_ingest()
+
+        if os.path.getsize(self.path) != self.size:
+            raise Exception, "Downloaded %d bytes instead of %d" % (os.path.getsize(self.path), self.size)
+
+        if os.path.isfile(self.statepath):
+            os.unlink(self.statepath)
+
+        if self.progress is not None:
+            self.progress(self.current, self.size)
+
+def _http_open(url, method=None, first=None, last=None):
+    request = urllib2.Request(url)
+    if method is not None:
+        request.get_method = lambda: method
+
+    if first is not None:
+        request.add_header("Range", "bytes=%d-%d" % (first, last))
+
+    return urllib2.urlopen(request, timeout=HTTP_TIMEOUT)
+
+class RangedDownload(object):
+    """Downloads an HTTP(S) URL into path. When the server accepts
+    ranges, the file is split into chunks that are fetched by up to
+    connections parallel requests. Finished chunks are recorded in
+    path + DOWNLOAD_STATE_SUFFIX, an interrupted download (e.g. by
+    a worker restart) only fetches the rest. progress(current, total)
+    is called at most once a second."""
+    def __init__(self, url, path, connections=1, chunksize=32 << 20, progress=None, ingest=None):
+        self.url = url
+        self.path = path
+        self.statepath = "%s%s" % (path, DOWNLOAD_STATE_SUFFIX)
+        self.connections = max(1, connections)
+        self.chunksize = max(1 << 20, chunksize)
+        self.progress = progress
+        self.size = None
+        self.validator = None
+        self.current = 0
+        self.reported = 0
+        self.lock = threading.Lock()
+        self.done = set()
+        self.failed = False
+        # DownloadIngest gets the chunks in order as they are finished
+        self.ingest = ingest
+        self.ingested = 0
+        self.ingest_lock = threading.Lock()
+
+    def _add_progress(self, length):
+        with self.lock:
+            self.current += length
+            if self.progress is not None and time.time() - self.reported >= 1:
+                self.progress(self.current, self.size or self.current)
+                self.reported = time.time()
+
+    def _probe(self):
+        """Returns whether the server supports ranges"""
+        try:
+            response = _http_open(self.url, method="HEAD")
+        except urllib2.HTTPError as ex:
+            # some servers refuse HEAD, the plain download tells more
+            log_debug("HEAD %s failed: %s" % (self.url, ex))
+            return False
+
+        try:
+            headers = response.info()
+            length = headers.getheader("Content-Length")
+            if length is None or not length.isdigit():
+                return False
+
+            self.size = int(length)
+            self.validator = headers.getheader("ETag") or headers.getheader("Last-Modified")
+            return headers.getheader("Accept-Ranges", "").strip().lower() == "bytes"
+        finally:
+            response.close()
+
+    def _load_state(self):
+        try:
+            with open(self.statepath, "r") as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        if state.get("url") != self.url or state.get("size") != self.size or \
+           state.get("chunksize") != self.chunksize or \
+           state.get("validator") != self.validator:
+            log_info("Remote file has changed, downloading it again")
+            return
+
+        if not os.path.isfile(self.path) or os.path.getsize(self.path) != self.size:
+            return
+
+        self.done = set(state["done"])
+
+    def _save_state(self):
+        tmppath = "%s.tmp" % self.statepath
+        with open(tmppath, "w") as f:
+            json.dump({ "url": self.url,
+                        "size": self.size,
+                        "chunksize": self.chunksize,
+                        "validator": self.validator,
+                        "done": sorted(self.done) }, f)
+        os.rename(tmppath, self.statepath)
+
+    def _feed_ingest(self):
+        """Feeds finished chunks following the ones already ingested.
+        Their data is still in the page cache."""
+        if self.ingest is None or not self.ingest_lock.acquire(False):
+            return
+
+        try:
+            with open(self.path, "rb") as source:
+                while True:
+                    with self.lock:
+                        if not self.ingested in self.done:
+                            break
+
+                    first, last = self._chunk_range(self.ingested)
+                    source.seek(first)
+                    remaining = last - first + 1
+                    while remaining > 0:
+                        data = source.read(min(HTTP_BLOCK_SIZE, remaining))
+                        if not data:
+                            raise Exception, "%s is shorter than expected" % self.path
+
+                        self.ingest.feed(data)
+                        remaining -= len(data)
+
+                    self.ingested += 1
+        finally:
+            self.ingest_lock.release()
+
+    def _chunk_range(self, index):
+        first = index * self.chunksize
+        return first, min(self.size, first + self.chunksize) - 1
+
+    def _fetch_chunk(self, target, index):
+        first, last = self._chunk_range(index)
+        received = 0
+        try:
+            response = _http_open(self.url, first=first, last=last)
+            try:
+                if response.getcode() != 206:
+                    raise Exception, "Server ignored range request (HTTP %d)" % response.getcode()
+
+                content_range = response.info().getheader("Content-Range", "")
+                if content_range.strip() != "bytes %d-%d/%d" % (first, last, self.size):
+                    raise Exception, "Unexpected Content-Range '%s' for bytes %d-%d" % (content_range, first, last)
+
+                target.seek(first)
+                while received <= last - first:
+                    data = response.read(min(HTTP_BLOCK_SIZE, last - first + 1 - received))
+                    if not data:
+                        break
+
+                    target.write(data)
+                    received += len(data)
+                    self._add_progress(len(data))
+            finally:
+                response.close()
+
+            if received != last - first + 1:
+                raise EOFError, "Received %d bytes instead of %d for bytes %d-%d" % (received, last - first + 1, first, last)
+        except:
+            # the chunk is fetched again from its start
+            self._add_progress(-received)
+            raise
+
+    def _fetch_chunk_retry(self, target, index):
+        retries = 0
+        while True:
+            try:
+                self._fetch_chunk(target, index)
+                return
+            except (IOError, EOFError, httplib.HTTPException) as ex:
+                retries += 1
+                if retries >= HTTP_RETRIES or self.failed:
+                    raise
+
+                log_warn("Fetching bytes %d-%d of %s failed, retrying: %s"
+                         % (self._chunk_range(index) + (self.url, ex)))
+
+    def _worker(self, chunks, errors):
+        try:
+            with open(self.path, "r+b") as target:
+                while not self.failed:
+                    try:
+                        index = chunks.get_nowait()
+                    except Queue.Empty:
+                        break
+
+                    self._fetch_chunk_retry(target, index)
+                    # the data must be on disk before the chunk is recorded
+                    target.flush()
+                    os.fsync(target.fileno())
+                    with self.lock:
+                        self.done.add(index)
+                        self._save_state()
+
+                    self._feed_ingest()
+        except Exception as ex:
+            self.failed = True
+            errors.append(ex)
+
+    def _download_ranges(self):
+        self._load_state()
+        if not self.done:
+            # the state marks the preallocated file as incomplete
+            self._save_state()
+            with open(self.path, "wb") as target:
+                target.truncate(self.size)
+
+        chunkcount = (self.size + self.chunksize - 1) // self.chunksize
+        chunks = Queue.Queue()
+        for index in xrange(chunkcount):
+            if index in self.done:
+                first, last = self._chunk_range(index)
+                self.current += last - first + 1
+            else:
+                chunks.put(index)
+
+        if self.done:
+            log_info("Resuming download of %s, %d of %d chunks left"
+                     % (self.url, chunkcount - len(self.done), chunkcount))
+
+        errors = []
+        threads = []
+        for i in xrange(min(self.connections, chunks.qsize())):
+            thread = threading.Thread(target=self._worker, args=(chunks, errors))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        # the state is kept to resume later
+        if errors:
+            raise errors[0]
+
+        # chunks finished while another thread was feeding
+        self._feed_ingest()
+
+    def _download_single(self):
+        response = _http_open(self.url)
+        try:
+            length = response.info().getheader("Content-Length")
+            if length is not None and length.isdigit():
+                self.size = int(length)
+
+            with open(self.path, "wb") as target:
+                while True:
+                    data = response.read(HTTP_BLOCK_SIZE)
+                    if not data:
+                        break
+
+                    target.write(data)
+                    self._add_progress(len(data))
+                    if self.ingest is not None:
+                        self.ingest.feed(data)
+        finally:
+            response.close()
+
+    def run(self):
+        if self._probe() and self.size > 0:
+            self._download_ranges()
+        else:
+            self._download_single()
+
+        if self.size is not None and os.path.getsize(self.path) != self.size:
+            raise Exception, "Downloaded %d bytes instead of %d" % (os.path.getsize(self.path), self.size)
+
+        if os.path.isfile(self.statepath):
+            os.unlink(self.statepath)
+
+        if self.progress is not None:
+            self.progress(self.current, self.size or self.current)
+
+def list_complete_downloads(dirname):
+    """Lists files in dirname except unfinished downloads,
+    which have a DOWNLOAD_STATE_SUFFIX companion, and their state"""
+    files = os.listdir(dirname)
+    unfinished = set()
+    for filename in files:
+        for suffix in [DOWNLOAD_STATE_SUFFIX, "%s.tmp" % DOWNLOAD_STATE_SUFFIX]:
+            if filename.endswith(suffix):
+                unfinished.add(filename)
+                unfinished.add(filename[:-len(suffix)])
+
+    return [filename for filename in files if not filename in unfinished]
+
 def cmp_vmcores_first(str1, str2):
     vmcore1 = "vmcore" in str1.lower()
     vmcore2 = "vmcore" in str2.lower()
@@ -1263,6 +4217,7 @@ class RetraceTask:
     CRASH_CMD_FILE = "crash_cmd"
     DOWNLOADED_FILE = "downloaded"
     MD5SUM_FILE = "md5sum"
+    SHA256SUM_FILE = "sha256sum"
     FINISHED_FILE = "finished_time"
     KERNELVER_FILE = "kernelver"
     LOG_FILE = "retrace_log"
@@ -1323,6 +4278,7 @@ class RetraceTask:
             self.set_crash_cmd("crash")
             os.makedirs(os.path.join(self._savedir, RetraceTask.MISC_DIR))
             os.umask(oldmask)
+            self._update_catalog()
         else:
             # existing task
             self._taskid = int(taskid)
@@ -1345,6 +4301,13 @@ class RetraceTask:
         key_sanitized = key.replace("/", "_").replace(" ", "_")
         return os.path.join(self._savedir, key_sanitized)
 
+    def _update_catalog(self):
+        """Refreshes the task's row in the task catalog."""
+        try:
+            update_task_catalog(self)
+        except sqlite3.Error as ex:
+            log_warn("Unable to update task catalog for task %d: %s" % (self._taskid, ex))
+
     def _start_local(self, debug=False, kernelver=None, arch=None):
         cmdline = ["/usr/bin/retrace-server-worker", "%d" % self._taskid]
         if debug:
@@ -1360,6 +4323,16 @@ class RetraceTask:
 
         return call(cmdline)
 
+    def _start_daemon(self, debug=False, kernelver=None, arch=None, client=None):
+        try:
+            enqueue_task(self._taskid, debug=debug, kernelver=kernelver,
+                         arch=arch, client=client)
+        except (IOError, OSError) as ex:
+            log_error("Unable to queue task %d: %s" % (self._taskid, ex))
+            return 1
+
+        return 0
+
     def _start_remote(self, host, debug=False, kernelver=None, arch=None):
         starturl = "%s/%d/start" % (host, self._taskid)
         qs = {}
@@ -1395,7 +4368,9 @@ class RetraceTask:
         """Returns task's savedir"""
         return self._savedir
 
-    def start(self, debug=False, kernelver=None, arch=None):
+    def start(self, debug=False, kernelver=None, arch=None, client=None):
+        """Runs the task. Client (an IP address) is used to share
+        the queue fairly when retrace-server-workerd is used."""
         crashdir = os.path.join(self._savedir, "crash")
         if arch is None:
             if self.get_type() in [TASK_VMCORE, TASK_VMCORE_INTERACTIVE]:
@@ -1409,9 +4384,15 @@ class RetraceTask:
 
         ARCH_HOSTS = CONFIG.get_arch_hosts()
         if task_arch in ARCH_HOSTS:
+            # the remote host does its own admission control
+            release_task_slot(self._taskid)
             return self._start_remote(ARCH_HOSTS[task_arch], debug=debug,
                                       kernelver=kernelver, arch=arch)
 
+        if use_worker_daemon():
+            return self._start_daemon(debug=debug, kernelver=kernelver,
+                                      arch=arch, client=client)
+
         return self._start_local(debug=debug, kernelver=kernelver, arch=arch)
 
     def chgrp(self, key):
@@ -1489,11 +4470,7 @@ class RetraceTask:
         """Returns whether the task is running. Reads /proc if readproc=True
         otherwise just reads the STATUS_FILE."""
         if readproc:
-            for pid, taskid, ppid in get_running_tasks():
-                if taskid == self._taskid:
-                    return True
-
-            return False
+            return self._taskid in get_task_workers()
         else:
             return self.has_status() and not self.get_status() in [STATUS_SUCCESS, STATUS_FAIL]
 
@@ -1501,16 +4478,6 @@ class RetraceTask:
         """Returns the age of the task in hours."""
         return int(time.time() - os.path.getmtime(self._savedir)) / 3600
 
-    def calculate_md5(self, file_name, chunk_size = 65536):
-        hash_md5 = hashlib.md5()
-        with open(file_name, "rb") as f:
-            while True:
-                chunk = f.read(chunk_size)
-                if not chunk:
-                    break
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
-
     def get_type(self):
         """Returns task type. If TYPE_FILE is missing,
         task is considered standard TASK_RETRACE."""
@@ -1526,6 +4493,7 @@ class RetraceTask:
             newtype = TASK_RETRACE
 
         self.set_atomic(RetraceTask.TYPE_FILE, str(newtype))
+        self._update_catalog()
 
     def has_backtrace(self):
         """Verifies whether BACKTRACE_FILE is present in the task directory."""
@@ -1557,6 +4525,7 @@ class RetraceTask:
             mode = "a"
 
         self.set_atomic(RetraceTask.LOG_FILE, log, mode=mode)
+        self._update_catalog()
 
     def has_status(self):
         """Verifies whether STATUS_FILE is present in the task directory."""
@@ -1574,6 +4543,7 @@ class RetraceTask:
     def set_status(self, statuscode):
         """Atomically writes given statuscode into STATUS_FILE."""
         self.set_atomic(RetraceTask.STATUS_FILE, "%d" % statuscode)
+        self._update_catalog()
 
     def has_remote(self):
         """Verifies whether REMOTE_FILE is present in the task directory."""
@@ -1607,6 +4577,19 @@ class RetraceTask:
         """Atomically writes given value into KERNELVER_FILE."""
         self.set_atomic(RetraceTask.KERNELVER_FILE, value)
 
+    def read_kernelver(self, vmcore, crash_cmd=["crash"]):
+        """Returns KernelVer of the task's vmcore or None. It is
+        determined from the vmcore only once, then it is read
+        from KERNELVER_FILE."""
+        if self.has_kernelver():
+            return KernelVer(self.get_kernelver())
+
+        result = get_kernel_release(vmcore, crash_cmd)
+        if result is not None:
+            self.set_kernelver(str(result))
+
+        return result
+
     def has_notes(self):
         return self.has(RetraceTask.NOTES_FILE)
 
@@ -1649,18 +4632,20 @@ class RetraceTask:
     def set_vmlinux(self, value):
         self.set(RetraceTask.VMLINUX_FILE, value)
 
-    def download_block(self, data):
-        self._progress_write_func(data)
-        self._progress_current += len(data)
-        progress = "%d%% (%s / %s)" % ((100 * self._progress_current) / self._progress_total,
-                                       human_readable_size(self._progress_current),
-                                       self._progress_total_str)
+    def report_progress(self, current, total):
+        progress = "%d%% (%s / %s)" % ((100 * current) / max(total, 1),
+                                       human_readable_size(current),
+                                       human_readable_size(total))
         self.set_atomic(RetraceTask.PROGRESS_FILE, progress)
 
-    def prepare_debuginfo(self, vmcore, chroot=None, kernelver=None, crash_cmd=["crash"]):
+    def prepare_debuginfo(self, vmcore, chroot=None, kernelver=None, crash_cmd=["crash"], session=None):
+        """Prepares vmlinux and debuginfo of loaded modules, returns
+        the path to vmlinux. The list of modules is obtained from
+        session (CrashSession) if given, it is left running for
+        further commands."""
         log_info("Calling prepare_debuginfo with crash_cmd = " + str(crash_cmd))
         if kernelver is None:
-            kernelver = get_kernel_release(vmcore, crash_cmd)
+            kernelver = self.read_kernelver(vmcore, crash_cmd)
 
         if kernelver is None:
             raise Exception, "Unable to determine kernel version"
@@ -1695,110 +4680,146 @@ class RetraceTask:
             log_info("Unable to find cached vmlinux at path: " + vmlinux_cache_path)
             vmlinux = None
 
-        # For now, unconditionally search for kernel-debuginfo.  However, if the vmlinux
-        # file existed in the cache, don't raise an exception on the task since the vmcore
-        # may still be usable, and instead, return early.
-        # A second optimization would be to avoid this completely if the modules files
-        # all exist in the cache.
-        log_info("Searching for kernel-debuginfo package for " + str(kernelver))
-        debuginfo = find_kernel_debuginfo(kernelver)
-        if not debuginfo:
-            if vmlinux is not None:
-                self.set_vmlinux(vmlinux)
-                return vmlinux
-            else:
-                raise Exception, "Unable to find debuginfo package and no cached vmlinux file"
-
-        # FIXME: Merge kernel_path with this logic
-        if "EL" in kernelver.release:
-            if kernelver.flavour is None:
-                pattern = "EL/vmlinux"
+        # The list of debuginfo files is read from the package only once
+        # per kernel, following tasks only unpack the modules they miss
+        manifest_path = get_kernel_manifest_path(debugdir_base, kernel_path)
+        cache_lock = KernelCacheLock(debugdir_base, kernel_path)
+        # tasks of the same kernel wait for each other instead of
+        # unpacking the same files concurrently
+        with cache_lock:
+            manifest = read_kernel_manifest(manifest_path)
+            if manifest is None:
+                # If the vmlinux file existed in the cache, don't raise an exception
+                # on the task since the vmcore may still be usable, and instead,
+                # return early.
+                log_info("Searching for kernel-debuginfo package for " + str(kernelver))
+                debuginfo = find_kernel_debuginfo(kernelver)
+                if not debuginfo:
+                    if vmlinux is not None:
+                        # the caller runs further commands in the session
+                        if session is not None:
+                            session.vmlinux = vmlinux
+                            session.crash_cmd = crash_cmd
+                        self.set_vmlinux(vmlinux)
+                        return vmlinux
+                    else:
+                        raise Exception, "Unable to find debuginfo package and no cached vmlinux file"
+
+                # Now open the kernel-debuginfo and get a listing of the files we may need
+                vmlinux_path, debugfiles = list_kernel_debuginfo(debuginfo, kernelver)
+                manifest = { "debuginfo": debuginfo,
+                             "vmlinux": vmlinux_path,
+                             "modules": dict((module, { "path": path, "cached": False })
+                                             for module, path in debugfiles.items()),
+                             "tasks": 0,
+                             "complete": False,
+                             "extracting": None }
+                write_kernel_manifest(manifest_path, manifest)
             else:
-                pattern = "EL%s/vmlinux" % kernelver.flavour
-        else:
-            pattern = "/vmlinux"
-
-        # Now open the kernel-debuginfo and get a listing of the files we may need
-        vmlinux_path = None
-        debugfiles = {}
-        child = Popen(["rpm", "-qpl", debuginfo], stdout=PIPE)
-        lines = child.communicate()[0].splitlines()
-        for line in lines:
-            if line.endswith(pattern):
-                vmlinux_path = line
-                continue
-
-            match = KO_DEBUG_PARSER.match(line)
-            if not match:
-                continue
-
-            # only pick the correct flavour for el4
-            if "EL" in kernelver.release:
-                if kernelver.flavour is None:
-                    pattern2 = "EL/"
-                else:
-                    pattern2 = "EL%s/" % kernelver.flavour
-
-                if not pattern2 in os.path.dirname(line):
-                    continue
+                log_info("Using kernel manifest " + manifest_path)
 
-            # '-' in file name is transformed to '_' in module name
-            debugfiles[match.group(1).replace("-", "_")] = line
+            # Only look for the vmlinux file here if it's not already been found above
+            # Note the dependency from this code on the debuginfo file list
+            if vmlinux is None:
+                if manifest["vmlinux"] is None:
+                    raise Exception, "Kernel debuginfo does not contain vmlinux"
 
-        # Only look for the vmlinux file here if it's not already been found above
-        # Note the dependency from this code on the debuginfo file list
-        if vmlinux is None:
-            vmlinux_debuginfo = os.path.join(debugdir_base, vmlinux_path.lstrip("/"))
-            if os.path.isfile(vmlinux_debuginfo):
-                log_info("Found cached vmlinux at existing debuginfo location: " + vmlinux_debuginfo)
-                vmlinux = vmlinux_debuginfo
-            else:
-                cache_files_from_debuginfo(debuginfo, debugdir_base, [vmlinux_path])
+                vmlinux_debuginfo = os.path.join(debugdir_base, manifest["vmlinux"].lstrip("/"))
                 if os.path.isfile(vmlinux_debuginfo):
-                    log_info("Found cached vmlinux at new debuginfo location: " + vmlinux_debuginfo)
+                    log_info("Found cached vmlinux at existing debuginfo location: " + vmlinux_debuginfo)
                     vmlinux = vmlinux_debuginfo
                 else:
-                    raise Exception, "Failed vmlinux caching from debuginfo at location: " + vmlinux_debuginfo
+                    debuginfo = get_manifest_debuginfo(manifest, kernelver)
+                    if not debuginfo:
+                        raise Exception, "Unable to find debuginfo package and no cached vmlinux file"
+
+                    cache_files_from_debuginfo(debuginfo, debugdir_base, [manifest["vmlinux"]])
+                    if os.path.isfile(vmlinux_debuginfo):
+                        log_info("Found cached vmlinux at new debuginfo location: " + vmlinux_debuginfo)
+                        vmlinux = vmlinux_debuginfo
+                    else:
+                        raise Exception, "Failed vmlinux caching from debuginfo at location: " + vmlinux_debuginfo
 
         # Obtain the list of modules this vmcore requires
-        if chroot:
-            with open(os.devnull, "w") as null:
-                child = Popen(["/usr/bin/mock", "--configdir", chroot, "shell",
-                               "--", "crash -s %s %s" % (vmcore, vmlinux)],
-                              stdin=PIPE, stdout=PIPE, stderr=null)
+        close_session = False
+        if session is None:
+            session = CrashSession(vmcore, vmlinux, crash_cmd=crash_cmd, chroot=chroot)
+            close_session = True
         else:
-            child = Popen(crash_cmd + ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-        stdout = child.communicate("mod\nquit")[0]
-        if child.returncode == 1 and "el5" in kernelver.release:
-            log_info("Unable to list modules but el5 detected, trying crash fixup for vmss files")
-            crash_cmd.append("--machdep")
-            crash_cmd.append("phys_base=0x200000")
-            log_info("trying crash_cmd = " + str(crash_cmd))
-            child = Popen(crash_cmd + [ "-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            stdout = child.communicate("mod\nquit")[0]
-
-        # If we fail to get the list of modules, is the vmcore even usable?
-        if child.returncode:
-            log_warn("Unable to list modules: crash exited with %d:\n%s" % (child.returncode, stdout))
-            self.set_vmlinux(vmlinux)
-            return vmlinux
+            session.vmlinux = vmlinux
+            session.crash_cmd = crash_cmd
+
+        try:
+            stdout = session.run(["mod"])
+            if stdout is None and "el5" in kernelver.release:
+                log_info("Unable to list modules but el5 detected, trying crash fixup for vmss files")
+                crash_cmd.append("--machdep")
+                crash_cmd.append("phys_base=0x200000")
+                log_info("trying crash_cmd = " + str(crash_cmd))
+                stdout = session.run(["mod"])
+        finally:
+            if close_session:
+                session.close()
 
         modules = []
-        for line in stdout.splitlines():
-            # skip header
-            if "NAME" in line:
-                continue
+        if stdout is None:
+            # If we fail to get the list of modules, is the vmcore even usable?
+            log_warn("Unable to list modules: crash failed:\n%s" % session.leftover)
+        else:
+            for line in stdout.splitlines():
+                # skip header
+                if "NAME" in line:
+                    continue
+
+                if " " in line:
+                    modules.append(line.split()[1])
+
+        with cache_lock:
+            # another task or the background extraction may have updated it
+            current = read_kernel_manifest(manifest_path)
+            if current is not None:
+                manifest = current
+
+            todo = []
+            for module in modules:
+                entry = manifest["modules"].get(module)
+                if entry is None or entry["cached"]:
+                    continue
 
-            if " " in line:
-                modules.append(line.split()[1])
+                if os.path.isfile(os.path.join(debugdir_base, entry["path"].lstrip("/"))):
+                    entry["cached"] = True
+                else:
+                    todo.append(entry)
+
+            if todo:
+                debuginfo = get_manifest_debuginfo(manifest, kernelver)
+                if debuginfo:
+                    cache_files_from_debuginfo(debuginfo, debugdir_base, [entry["path"] for entry in todo])
+                    for entry in todo:
+                        entry["cached"] = os.path.isfile(os.path.join(debugdir_base, entry["path"].lstrip("/")))
+                else:
+                    log_warn("Unable to find debuginfo package, %d modules are missing" % len(todo))
+
+            manifest["tasks"] += 1
+            extract_all = CONFIG["KernelExtractAllTasks"] > 0 and not manifest["complete"] and \
+                          manifest["tasks"] >= CONFIG["KernelExtractAllTasks"] and \
+                          (not manifest["extracting"] or
+                           manifest["extracting"] + KERNEL_EXTRACT_TIMEOUT < time.time())
+            if extract_all:
+                extract_all = get_manifest_debuginfo(manifest, kernelver)
+                if extract_all:
+                    manifest["extracting"] = int(time.time())
 
-        todo = []
-        for module in modules:
-            if module in debugfiles and \
-               not os.path.isfile(os.path.join(debugdir_base, debugfiles[module].lstrip("/"))):
-                todo.append(debugfiles[module])
+            try:
+                write_kernel_manifest(manifest_path, manifest)
+            except (IOError, OSError) as ex:
+                log_warn("Unable to write kernel manifest %s: %s" % (manifest_path, ex))
+                extract_all = False
 
-        cache_files_from_debuginfo(debuginfo, debugdir_base, todo)
+        # not under the lock, the helper takes it to publish the files
+        if extract_all:
+            log_info("Unpacking whole %s in background" % manifest["debuginfo"])
+            extract_kernel_debuginfo_background(manifest["debuginfo"], debugdir_base, kernel_path)
 
         self.set_vmlinux(vmlinux)
         return vmlinux
@@ -1823,6 +4844,7 @@ class RetraceTask:
     def download_remote(self, unpack=True, timeout=0, kernelver=None):
         """Downloads all remote resources and returns a list of errors."""
         md5sums = []
+        sha256sums = []
         downloaded = []
         errors = []
 
@@ -1832,6 +4854,17 @@ class RetraceTask:
             os.makedirs(crashdir)
             os.umask(oldmask)
 
+        checksums = []
+        if self.has_md5sum():
+            checksums.append("md5")
+            if CONFIG["DownloadSha256"]:
+                checksums.append("sha256")
+
+        # vmcore archives are unpacked while they are being downloaded
+        unpackdir = None
+        if unpack and self.get_type() in [TASK_VMCORE, TASK_VMCORE_INTERACTIVE]:
+            unpackdir = crashdir
+
         for url in self.get_remote():
             self.set_status(STATUS_DOWNLOADING)
             log_info(STATUS[STATUS_DOWNLOADING])
@@ -1840,27 +4873,17 @@ class RetraceTask:
                 filename = url[4:].strip()
                 log_info("Retrieving FTP file '%s'" % filename)
 
-                ftp = None
+                ingest = DownloadIngest(filename, checksums, unpackdir)
                 try:
-                    ftp = ftp_init()
-                    with open(os.path.join(crashdir, filename), "wb") as target_file:
-                        self._progress_write_func = target_file.write
-                        self._progress_total = ftp.size(filename)
-                        self._progress_total_str = human_readable_size(self._progress_total)
-                        self._progress_current = 0
-
-                        # the files are expected to be huge (even hundreds of gigabytes)
-                        # use a larger buffer - 16MB by default
-                        ftp.retrbinary("RETR %s" % filename, self.download_block,
-                                       CONFIG["FTPBufferSize"] * (1 << 20))
-
+                    # the files are expected to be huge (even hundreds of gigabytes)
+                    FtpDownload(get_ftp_pool(), filename, os.path.join(crashdir, filename),
+                                segments=CONFIG["FTPSegments"], progress=self.report_progress,
+                                ingest=ingest).run()
                     downloaded.append(filename)
                 except Exception as ex:
+                    ingest.abort()
                     errors.append((url, str(ex)))
                     continue
-                finally:
-                    if ftp:
-                        ftp_close(ftp)
             elif url.startswith("/") or url.startswith("file:///"):
                 if url.startswith("file://"):
                     url = url[7:]
@@ -1873,6 +4896,7 @@ class RetraceTask:
 
                 filename = os.path.basename(url)
                 targetfile = os.path.join(crashdir, filename)
+                ingest = DownloadIngest(filename, checksums, unpackdir)
 
                 copy = True
                 if get_archive_type(url) == ARCHIVE_UNKNOWN:
@@ -1884,13 +4908,25 @@ class RetraceTask:
                     except:
                         log_debug("Failed")
 
-                if copy:
-                    try:
+                try:
+                    if copy:
                         log_debug("Copying")
-                        shutil.copy(url, targetfile)
-                    except Exception as ex:
-                        errors.append((url, str(ex)))
-                        continue
+                        with open(url, "rb") as source:
+                            with open(targetfile, "wb") as target:
+                                while True:
+                                    data = source.read(UNPACK_CHUNK_SIZE)
+                                    if not data:
+                                        break
+
+                                    target.write(data)
+                                    ingest.feed(data)
+                        shutil.copymode(url, targetfile)
+                    elif checksums:
+                        ingest.feed_file(targetfile)
+                except Exception as ex:
+                    ingest.abort()
+                    errors.append((url, str(ex)))
+                    continue
 
                 downloaded.append(url)
             else:
@@ -1900,34 +4936,64 @@ class RetraceTask:
                     errors.append((url, "malformed URL"))
                     continue
 
-                child = Popen(["wget", "-nv", "-P", crashdir, url], stdout=PIPE, stderr=STDOUT)
-                stdout = child.communicate()[0]
-                if child.wait():
-                    errors.append((url, "wget exitted with %d: %s" % (child.returncode, stdout)))
-                    continue
-
                 filename = url.rsplit("/", 1)[1]
+                ingest = DownloadIngest(filename, checksums, unpackdir)
+                if url.startswith("http://") or url.startswith("https://"):
+                    if not filename:
+                        errors.append((url, "malformed URL"))
+                        continue
+
+                    try:
+                        RangedDownload(url, os.path.join(crashdir, filename),
+                                       connections=CONFIG["DownloadConnections"],
+                                       chunksize=CONFIG["DownloadChunkSize"] << 20,
+                                       progress=self.report_progress,
+                                       ingest=ingest).run()
+                    except Exception as ex:
+                        ingest.abort()
+                        errors.append((url, str(ex)))
+                        continue
+                else:
+                    child = Popen(["wget", "-nv", "-P", crashdir, url], stdout=PIPE, stderr=STDOUT)
+                    stdout = child.communicate()[0]
+                    if child.wait():
+                        errors.append((url, "wget exitted with %d: %s" % (child.returncode, stdout)))
+                        continue
+
+                    ingest.feed_file(os.path.join(crashdir, filename))
+
                 downloaded.append(url)
 
-            if self.has_md5sum():
-                self.set_status(STATUS_CALCULATING_MD5SUM)
-                log_info(STATUS[STATUS_CALCULATING_MD5SUM])
-                md5v = self.calculate_md5(os.path.join(crashdir, filename))
-                md5sums.append("{0} {1}".format(md5v, downloaded[-1]))
+            fullpath = os.path.join(crashdir, filename)
+            try:
+                unpacked = ingest.finish()
+            except Exception as ex:
+                errors.append((fullpath, str(ex)))
+                continue
+
+            if checksums:
+                md5sums.append("{0} {1}".format(ingest.hexdigest("md5"), downloaded[-1]))
+                if "sha256" in checksums:
+                    sha256sums.append("{0} {1}".format(ingest.hexdigest("sha256"), downloaded[-1]))
 
             self.set_status(STATUS_POSTPROCESS)
             log_info(STATUS[STATUS_POSTPROCESS])
 
-            if unpack:
-                fullpath = os.path.join(crashdir, filename)
+            if unpacked is not None:
+                os.unlink(fullpath)
+                try:
+                    select_vmcore(unpacked)
+                except Exception as ex:
+                    errors.append((fullpath, str(ex)))
+            elif unpack:
                 if self.get_type() in [TASK_VMCORE, TASK_VMCORE_INTERACTIVE]:
                     try:
-                        unpack_vmcore(fullpath)
+                        unpack_vmcore(fullpath, progress=self.report_progress)
                     except Exception as ex:
                         errors.append((fullpath, str(ex)))
                 if self.get_type() in [TASK_RETRACE, TASK_RETRACE_INTERACTIVE]:
                     try:
-                        unpack_coredump(fullpath)
+                        unpack_coredump(fullpath, progress=self.report_progress)
                     except Exception as ex:
                         errors.append((fullpath, str(ex)))
 
@@ -1939,7 +5005,7 @@ class RetraceTask:
                 if os.path.isdir(fullpath):
                     move_dir_contents(fullpath, crashdir)
 
-            files = os.listdir(crashdir)
+            files = list_complete_downloads(crashdir)
             if len(files) < 1:
                 errors.append(([], "No files found in the tarball"))
             elif len(files) == 1:
@@ -1968,7 +5034,8 @@ class RetraceTask:
                             if vmcores[0] != "vmcore":
                                 os.rename(os.path.join(crashdir, filename), vmcore)
 
-            files = os.listdir(crashdir)
+            # unfinished downloads are kept to be resumed
+            files = list_complete_downloads(crashdir)
             for filename in files:
                 if filename == "vmcore":
                     continue
@@ -2073,6 +5140,9 @@ class RetraceTask:
         os.unlink(os.path.join(self._savedir, RetraceTask.REMOTE_FILE))
         if md5sums:
             self.set_md5sum("\n".join(md5sums)+"\n")
+
+        if sha256sums:
+            self.set_sha256sum("\n".join(sha256sums)+"\n")
         self.set_downloaded(", ".join(downloaded))
 
         return errors
@@ -2121,8 +5191,14 @@ class RetraceTask:
         miscdir = os.path.join(self._savedir, RetraceTask.MISC_DIR)
         if not os.path.isdir(miscdir):
             oldmask = os.umask(0007)
-            os.makedirs(miscdir)
-            os.umask(oldmask)
+            try:
+                os.makedirs(miscdir)
+            except OSError as ex:
+                # vmcore commands running in parallel
+                if ex.errno != errno.EEXIST:
+                    raise
+            finally:
+                os.umask(oldmask)
 
         miscpath = os.path.join(miscdir, name)
         with open(miscpath, "w") as misc_file:
@@ -2155,6 +5231,8 @@ class RetraceTask:
         elif not managed and self.has(RetraceTask.MANAGED_FILE):
             self.delete(RetraceTask.MANAGED_FILE)
 
+        self._update_catalog()
+
     def has_downloaded(self):
         """Verifies whether DOWNLOAD_FILE exists"""
         return self.has(RetraceTask.DOWNLOADED_FILE)
@@ -2179,6 +5257,18 @@ class RetraceTask:
         """Writes (not atomically) content to MD5SUM_FILE"""
         self.set(RetraceTask.MD5SUM_FILE, value)
 
+    def has_sha256sum(self):
+        """Verifies whether SHA256SUM_FILE exists"""
+        return self.has(RetraceTask.SHA256SUM_FILE)
+
+    def get_sha256sum(self):
+        """Gets contents of SHA256SUM_FILE"""
+        return self.get(RetraceTask.SHA256SUM_FILE, maxlen=1 << 22)
+
+    def set_sha256sum(self, value):
+        """Writes (not atomically) content to SHA256SUM_FILE"""
+        self.set(RetraceTask.SHA256SUM_FILE, value)
+
     def has_crashrc(self):
         """Verifies whether CRASHRC_FILE exists"""
         return self.has(RetraceTask.CRASHRC_FILE)
@@ -2339,6 +5429,8 @@ class RetraceTask:
         if os.path.isdir(kerneldir):
             shutil.rmtree(kerneldir)
 
+        self._update_catalog()
+
     def remove(self):
         """Completely removes the task directory."""
         self.clean()
@@ -2347,6 +5439,12 @@ class RetraceTask:
             shutil.rmtree(kerneldir)
 
         shutil.rmtree(self._savedir)
+        release_task_slot(self._taskid)
+
+        try:
+            remove_from_task_catalog(self._taskid)
+        except sqlite3.Error as ex:
+            log_warn("Unable to remove task %d from task catalog: %s" % (self._taskid, ex))
 
     def create_worker(self):
         """Get default worker instance for this task"""
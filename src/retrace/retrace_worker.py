@@ -1,8 +1,12 @@
 import grp
 import time
 import sys
+import threading
+import Queue
 sys.path.insert(0, "/usr/share/retrace-server/")
 from retrace import *
+from resolver import resolve_coredump_packages
+from btfilter import BacktraceFilter
 
 CONFIG = Config()
 
@@ -17,6 +21,8 @@ class RetraceWorker(object):
         if self.logging_handler is None:
             self.logging_handler = logging.FileHandler(
                 self.task._get_file_path(RetraceTask.LOG_FILE))
+            # the handler has just created LOG_FILE
+            self.task._update_catalog()
         logger.addHandler(self.logging_handler)
 
     def end_logging(self):
@@ -291,59 +297,72 @@ class RetraceWorker(object):
         else:
             # read required packages from coredump
             try:
-                repoid = "%s%s" % (REPO_PREFIX, releaseid)
-                yumcfgpath = os.path.join(self.task.get_savedir(), "yum.conf")
-                with open(yumcfgpath, "w") as yumcfg:
-                    yumcfg.write("[%s]\n" % repoid)
-                    yumcfg.write("name=%s\n" % releaseid)
-                    yumcfg.write("baseurl=file://%s/%s/\n" % (CONFIG["RepoDir"], releaseid))
-                    yumcfg.write("failovermethod=priority\n")
-                child = Popen(["coredump2packages", os.path.join(crashdir, "coredump"),
-                               "--repos=%s" % repoid, "--config=%s" % yumcfgpath,
-                               "--log=%s" % os.path.join(self.task.get_savedir(), "c2p_log")],
-                              stdout=PIPE, stderr=PIPE)
-                section = 0
-                crash_package_or_component = None
-                stdout, stderr = child.communicate()
-                lines = stdout.split("\n")
+                with open(os.path.join(self.task.get_savedir(), "c2p_log"), "w") as c2plog:
+                    crash_package_or_component, found, notfound = \
+                        resolve_coredump_packages(os.path.join(crashdir, "coredump"),
+                                                  releaseid, log=c2plog)
+
                 libdb = False
-                for line in lines:
-                    if line == "":
-                        section += 1
-                        continue
-                    elif 0 == section:
-                        crash_package_or_component = line.strip()
-                    elif 1 == section:
-                        stripped = line.strip()
-
-                        # hack - help to depsolver, yum would fail otherwise
-                        if distribution == "fedora" and stripped.startswith("gnome"):
-                            packages.append("desktop-backgrounds-gnome")
-
-                        # hack - libdb-debuginfo and db4-debuginfo are conflicting
-                        if distribution == "fedora" and \
-                           (stripped.startswith("db4-debuginfo") or \
-                            stripped.startswith("libdb-debuginfo")):
-                            if libdb:
-                                continue
-                            else:
-                                libdb = True
-
-                        packages.append(stripped)
-                    elif 2 == section:
-                        soname, buildid = line.strip().split(" ", 1)
-                        if not soname or soname == "-":
-                            soname = None
-                        missing.append((soname, buildid))
-
-                if stderr:
-                    log_warn(stderr)
+                for stripped in found:
+                    # hack - help to depsolver, yum would fail otherwise
+                    if distribution == "fedora" and stripped.startswith("gnome"):
+                        packages.append("desktop-backgrounds-gnome")
+
+                    # hack - libdb-debuginfo and db4-debuginfo are conflicting
+                    if distribution == "fedora" and \
+                       (stripped.startswith("db4-debuginfo") or \
+                        stripped.startswith("libdb-debuginfo")):
+                        if libdb:
+                            continue
+                        else:
+                            libdb = True
+
+                    packages.append(stripped)
+
+                for soname, buildid in notfound:
+                    if not soname or soname == "-":
+                        soname = None
+                    missing.append((soname, buildid))
 
             except Exception as ex:
                 log_error("Unable to obtain packages from 'coredump' file: %s" % ex)
                 self._fail()
         return (packages, missing, fafrepo)
 
+    def store_debuginfos(self, releaseid, packages):
+        """Puts debuginfo packages into the shared debuginfo store.
+        Returns the packages that still need to be installed."""
+        result = []
+        hits = 0
+        misses = 0
+        for package in packages:
+            if not is_debuginfo_package(package):
+                result.append(package)
+                continue
+
+            rpmpath = find_repo_package(releaseid, package)
+            if rpmpath is None:
+                log_debug("%s is not in the local repository, installing" % package)
+                result.append(package)
+                continue
+
+            try:
+                if store_debuginfo(package, rpmpath):
+                    hits += 1
+                else:
+                    misses += 1
+            except Exception as ex:
+                log_warn("Unable to store %s: %s" % (package, ex))
+                result.append(package)
+
+        log_info("Debuginfo store: %d hits, %d misses" % (hits, misses))
+        try:
+            save_crashstats_debuginfostore(hits, misses)
+        except Exception as ex:
+            log_warn("Failed to save debuginfo store statistics: %s" % ex)
+
+        return result
+
     def start_retrace(self, custom_arch=None):
         self.hook_start()
 
@@ -385,54 +404,21 @@ class RetraceWorker(object):
         self.hook_pre_prepare_mock()
 
         # create mock config file
+        binds = [(crashdir, "/var/spool/abrt/crash")]
+        if CONFIG["UseFafPackages"]:
+            binds.append((self.fafrepo, "/packages"))
+
+        install = packages
+        debugdirs = None
+        if CONFIG["UseDebuginfoStore"]:
+            install = self.store_debuginfos(releaseid, packages)
+            binds.append((get_debuginfo_store_tree(), DEBUGINFO_STORE_MOUNT))
+            debugdirs = [DEBUGINFO_STORE_MOUNT]
+
         try:
-            with open(os.path.join(task.get_savedir(), RetraceTask.MOCK_DEFAULT_CFG), "w") as mockcfg:
-                mockcfg.write("config_opts['root'] = '%d'\n" % task.get_taskid())
-                mockcfg.write("config_opts['target_arch'] = '%s'\n" % arch)
-                mockcfg.write("config_opts['chroot_setup_cmd'] = '--skip-broken install %s abrt-addon-ccpp shadow-utils %s rpm'\n" % (" ".join(packages),
-                    self.plugin.gdb_package))
-                mockcfg.write("config_opts['plugin_conf']['ccache_enable'] = False\n")
-                mockcfg.write("config_opts['plugin_conf']['yum_cache_enable'] = False\n")
-                mockcfg.write("config_opts['plugin_conf']['root_cache_enable'] = False\n")
-                mockcfg.write("config_opts['plugin_conf']['bind_mount_enable'] = True\n")
-                mockcfg.write("config_opts['plugin_conf']['bind_mount_opts'] = { 'create_dirs': True,\n")
-                mockcfg.write("    'dirs': [\n")
-                mockcfg.write("              ('%s', '/var/spool/abrt/crash'),\n" % crashdir)
-                if CONFIG["UseFafPackages"]:
-                    mockcfg.write("              ('%s', '/packages'),\n" % self.fafrepo)
-                mockcfg.write("            ] }\n")
-                mockcfg.write("\n")
-                mockcfg.write("config_opts['yum.conf'] = \"\"\"\n")
-                mockcfg.write("[main]\n")
-                mockcfg.write("cachedir=/var/cache/yum\n")
-                mockcfg.write("debuglevel=1\n")
-                mockcfg.write("reposdir=%s\n" % os.devnull)
-                mockcfg.write("logfile=/var/log/yum.log\n")
-                mockcfg.write("retries=20\n")
-                mockcfg.write("obsoletes=1\n")
-                if version != "rawhide" and CONFIG["RequireGPGCheck"]:
-                    mockcfg.write("gpgcheck=1\n")
-                else:
-                    mockcfg.write("gpgcheck=0\n")
-                mockcfg.write("assumeyes=1\n")
-                mockcfg.write("syslog_ident=mock\n")
-                mockcfg.write("syslog_device=\n")
-                mockcfg.write("\n")
-                mockcfg.write("#repos\n")
-                mockcfg.write("\n")
-                mockcfg.write("[%s]\n" % distribution)
-                mockcfg.write("name=%s\n" % releaseid)
-                mockcfg.write("baseurl=file://%s/%s/\n" % (CONFIG["RepoDir"], releaseid))
-                mockcfg.write("failovermethod=priority\n")
-                if version != "rawhide" and CONFIG["RequireGPGCheck"]:
-                    mockcfg.write("gpgkey=file:///usr/share/retrace-server/gpg/%s-%s\n" % (distribution, version))
-                mockcfg.write("\"\"\"\n")
-
-            # symlink defaults from /etc/mock
-            os.symlink("/etc/mock/site-defaults.cfg",
-                       os.path.join(task.get_savedir(), RetraceTask.MOCK_SITE_DEFAULTS_CFG))
-            os.symlink("/etc/mock/logging.ini",
-                       os.path.join(task.get_savedir(), RetraceTask.MOCK_LOGGING_INI))
+            write_mock_config(task.get_savedir(), "%d" % task.get_taskid(),
+                              distribution, version, arch, self.plugin.gdb_package,
+                              packages=install, binds=binds)
         except Exception as ex:
             log_error("Unable to create mock config file: %s" % ex)
             self._fail()
@@ -443,6 +429,11 @@ class RetraceWorker(object):
 
         self._retrace_run(25, ["/usr/bin/mock", "init", "--resultdir", task.get_savedir() + "/log", "--configdir", task.get_savedir()])
 
+        if CONFIG["UseChrootCache"] and install:
+            # the cached template only contains the base packages
+            self._retrace_run(28, ["/usr/bin/mock", "--configdir", task.get_savedir(),
+                                   "install"] + install)
+
         self.hook_post_prepare_mock()
         self.hook_pre_retrace()
 
@@ -458,7 +449,7 @@ class RetraceWorker(object):
         log_info(STATUS[STATUS_BACKTRACE])
 
         try:
-            backtrace, exploitable = run_gdb(task.get_savedir(), self.plugin)
+            backtrace, exploitable = run_gdb(task.get_savedir(), self.plugin, debugdirs)
         except Exception as ex:
             log_error(str(ex))
             self._fail()
@@ -495,13 +486,14 @@ class RetraceWorker(object):
         self.stats["status"] = STATUS_SUCCESS
 
         try:
-            con = init_crashstats_db()
-            statsid = save_crashstats(self.stats, con)
-            save_crashstats_success(statsid, self.prerunning, len(get_active_tasks()), rootsize, con)
-            save_crashstats_packages(statsid, packages[1:], con)
-            if missing:
-                save_crashstats_build_ids(statsid, missing, con)
-            con.close()
+            con = get_crashstats_db()
+            # a single transaction
+            with con:
+                statsid = save_crashstats(self.stats, con)
+                save_crashstats_success(statsid, self.prerunning, len(get_active_tasks()), rootsize, con)
+                save_crashstats_packages(statsid, packages[1:], con)
+                if missing:
+                    save_crashstats_build_ids(statsid, missing, con)
         except Exception as ex:
             log_warn(str(ex))
 
@@ -527,6 +519,94 @@ class RetraceWorker(object):
 
         return None
 
+    def run_crash_commands(self, session, save):
+        """Runs the kernel log and vmcore commands (see get_vmcore_commands)
+        in the crash session. Up to VmcoreCrashSessions lines of
+        [vmcorecommands] run in parallel, each in its own session.
+        save(name, output) is called as soon as a line finishes, possibly
+        from another thread. Returns the kernel log."""
+        kernellog = session.run(["log"])
+        if kernellog is None:
+            # the log is often readable even if crash can not fully initialize
+            log_warn("crash failed, reading the log in minimal mode")
+            minimal = CrashSession(session.vmcore, session.vmlinux, crash_cmd=session.crash_cmd,
+                                   chroot=session.chroot, minimal=True)
+            try:
+                kernellog = minimal.run(["log"])
+            finally:
+                minimal.close()
+
+            if kernellog is None:
+                log_warn("crash 'log' failed")
+                kernellog = minimal.leftover
+
+        groups = Queue.Queue()
+        for group in get_vmcore_commands():
+            groups.put(group)
+
+        def run_groups(session):
+            while True:
+                try:
+                    name, commands = groups.get_nowait()
+                except Queue.Empty:
+                    return
+
+                bt_filter = None
+                consumer = None
+                if name == "bt-filter":
+                    # grouped while crash produces the output
+                    bt_filter = BacktraceFilter()
+                    consumer = bt_filter.feed
+
+                output = session.run(commands, timeout=CONFIG["VmcoreCommandTimeout"],
+                                     consumer=consumer)
+                if output is None:
+                    if session.stuck:
+                        # the session keeps its CPU, no new crash is started
+                        log_error("crash '%s' timed out after %d seconds and could not be killed, "
+                                  "giving up the remaining commands in this session" %
+                                  ("; ".join(commands), CONFIG["VmcoreCommandTimeout"]))
+                        return
+                    elif session.timed_out:
+                        log_warn("crash '%s' timed out after %d seconds" %
+                                 ("; ".join(commands), CONFIG["VmcoreCommandTimeout"]))
+                    else:
+                        log_warn("crash '%s' failed:\n%s" % ("; ".join(commands), session.leftover))
+                    continue
+
+                if bt_filter is not None:
+                    output = bt_filter.report()
+
+                try:
+                    save(name, output)
+                except Exception as ex:
+                    log_warn("Unable to save '%s': %s" % (name, ex))
+
+        def run_groups_in_new_session():
+            own = CrashSession(session.vmcore, session.vmlinux, crash_cmd=session.crash_cmd,
+                               chroot=session.chroot)
+            try:
+                run_groups(own)
+            finally:
+                own.close()
+
+        threads = []
+        for i in xrange(min(CONFIG["VmcoreCrashSessions"], groups.qsize()) - 1):
+            thread = threading.Thread(target=run_groups_in_new_session)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        run_groups(session)
+        for thread in threads:
+            thread.join()
+
+        return kernellog
+
+    def save_crash_output(self, name, output):
+        if output:
+            self.task.add_misc(name, output)
+
     def start_vmcore(self, custom_kernelver=None):
         self.hook_start()
 
@@ -543,7 +623,7 @@ class RetraceWorker(object):
             kernelver = custom_kernelver
             kernelver_str = custom_kernelver.kernelver_str
         else:
-            kernelver = get_kernel_release(vmcore, task.get_crash_cmd().split())
+            kernelver = task.read_kernelver(vmcore, task.get_crash_cmd().split())
             if not kernelver:
                 raise Exception("Unable to determine kernel version")
 
@@ -640,87 +720,31 @@ class RetraceWorker(object):
             self.hook_post_prepare_mock()
 
             # no locks required, mock locks itself
+            session = CrashSession(vmcore, None, crash_cmd=task.get_crash_cmd().split(), chroot=cfgdir)
             try:
                 self.hook_pre_prepare_debuginfo()
-                vmlinux = task.prepare_debuginfo(vmcore, cfgdir, kernelver=kernelver, crash_cmd=task.get_crash_cmd().split())
+                vmlinux = task.prepare_debuginfo(vmcore, cfgdir, kernelver=kernelver,
+                                                 crash_cmd=session.crash_cmd, session=session)
                 self.hook_post_prepare_debuginfo()
 
                 self.hook_pre_retrace()
-                # generate the log
-                with open(os.devnull, "w") as null:
-                    child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                   "crash --minimal -s %s %s" % (vmcore, vmlinux)],
-                                  stdin=PIPE, stdout=PIPE, stderr=null)
-                    kernellog = child.communicate("log\nquit\n")[0]
-                    if child.wait():
-                        log_warn("crash 'log' exitted with %d" % child.returncode)
-
-                    child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                   "crash -s %s %s" % (vmcore, vmlinux)], stdin=PIPE, stdout=PIPE, stderr=null)
-                    crash_bt_a = child.communicate("set hex\nbt -a\nquit\n")[0]
-                    if child.wait():
-                        log_warn("crash 'bt -a' exitted with %d" % child.returncode)
-                        crash_bt_a = None
-
-                    crash_kmem_f = None
-                    if CONFIG["VmcoreRunKmem"] == 1:
-                        child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                       "crash -s %s %s" % (vmcore, vmlinux)], stdin=PIPE, stdout=PIPE, stderr=null)
-                        crash_kmem_f = child.communicate("kmem -f\nquit\n")[0]
-                        if child.wait():
-                            log_warn("crash 'kmem -f' exitted with %d" % child.returncode)
-                            crash_kmem_f = None
-
-                    if CONFIG["VmcoreRunKmem"] == 2:
-                        child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                       "crash -s %s %s" % (vmcore, vmlinux)], stdin=PIPE, stdout=PIPE, stderr=null)
-                        crash_kmem_f = child.communicate("set hash off\nkmem -f\nset hash on\nquit\n")[0]
-                        if child.wait():
-                            log_warn("crash 'kmem -f' exitted with %d" % child.returncode)
-                            crash_kmem_f = None
-
-                    crash_kmem_z = None
-                    if CONFIG["VmcoreRunKmem"] == 3:
-                        child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                       "crash -s %s %s" % (vmcore, vmlinux)], stdin=PIPE, stdout=PIPE, stderr=null)
-                        crash_kmem_z = child.communicate("kmem -z\nquit\n")[0]
-                        if child.wait():
-                            log_warn("crash 'kmem -z' exitted with %d" % child.returncode)
-                            crash_kmem_z = None
-
-                    child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                   "crash -s %s %s" % (vmcore, vmlinux)], stdin=PIPE, stdout=PIPE, stderr=null)
-                    crash_sys = child.communicate("sys\nquit\n")[0]
-                    if child.wait():
-                        log_warn("crash 'sys' exitted with %d" % child.returncode)
-                        crash_sys = None
-
-                    child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                   "crash -s %s %s" % (vmcore, vmlinux)], stdin=PIPE, stdout=PIPE, stderr=null)
-                    crash_sys_c = child.communicate("sys -c\nquit\n")[0]
-                    if child.wait():
-                        log_warn("crash 'sys -c' exitted with %d" % child.returncode)
-                        crash_sys_c = None
-
-                    child = Popen(["/usr/bin/mock", "--configdir", cfgdir, "shell", "--",
-                                   "crash -s %s %s" % (vmcore, vmlinux)], stdin=PIPE, stdout=PIPE, stderr=null)
-                    crash_foreach_bt = child.communicate("set hex\nforeach bt\nquit\n")[0]
-                    if child.wait():
-                        log_warn("crash 'foreach bt' exitted with %d" % child.returncode)
-                        crash_foreach_bt = None
-
+                kernellog = self.run_crash_commands(session, self.save_crash_output)
             except Exception as ex:
                 log_error(str(ex))
                 self._fail()
+            finally:
+                session.close()
 
         else:
+            session = CrashSession(vmcore, None, crash_cmd=task.get_crash_cmd().split())
             try:
                 self.hook_pre_prepare_debuginfo()
-                crash_cmd = task.get_crash_cmd().split()
-                vmlinux = task.prepare_debuginfo(vmcore, kernelver=kernelver, crash_cmd=crash_cmd)
-                task.set_crash_cmd(' '.join(crash_cmd))
+                vmlinux = task.prepare_debuginfo(vmcore, kernelver=kernelver,
+                                                 crash_cmd=session.crash_cmd, session=session)
+                task.set_crash_cmd(' '.join(session.crash_cmd))
                 self.hook_post_prepare_debuginfo()
             except Exception as ex:
+                session.close()
                 log_error("prepare_debuginfo failed: %s" % str(ex))
                 self._fail()
 
@@ -728,76 +752,12 @@ class RetraceWorker(object):
             task.set_status(STATUS_BACKTRACE)
             log_info(STATUS[STATUS_BACKTRACE])
 
-            child = Popen(task.get_crash_cmd().split() + ["--minimal", "-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            kernellog = child.communicate("log\nquit\n")[0]
-            if child.wait():
-                log_warn("crash 'log' exited with %d" % child.returncode)
-
-            child = Popen(task.get_crash_cmd().split() + ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            crash_bt_a = child.communicate("set hex\nbt -a\nquit\n")[0]
-            if child.wait():
-                log_warn("crash 'bt -a' exited with %d" % child.returncode)
-                crash_bt_a = None
-
-            crash_kmem_f = None
-            if CONFIG["VmcoreRunKmem"] == 1:
-                child = Popen(task.get_crash_cmd().split() + ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-                crash_kmem_f = child.communicate("kmem -f\nquit\n")[0]
-                if child.wait():
-                    log_warn("crash 'kmem -f' exited with %d" % child.returncode)
-                    crash_kmem_f = None
-
-            if CONFIG["VmcoreRunKmem"] == 2:
-                child = Popen(task.get_crash_cmd().split() + ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-                crash_kmem_f = child.communicate("set hash off\nkmem -f\nset hash on\nquit\n")[0]
-                if child.wait():
-                    log_warn("crash 'kmem -f' exited with %d" % child.returncode)
-                    crash_kmem_f = None
-
-            crash_kmem_z = None
-            if CONFIG["VmcoreRunKmem"] == 3:
-                child = Popen(task.get_crash_cmd().split() + ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-                crash_kmem_z = child.communicate("kmem -z\nquit\n")[0]
-                if child.wait():
-                    log_warn("crash 'kmem -z' exited with %d" % child.returncode)
-                    crash_kmem_z = None
-
-            child = Popen(task.get_crash_cmd().split() +  ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            crash_sys = child.communicate("sys\nquit\n")[0]
-            if child.wait():
-                log_warn("crash 'sys' exited with %d" % child.returncode)
-                crash_sys = None
-
-            child = Popen(task.get_crash_cmd().split() + ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            crash_sys_c = child.communicate("sys -c\nquit\n")[0]
-            if child.wait():
-                log_warn("crash 'sys -c' exited with %d" % child.returncode)
-                crash_sys_c = None
-
-            child = Popen(task.get_crash_cmd().split() + ["-s", vmcore, vmlinux], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            crash_foreach_bt = child.communicate("set hex\nforeach bt\nquit\n")[0]
-            if child.wait():
-                log_warn("crash 'foreach bt' exited with %d" % child.returncode)
-                crash_foreach_bt = None
+            try:
+                kernellog = self.run_crash_commands(session, self.save_crash_output)
+            finally:
+                session.close()
 
         task.set_backtrace(kernellog)
-        if crash_bt_a:
-            task.add_misc("bt-a", crash_bt_a)
-        if crash_kmem_f:
-            task.add_misc("kmem-f", crash_kmem_f)
-        if crash_kmem_z:
-            task.add_misc("kmem-z", crash_kmem_z)
-        if crash_sys:
-            task.add_misc("sys", crash_sys)
-        if crash_sys_c:
-            task.add_misc("sys-c", crash_sys_c)
-        if crash_foreach_bt:
-            child = Popen(["bt_filter"], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            bt_filter = child.communicate(crash_foreach_bt)[0]
-            if child.wait():
-                bt_filter = "bt_filter exitted with %d\n\n%s" % (child.returncode, bt_filter)
-
-            task.add_misc("bt-filter", bt_filter)
 
         crashrc_lines = []
 
@@ -885,6 +845,7 @@ class RetraceWorker(object):
         self.hook_pre_start()
         self.stats = {
             "taskid": self.task.get_taskid(),
+            "type": self.task.get_type(),
             "package": None,
             "version": None,
             "arch": None,
@@ -894,6 +855,8 @@ class RetraceWorker(object):
             "status": STATUS_FAIL,
         }
         self.prerunning = len(get_active_tasks()) - 1
+        # the slot has been acquired on task creation, this process owns it now
+        claim_task_slot(self.task.get_taskid())
         try:
             task = self.task
 
@@ -935,6 +898,8 @@ class RetraceWorker(object):
         except Exception as ex:
             log_error(str(ex))
             self._fail()
+        finally:
+            release_task_slot(self.task.get_taskid())
 
     def clean_task(self):
         self.hook_pre_clean_task()
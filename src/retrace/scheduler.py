@@ -0,0 +1,110 @@
+import time
+from retrace import *
+
+CONFIG = Config()
+
+LANE_INTERACTIVE = "interactive"
+LANE_COREDUMP = "coredump"
+LANE_VMCORE = "vmcore"
+
+TASK_LANES = {
+  TASK_RETRACE: LANE_COREDUMP,
+  TASK_DEBUG: LANE_COREDUMP,
+  TASK_VMCORE: LANE_VMCORE,
+  TASK_RETRACE_INTERACTIVE: LANE_INTERACTIVE,
+  TASK_VMCORE_INTERACTIVE: LANE_INTERACTIVE,
+}
+
+LANE_WEIGHT_OPTIONS = {
+  LANE_INTERACTIVE: "InteractiveLaneWeight",
+  LANE_COREDUMP: "CoredumpLaneWeight",
+  LANE_VMCORE: "VmcoreLaneWeight",
+}
+
+# client's past usage loses half of its weight after (seconds)
+USAGE_HALFLIFE = 3600.0
+
+class TaskScheduler(object):
+    """Chooses the next queued task to run.
+
+    Every lane (interactive, coredump, vmcore) gets a share of workers
+    proportional to its weight, which is implemented as weighted fair
+    queuing: running a task advances the lane's virtual time by
+    cost / weight and the lane with the lowest virtual time goes next.
+    The cost of a task is its estimated run time (get_task_est_time).
+    Within a lane the client (case number or IP address) that consumed
+    the least recently goes first, ties are broken by queue order."""
+    def __init__(self):
+        self.lane_time = {}
+        self.vclock = 0.0
+        self.usage = {}
+        self.usage_time = time.time()
+
+    def describe(self, taskid, job):
+        """Returns scheduling information about the queued job
+        or None if its task does not exist anymore."""
+        try:
+            task = RetraceTask(taskid)
+        except:
+            return None
+
+        if task.has_caseno():
+            client = "case %d" % task.get_caseno()
+        elif job.get("client"):
+            client = job["client"]
+        else:
+            client = None
+
+        return {
+          "taskid": taskid,
+          "job": job,
+          "lane": TASK_LANES.get(task.get_type(), LANE_COREDUMP),
+          "client": client,
+          "cost": float(get_task_est_time(task)),
+        }
+
+    def _weight(self, lane):
+        return max(1, CONFIG[LANE_WEIGHT_OPTIONS[lane]])
+
+    def _decay(self):
+        now = time.time()
+        factor = 0.5 ** ((now - self.usage_time) / USAGE_HALFLIFE)
+        self.usage_time = now
+        for client in self.usage.keys():
+            self.usage[client] *= factor
+            if self.usage[client] < 1.0:
+                del self.usage[client]
+
+    def _lane_start(self, lane):
+        # an idle lane must not save up credit and then starve the others
+        return max(self.lane_time.get(lane, 0.0), self.vclock)
+
+    def pick(self, candidates):
+        """Returns the candidate (see describe) that should run next"""
+        if not candidates:
+            return None
+
+        self._decay()
+
+        lanes = set(c["lane"] for c in candidates)
+        lane = min(lanes, key=lambda l: (self._lane_start(l), -self._weight(l)))
+
+        best = None
+        for candidate in candidates:
+            if candidate["lane"] != lane:
+                continue
+
+            if best is None or (self.usage.get(candidate["client"], 0.0) <
+                                self.usage.get(best["client"], 0.0)):
+                best = candidate
+
+        return best
+
+    def charge(self, candidate):
+        """Accounts the candidate that has just been started"""
+        lane = candidate["lane"]
+        start = self._lane_start(lane)
+        self.vclock = start
+        self.lane_time[lane] = start + candidate["cost"] / self._weight(lane)
+        client = candidate["client"]
+        self.usage[client] = self.usage.get(client, 0.0) + candidate["cost"]
@@ -0,0 +1,174 @@
+import errno
+import os
+import stat
+import threading
+import time
+
+# df, du and ps are called on every task manager page load and for
+# every task in the list, the probes below read the kernel's data
+# directly and remember the results for a while
+FREE_SPACE_TTL = 2
+PROCESS_TABLE_TTL = 1
+DIR_SIZE_TTL = 10
+
+PROC_DIR = "/proc"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+# indices into /proc/<pid>/stat following the command name
+STAT_PPID = 1
+STAT_STARTTIME = 19
+# entries that vanished or can not be read are left out of sizes, like du does
+WALK_SKIPPED_ERRORS = [errno.ENOENT, errno.EACCES, errno.EPERM]
+
+class TTLCache(object):
+    """Remembers results of functions for ttl seconds.
+    It is shared by the threads of mod_wsgi."""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key, func, *args):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and 0 <= now - entry[0] < self.ttl:
+                return entry[1]
+
+        value = func(*args)
+        with self.lock:
+            self.entries[key] = (now, value)
+
+        return value
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+_free_space_cache = TTLCache(FREE_SPACE_TTL)
+_process_table_cache = TTLCache(PROCESS_TABLE_TTL)
+_dir_size_cache = TTLCache(DIR_SIZE_TTL)
+
+def _statvfs_free(path):
+    try:
+        result = os.statvfs(path)
+    except OSError:
+        return None
+
+    # the same as 'Available' of df, the space left for non-root users
+    return result.f_bavail * result.f_frsize
+
+def filesystem_free_space(path):
+    """Returns the number of bytes available on the filesystem
+    containing path or None if it can't be determined"""
+    return _free_space_cache.get(os.path.realpath(path), _statvfs_free, path)
+
+def _walk_size(path):
+    result = 0
+    # hardlinks are only counted once, like du does
+    seen = set()
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            st = os.lstat(current)
+        except OSError as ex:
+            if ex.errno not in WALK_SKIPPED_ERRORS:
+                raise
+            continue
+
+        if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+
+        result += st.st_size
+        if stat.S_ISDIR(st.st_mode):
+            try:
+                names = os.listdir(current)
+            except OSError as ex:
+                if ex.errno not in WALK_SKIPPED_ERRORS:
+                    raise
+                continue
+
+            stack.extend(os.path.join(current, name) for name in names)
+
+    return result
+
+def directory_size(path):
+    """Returns the apparent size of path and everything below it
+    in bytes (du -sb)"""
+    return _dir_size_cache.get(os.path.realpath(path), _walk_size, path)
+
+class Process(object):
+    """A process as seen in /proc"""
+    __slots__ = ["pid", "ppid", "elapsed", "cmdline"]
+
+    def __init__(self, pid, ppid, elapsed, cmdline):
+        self.pid = pid
+        self.ppid = ppid
+        # seconds since the process started
+        self.elapsed = elapsed
+        self.cmdline = cmdline
+
+def _read_process(pid, uptime):
+    procdir = os.path.join(PROC_DIR, "%d" % pid)
+    with open(os.path.join(procdir, "stat"), "r") as f:
+        line = f.read()
+
+    # the command name in parentheses may contain anything
+    fields = line[line.rindex(")") + 2:].split()
+    ppid = int(fields[STAT_PPID])
+    elapsed = max(0, int(uptime - float(fields[STAT_STARTTIME]) / CLOCK_TICKS))
+
+    with open(os.path.join(procdir, "cmdline"), "r") as f:
+        cmdline = f.read().split("\0")
+
+    if cmdline and not cmdline[-1]:
+        cmdline.pop()
+
+    return Process(pid, ppid, elapsed, cmdline)
+
+def read_process_table():
+    """Returns { pid: Process } of all processes, read from /proc"""
+    with open(os.path.join(PROC_DIR, "uptime"), "r") as f:
+        uptime = float(f.read().split()[0])
+
+    result = {}
+    for name in os.listdir(PROC_DIR):
+        if not name.isdigit():
+            continue
+
+        try:
+            process = _read_process(int(name), uptime)
+        except (IOError, OSError, ValueError, IndexError):
+            # the process has exited meanwhile
+            continue
+
+        result[process.pid] = process
+
+    return result
+
+def get_process_table():
+    """read_process_table() cached for PROCESS_TABLE_TTL seconds"""
+    return _process_table_cache.get(None, read_process_table)
+
+def get_process_tree(pid, processes=None):
+    """Returns PIDs of the process and all its descendants"""
+    if processes is None:
+        processes = get_process_table()
+
+    children = {}
+    for process in processes.values():
+        children.setdefault(process.ppid, []).append(process.pid)
+
+    result = []
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        result.append(current)
+        stack.extend(children.get(current, []))
+
+    return result
@@ -0,0 +1,151 @@
+"""Benchmark package resolution of coredump2packages.
+
+run: python benchmark_resolver.py [--libraries=N] [--versions=N]
+
+Generates synthetic eu-unstrip output of a core with many shared
+libraries and a fake package sack in which every library was shipped
+by several releases of its package with the same build-id. Resolves it
+with PackageResolver and with the original quadratic algorithm, checks
+that both give the same result and prints the times.
+"""
+
+from __future__ import print_function
+import argparse
+import sys
+import time
+from retrace.repoindex import IndexedPackage, compare_evr
+from retrace.resolver import PackageResolver, parse_unstrip_output
+
+class FakeSearch(object):
+    """Same interface as retrace.resolver.YumSearch"""
+    name = "Fake"
+
+    def __init__(self, libraries, versions):
+        self.debuginfo = {}
+        self.files = {}
+        self.evra = {}
+        self.unstrip = []
+        for lib in range(libraries):
+            # every source package ships several libraries
+            source = "source%d" % (lib % max(1, libraries // 4))
+            build_id = "%040x" % (lib + 1)
+            path = "/usr/lib64/lib%d.so.1" % lib
+            for version in range(versions):
+                # older releases did not ship all libraries
+                if version and (lib + version) % 3 == 0:
+                    continue
+                release = "%d.fc25" % (version + 1)
+                debuginfo = IndexedPackage("%s-debuginfo" % source, 0, "1.0", release,
+                                           "x86_64", source)
+                binary = IndexedPackage("%s-libs" % source, 0, "1.0", release,
+                                        "x86_64", source)
+                self.debuginfo.setdefault(build_id, []).append((debuginfo, None))
+                self.files.setdefault(path, []).append(binary)
+                key = (debuginfo.epoch, debuginfo.ver, debuginfo.rel, debuginfo.arch)
+                self.evra.setdefault(key, []).append(binary)
+            self.unstrip.append("0x%x+0x1000 %s@0x%x %s - lib%d.so.1"
+                                % (lib << 16, build_id, lib << 16, path, lib))
+
+    def prefetch(self, entries, log):
+        pass
+
+    def debuginfos(self, build_id):
+        return self.debuginfo.get(build_id, [])
+
+    def binaries(self, binobj_path):
+        return self.files.get(binobj_path, [])
+
+    def by_evra(self, package):
+        return self.evra.get((package.epoch, package.ver, package.rel, package.arch), [])
+
+class QuadraticResolver(PackageResolver):
+    """The original algorithm, kept as a reference"""
+    def process_unstrip_output(self, entries, log):
+        package_list = []
+        missing_buildid_list = []
+        coredump_package_list = []
+        first_entry = True
+        for build_id, binobj_path in entries:
+            entry_package_list, entry_coredump_package_list = self.process_unstrip_entry(build_id, binobj_path, log)
+            if first_entry:
+                coredump_package_list = entry_coredump_package_list
+                first_entry = False
+            if len(entry_package_list) == 0:
+                missing_buildid_list.append([binobj_path, build_id])
+            else:
+                for entry_package in entry_package_list:
+                    found = False
+                    for package in package_list:
+                        if str(entry_package) == str(package):
+                            found = True
+                            break
+                    if not found:
+                        package_list.append(entry_package)
+        return package_list, missing_buildid_list, coredump_package_list
+
+    def remove_duplicates(self, package_list, log):
+        def find_duplicates():
+            for p1 in range(0, len(package_list) - 1):
+                package1 = package_list[p1]
+                for p2 in range(p1 + 1, len(package_list)):
+                    package2 = package_list[p2]
+                    if package1.name == package2.name and package1.arch == package2.arch:
+                        return package1, package2
+            return None, None
+
+        def count_removals(package):
+            count = 0
+            for other in package_list:
+                if other.base_package_name != package.base_package_name:
+                    continue
+                if other.epoch != package.epoch or other.ver != package.ver or \
+                   other.rel != package.rel or other.arch != package.arch:
+                    continue
+                count += 1
+            return count
+
+        while True:
+            package1, package2 = find_duplicates()
+            if package1 is None:
+                break
+            p1removals = count_removals(package1)
+            p2removals = count_removals(package2)
+            removal_candidate = package1
+            if p1removals == p2removals:
+                if compare_evr(package1, package2) > 0:
+                    removal_candidate = package2
+            elif p1removals > p2removals:
+                removal_candidate = package2
+            for package in package_list[:]:
+                if package.base_package_name == removal_candidate.base_package_name and \
+                        0 == compare_evr(package, removal_candidate):
+                    package_list.remove(package)
+
+def measure(resolver, entries):
+    start = time.time()
+    result = resolver.resolve(entries)
+    return result, time.time() - start
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Benchmark coredump package resolution")
+    argparser.add_argument("--libraries", type=int, default=400,
+                           help="Number of shared libraries in the core")
+    argparser.add_argument("--versions", type=int, default=3,
+                           help="Number of package releases sharing a build-id")
+    args = argparser.parse_args()
+
+    search = FakeSearch(args.libraries, args.versions)
+    entries = parse_unstrip_output("\n".join(search.unstrip))
+
+    result, elapsed = measure(PackageResolver(search), entries)
+    reference, reference_elapsed = measure(QuadraticResolver(search), entries)
+
+    print("Libraries: %d, package releases: %d, packages: %d"
+          % (args.libraries, args.versions, len(result[1])))
+    print("Hashed:    %.3f s" % elapsed)
+    print("Quadratic: %.3f s" % reference_elapsed)
+    if result != reference:
+        print("Results differ", file=sys.stderr)
+        sys.exit(1)
+
+    print("Speedup:   %.1fx" % (reference_elapsed / max(elapsed, 1e-6)))
@@ -0,0 +1,150 @@
+"""Test downloading of remote files by RangedDownload.
+
+run: python test_download.py
+
+Serves random data by a local HTTP server supporting range requests
+and checks parallel, resumed and plain downloads.
+"""
+
+import BaseHTTPServer
+import os
+import re
+import shutil
+import SocketServer
+import tempfile
+import threading
+import unittest
+from retrace.retrace import RangedDownload, DOWNLOAD_STATE_SUFFIX
+
+CHUNK = 1 << 20
+RANGE_PARSER = re.compile("^bytes=([0-9]+)-([0-9]+)$")
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.data = ""
+        self.etag = "\"1\""
+        self.ranges = True
+        # requests starting at these offsets are cut short
+        self.broken = set()
+        # the same, but only once
+        self.flaky = set()
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def url(self, name="vmcore.tar.gz"):
+        return "http://127.0.0.1:%d/%s" % (self.server_address[1], name)
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _headers(self, code, length, extra={}):
+        self.send_response(code)
+        self.send_header("Content-Length", "%d" % length)
+        self.send_header("ETag", self.server.etag)
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        for key, value in extra.items():
+            self.send_header(key, value)
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._headers(200, len(self.server.data))
+
+    def do_GET(self):
+        data = self.server.data
+        match = RANGE_PARSER.match(self.headers.getheader("Range", ""))
+        if not self.server.ranges or match is None:
+            with self.server.lock:
+                self.server.requests.append(None)
+            self._headers(200, len(data))
+            self.wfile.write(data)
+            return
+
+        first, last = int(match.group(1)), int(match.group(2))
+        with self.server.lock:
+            self.server.requests.append(first)
+        self._headers(206, last - first + 1,
+                      { "Content-Range": "bytes %d-%d/%d" % (first, last, len(data)) })
+        with self.server.lock:
+            cut = first in self.server.broken or first in self.server.flaky
+            self.server.flaky.discard(first)
+        if cut:
+            self.wfile.write(data[first:first + 1000])
+            return
+
+        self.wfile.write(data[first:last + 1])
+
+class TestRangedDownload(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.data = os.urandom(5 * CHUNK + 12345)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "vmcore.tar.gz")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def download(self, connections=3, progress=None):
+        RangedDownload(self.server.url(), self.path, connections=connections,
+                       chunksize=CHUNK, progress=progress).run()
+
+    def check_file(self):
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.server.data)
+        self.assertFalse(os.path.exists(self.path + DOWNLOAD_STATE_SUFFIX))
+
+    def test_parallel(self):
+        progress = []
+        self.download(progress=lambda current, total: progress.append((current, total)))
+        self.check_file()
+        self.assertEqual(sorted(self.server.requests), [i * CHUNK for i in xrange(6)])
+        self.assertEqual(progress[-1], (len(self.server.data), len(self.server.data)))
+
+    def test_no_ranges(self):
+        self.server.ranges = False
+        self.download()
+        self.check_file()
+        self.assertEqual(self.server.requests, [None])
+
+    def test_resume(self):
+        self.server.broken = set([2 * CHUNK])
+        self.assertRaises(Exception, self.download, 1)
+        self.assertTrue(os.path.exists(self.path + DOWNLOAD_STATE_SUFFIX))
+
+        self.server.broken = set()
+        self.server.requests = []
+        self.download()
+        self.check_file()
+        # the chunks before the broken one are not fetched again
+        self.assertEqual(sorted(self.server.requests), [i * CHUNK for i in xrange(2, 6)])
+
+    def test_retry(self):
+        self.server.flaky = set([CHUNK, 3 * CHUNK])
+        self.download()
+        self.check_file()
+        self.assertEqual(sorted(self.server.requests),
+                         sorted([i * CHUNK for i in xrange(6)] + [CHUNK, 3 * CHUNK]))
+
+    def test_changed_file(self):
+        self.server.broken = set([4 * CHUNK])
+        self.assertRaises(Exception, self.download, 1)
+
+        self.server.broken = set()
+        self.server.etag = "\"2\""
+        self.server.data = self.server.data[::-1]
+        self.server.requests = []
+        self.download()
+        self.check_file()
+        self.assertEqual(len(self.server.requests), 6)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+"""Test FTP connection pooling and resumed downloads by FtpDownload.
+
+run: python test_ftp.py
+
+Requires pyftpdlib, skipped without it. Serves random data by a local
+FTP server and checks segmented, interrupted and continued downloads.
+"""
+
+from __future__ import print_function
+import ftplib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, DTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    print("pyftpdlib is not installed, skipping FTP tests", file=sys.stderr)
+    sys.exit(0)
+from retrace.retrace import Config, FtpDownload, FtpPool, DOWNLOAD_STATE_SUFFIX, \
+                            FTP_MIN_SEGMENT, ftp_list_dir, get_ftp_pool
+
+CONFIG = Config()
+SIZE = 3 * FTP_MIN_SEGMENT + 12345
+
+class StandInDTPHandler(DTPHandler):
+    def __init__(self, sock, cmd_channel):
+        DTPHandler.__init__(self, sock, cmd_channel)
+        self.sent = 0
+
+    def send(self, data):
+        server = self.cmd_channel.server
+        if server.cut_after is not None and self.sent + len(data) > server.cut_after:
+            # drop the connection in the middle of the transfer
+            server.cut_after = None
+            self.close()
+            return 0
+
+        sent = DTPHandler.send(self, data)
+        self.sent += sent
+        return sent
+
+class StandInHandler(FTPHandler):
+    dtp_handler = StandInDTPHandler
+
+    def on_login(self, username):
+        with self.server.lock:
+            self.server.logins += 1
+
+    def ftp_NLST(self, path):
+        with self.server.lock:
+            if self.server.failing_nlst > 0:
+                self.server.failing_nlst -= 1
+                self.respond("421 Service not available")
+                return
+        return FTPHandler.ftp_NLST(self, path)
+
+    def ftp_RETR(self, file):
+        with self.server.lock:
+            self.server.retrieved.append(self._restart_position)
+        return FTPHandler.ftp_RETR(self, file)
+
+class TestFtp(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.ftpdir = tempfile.mkdtemp()
+        cls.data = os.urandom(SIZE)
+        with open(os.path.join(cls.ftpdir, "vmcore.tar.gz"), "wb") as f:
+            f.write(cls.data)
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_user("retrace", "secret", cls.ftpdir)
+        StandInHandler.authorizer = authorizer
+        cls.server = ThreadedFTPServer(("127.0.0.1", 0), StandInHandler)
+        cls.server.lock = threading.Lock()
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+        for key, value in [("FTPHost", "127.0.0.1"), ("FTPPort", cls.server.address[1]),
+                           ("FTPUser", "retrace"), ("FTPPass", "secret"),
+                           ("FTPDir", "/"), ("FTPSSL", False)]:
+            CONFIG[key]
+            CONFIG.GLOBAL[key] = value
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close_all()
+        shutil.rmtree(cls.ftpdir)
+
+    def setUp(self):
+        self.server.logins = 0
+        self.server.retrieved = []
+        self.server.cut_after = None
+        self.server.failing_nlst = 0
+        self.pool = FtpPool(4)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "vmcore.tar.gz")
+
+    def tearDown(self):
+        self.pool.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def download(self, segments):
+        FtpDownload(self.pool, "vmcore.tar.gz", self.path, segments=segments).run()
+
+    def check_file(self):
+        with open(self.path, "rb") as f:
+            self.assertTrue(f.read() == self.data)
+        self.assertFalse(os.path.exists(self.path + DOWNLOAD_STATE_SUFFIX))
+
+    def test_pool(self):
+        for i in xrange(5):
+            ftp = self.pool.acquire()
+            self.assertEqual(ftp_list_dir("/", ftp), ["vmcore.tar.gz"])
+            self.pool.release(ftp)
+        self.assertEqual(self.server.logins, 1)
+
+    def test_segments(self):
+        self.download(3)
+        self.check_file()
+        self.assertEqual(sorted(self.server.retrieved),
+                         [0, SIZE // 3, 2 * (SIZE // 3)])
+
+    def test_dropped_connection(self):
+        self.server.cut_after = 5 << 20
+        self.download(1)
+        self.check_file()
+        self.assertEqual(len(self.server.retrieved), 2)
+        self.assertEqual(self.server.retrieved[0], 0)
+        self.assertTrue(self.server.retrieved[1] > 0)
+
+    def test_partial_file(self):
+        with open(self.path, "wb") as f:
+            f.write(self.data[:1000000])
+        self.download(3)
+        self.check_file()
+        self.assertEqual(self.server.retrieved, [1000000])
+
+    def test_preallocated_file(self):
+        # the state is recorded before anything is retrieved
+        download = FtpDownload(self.pool, "vmcore.tar.gz", self.path, segments=3)
+        download._probe()
+        download._load_state()
+        self.assertTrue(os.path.exists(self.path + DOWNLOAD_STATE_SUFFIX))
+
+        # a full-size file without the state is not taken as complete
+        os.unlink(self.path + DOWNLOAD_STATE_SUFFIX)
+        self.download(3)
+        self.check_file()
+        self.assertEqual(sorted(self.server.retrieved),
+                         [0, SIZE // 3, 2 * (SIZE // 3)])
+
+    def test_failed_listing(self):
+        # every failure gives the connection back to the pool
+        connections = CONFIG["FTPConnections"]
+        self.server.failing_nlst = connections + 1
+        for i in xrange(connections + 1):
+            self.assertRaises(ftplib.error_temp, ftp_list_dir, "/")
+        self.assertEqual(ftp_list_dir("/"), ["vmcore.tar.gz"])
+        get_ftp_pool().clear()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    unittest.main()